@@ -0,0 +1,59 @@
+"""Benchmark of FileStorage count and list against the former glob-based walk.
+
+Usage::
+
+    python benchmarks/filestorage_walk.py --files 1000000 --directory /mnt/disk/bench
+"""
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+import uuid
+
+from simple_file_repository import FileStorage
+
+
+def populate(storage: FileStorage, files: int):
+    # write files directly to stripes, FileStorage.store is too slow for millions
+    for _ in range(files):
+        file_id = uuid.uuid4()
+        stripe_dir = storage._select_stripe(file_id)
+        if stripe_dir not in storage._created_stripes:
+            storage._create_stripe(stripe_dir)
+        with open(os.path.join(stripe_dir, file_id.hex + ".bin"), "wb") as f:
+            f.write(b"x")
+
+
+def measure(name: str, fn):
+    started = time.perf_counter()
+    result = fn()
+    print("{:<12} {:>10} {:8.3f} s".format(name, result, time.perf_counter() - started))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=1000000)
+    parser.add_argument("--directory", default=None)
+    parser.add_argument("--workers", type=int, default=8)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(dir=args.directory) as directory:
+        storage = FileStorage(directory, "bench", walk_workers=args.workers)
+        print("Populating {} files in {}".format(args.files, directory))
+        populate(storage, args.files)
+        pattern = storage.database_directory + "/*/*.bin"
+
+        measure("glob count", lambda: len(glob.glob(pattern)))
+        measure("count", storage.count)
+        measure(
+            "glob list",
+            lambda: sum(1 for path in glob.glob(pattern) if path.split("/")[-1][0:-4]),
+        )
+        measure("list", lambda: sum(1 for _ in storage.list()))
+        measure("clean", lambda: storage.clean() or 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Benchmark of MultiFileStorage throughput against the count of roots.
+
+Files are stored and read back by concurrent workers over the first 1, 2,
+... N roots. With roots on separate disks store and get throughput must
+grow linearly with the count of roots. Lookups of missing files probe
+every root, so their throughput is expected to drop as roots are added.
+
+Usage::
+
+    python benchmarks/multifilestorage_scaling.py --files 20000 \\
+        --roots /mnt/disk0/bench /mnt/disk1/bench /mnt/disk2/bench
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from simple_file_repository import MultiFileStorage
+
+
+def rate(fn, items, workers: int):
+    """Return results of `fn` over items and items per second."""
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(fn, items))
+    return results, len(items) / (time.perf_counter() - started)
+
+
+def run(roots, files: int, size: int, workers: int):
+    storage = MultiFileStorage(roots, "bench")
+    content = os.urandom(size)
+    file_ids, stored = rate(lambda _: storage.store(content), range(files), workers)
+    _, read = rate(storage.get, file_ids, workers)
+    missing_ids = [uuid.uuid4() for _ in range(files)]
+    _, missed = rate(storage.exists, missing_ids, workers)
+    return stored, read, missed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--roots", nargs="+", default=None)
+    parser.add_argument("--files", type=int, default=20000)
+    parser.add_argument("--size", type=int, default=64 * 1024)
+    parser.add_argument("--workers", type=int, default=16)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        parents = args.roots or [
+            os.path.join(directory, "disk{}".format(index)) for index in range(4)
+        ]
+        print(
+            "{:>5} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+                "roots", "store/s", "get/s", "miss/s", "store x", "get x"
+            )
+        )
+        baseline = None
+        for count in range(1, len(parents) + 1):
+            roots = []
+            for parent in parents[:count]:
+                os.makedirs(parent, exist_ok=True)
+                roots.append(tempfile.mkdtemp(dir=parent))
+            try:
+                stored, read, missed = run(roots, args.files, args.size, args.workers)
+            finally:
+                for root in roots:
+                    shutil.rmtree(root, ignore_errors=True)
+            baseline = baseline or (stored, read)
+            print(
+                "{:>5} {:>10.0f} {:>10.0f} {:>10.0f} {:>8.2f} {:>8.2f}".format(
+                    count,
+                    stored,
+                    read,
+                    missed,
+                    stored / baseline[0],
+                    read / baseline[1],
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""Benchmark of thumbnail latency and CPU time of ImageMagick and Pillow backends.
+
+CPU time includes `convert` child processes.
+
+Usage::
+
+    python benchmarks/thumbnailer.py --image photo.jpg --count 50 --convert /usr/bin/convert
+"""
+
+import argparse
+import resource
+import shutil
+import statistics
+import time
+
+from simple_file_repository import ImageMagickThumbnailer, PillowThumbnailer
+from simple_file_repository.imageinfo import parse_image_info
+from simple_file_repository.photostorage import ThumbnailProfile
+
+PROFILES = {
+    "quality": ThumbnailProfile.QUALITY,
+    "balanced": ThumbnailProfile.BALANCED,
+    "fast": ThumbnailProfile.FAST,
+}
+
+
+def cpu_time() -> float:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime + children.ru_utime + children.ru_stime
+
+
+def measure(name: str, thumbnailer, content: bytes, args):
+    info = parse_image_info(content)
+    latencies = []
+    started_cpu = cpu_time()
+    for _ in range(args.count):
+        started = time.perf_counter()
+        thumbnailer.render(
+            content, info, args.formats, args.size, PROFILES[args.profile]
+        )
+        latencies.append(time.perf_counter() - started)
+    cpu = (cpu_time() - started_cpu) / args.count
+    latencies.sort()
+    print(
+        "{:<12} median {:8.1f} ms  p95 {:8.1f} ms  cpu {:8.1f} ms".format(
+            name,
+            statistics.median(latencies) * 1000,
+            latencies[int(len(latencies) * 0.95) - 1] * 1000,
+            cpu * 1000,
+        )
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--image", required=True)
+    parser.add_argument("--count", type=int, default=50)
+    parser.add_argument("--size", type=int, default=200)
+    parser.add_argument("--formats", nargs="+", default=["image/jpeg"])
+    parser.add_argument("--profile", choices=sorted(PROFILES), default="quality")
+    parser.add_argument("--convert", default=shutil.which("convert"))
+    args = parser.parse_args()
+
+    with open(args.image, "rb") as f:
+        content = f.read()
+    if args.convert:
+        measure("imagemagick", ImageMagickThumbnailer(args.convert), content, args)
+    else:
+        print("imagemagick  skipped, convert is not found")
+    measure("pillow", PillowThumbnailer(), content, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,16 +4,34 @@ Simple file and photo repository storage.
 Backed by filesystem or S3 storages.
 """
 
+from .archive import export_archive, import_archive  # noqa: F401
+from .bloom import BloomFilter  # noqa: F401
+from .bloomstorage import BloomStorage  # noqa: F401
+from .coalescingstorage import CoalescingStorage  # noqa: F401
 from .exceptions import StorageError  # noqa: F401
+from .exceptions import StorageExistsError  # noqa: F401
 from .exceptions import StorageNotFoundError  # noqa: F401
 from .exceptions import StorageNotInitializedError  # noqa: F401
+from .exceptions import StorageThrottledError  # noqa: F401
 from .exceptions import (  # noqa: F401
     PhotoStorageNotFoundError,
 )
 from .filestorage import FileStorage  # noqa: F401
-from .photostorage import PhotoStorage  # noqa: F401
+from .hedging import Hedger  # noqa: F401
+from .imageinfo import ImageInfo  # noqa: F401
+from .limiter import AdaptiveLimiter  # noqa: F401
+from .migrate import Migrator  # noqa: F401
+from .multifilestorage import DiskRoot, MultiFileStorage  # noqa: F401
+from .photostorage import PhotoStorage, ThumbnailProfile  # noqa: F401
 from .photostorages import PhotoStorages  # noqa: F401
+from .prefetchingstorage import PrefetchingStorage  # noqa: F401
 from .s3storage import S3Storage  # noqa: F401
-from .storage import Storage  # noqa: F401
+from .scrubber import Scrubber  # noqa: F401
+from .singleflight import SingleFlight  # noqa: F401
+from .storage import FileHandle, FileStat, Storage  # noqa: F401
+from .thumbnailer import ImageMagickThumbnailer  # noqa: F401
+from .thumbnailer import PillowThumbnailer, Thumbnailer  # noqa: F401
+from .tieredstorage import TieredStorage  # noqa: F401
+from .usage import Usage  # noqa: F401
 
 __version__ = "0.10.0"
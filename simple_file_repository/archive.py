@@ -0,0 +1,237 @@
+import json
+import logging
+import tarfile
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, Iterator, Optional, Tuple
+from uuid import UUID
+
+from .exceptions import StorageError, StorageNotFoundError
+from .storage import FileHandle, FileStat, Storage
+from .utils import bounded_map
+
+logger = logging.getLogger("Archive")
+
+MANIFEST_NAME = "MANIFEST.jsonl"
+
+COMPRESSION_GZIP = "gz"
+COMPRESSION_ZSTD = "zstd"
+
+# PAX header keywords carrying object metadata
+PAX_CONTENT_TYPE = "SFR.content_type"
+PAX_CACHE_CONTROL = "SFR.cache_control"
+PAX_TAGS = "SFR.tags"
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    WORKERS = 8
+    # manifest is kept in memory until it grows larger
+    MANIFEST_SPOOL_SIZE = 1024 * 1024
+
+
+def _zstandard():
+    try:
+        import zstandard  # pylint: disable=import-outside-toplevel
+    except ImportError as e:
+        raise ValueError("Install zstandard to use zstd compression") from e
+    return zstandard
+
+
+def _check_compression(compression: Optional[str]):
+    if compression not in (None, COMPRESSION_GZIP, COMPRESSION_ZSTD):
+        raise ValueError("Unsupported compression " + str(compression))
+
+
+def _object_tarinfo(stat: FileStat, size: int) -> tarfile.TarInfo:
+    tarinfo = tarfile.TarInfo(stat.file_id.hex)
+    tarinfo.size = size
+    tarinfo.mode = 0o644
+    if stat.mtime is not None:
+        tarinfo.mtime = int(stat.mtime)
+    pax_headers = {PAX_CONTENT_TYPE: stat.content_type}
+    if stat.cache_control:
+        pax_headers[PAX_CACHE_CONTROL] = stat.cache_control
+    if stat.tags:
+        pax_headers[PAX_TAGS] = json.dumps(stat.tags, sort_keys=True)
+    tarinfo.pax_headers = pax_headers
+    return tarinfo
+
+
+def _manifest_entry(stat: FileStat, size: int) -> dict:
+    return {
+        "id": stat.file_id.hex,
+        "content_type": stat.content_type,
+        "size": size,
+        "cache_control": stat.cache_control,
+        "tags": stat.tags,
+    }
+
+
+def _open_object(
+    storage: Storage, file_hex: str
+) -> Optional[Tuple[FileStat, FileHandle]]:
+    file_id = UUID(hex=file_hex)
+    try:
+        stat = storage.stat(file_id, with_tags=True)
+        return stat, storage.open_file(file_id)
+    except StorageNotFoundError:
+        # deleted after listing
+        logger.warning("Skipping missing object %s", file_hex)
+        return None
+
+
+def _write_objects(
+    storage: Storage,
+    archive: tarfile.TarFile,
+    manifest: BinaryIO,
+    file_ids: Iterable[str],
+    workers: int,
+) -> int:
+    count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        # objects are opened ahead and streamed to the archive in order
+        items = bounded_map(
+            executor,
+            lambda file_hex: _open_object(storage, file_hex),
+            file_ids,
+            workers,
+        )
+        for item in items:
+            if item is None:
+                continue
+            stat, handle = item
+            with handle:
+                # the size of the opened object, it may differ from stat
+                archive.addfile(_object_tarinfo(stat, handle.size), handle)
+            line = json.dumps(_manifest_entry(stat, handle.size)) + "\n"
+            manifest.write(line.encode("utf-8"))
+            count += 1
+    return count
+
+
+def _write_manifest(archive: tarfile.TarFile, manifest: BinaryIO):
+    tarinfo = tarfile.TarInfo(MANIFEST_NAME)
+    tarinfo.size = manifest.tell()
+    tarinfo.mtime = int(time.time())
+    tarinfo.mode = 0o644
+    manifest.seek(0)
+    archive.addfile(tarinfo, manifest)
+
+
+def export_archive(
+    storage: Storage,
+    fileobj: BinaryIO,
+    file_ids: Optional[Iterable[str]] = None,
+    compression: Optional[str] = None,
+    workers: int = DefaultParams.WORKERS,
+) -> int:
+    """Write objects of a storage to a tar archive.
+
+    Every object is a member named by its hex id with mime type, cache
+    control and tags in PAX headers. A manifest with one JSON line per object
+    is appended as a last member `MANIFEST.jsonl`. Objects are read by
+    `workers` threads but written in order of `file_ids`. The archive is
+    streamed, so `fileobj` may be a pipe or a socket. Objects are streamed
+    as well, so memory use does not depend on object sizes.
+
+    :param storage: a storage to export
+    :param fileobj: a writable binary file object
+    :param file_ids: hex ids to export, all objects of the storage if `None`
+    :param compression: `gz`, `zstd` (requires `zstandard` package) or `None`
+    :param workers: count of concurrent reads
+    :return: count of exported objects
+    """
+    _check_compression(compression)
+    if workers < 1:
+        raise ValueError("Invalid workers count " + str(workers))
+    if file_ids is None:
+        file_ids = storage.list()
+
+    compressor = None
+    if compression == COMPRESSION_ZSTD:
+        compressor = _zstandard().ZstdCompressor().stream_writer(fileobj, closefd=False)
+        fileobj = compressor
+    mode = "w|gz" if compression == COMPRESSION_GZIP else "w|"
+
+    with tempfile.SpooledTemporaryFile(
+        max_size=DefaultParams.MANIFEST_SPOOL_SIZE
+    ) as manifest:
+        with tarfile.open(
+            fileobj=fileobj, mode=mode, format=tarfile.PAX_FORMAT
+        ) as archive:
+            count = _write_objects(storage, archive, manifest, file_ids, workers)
+            _write_manifest(archive, manifest)
+    if compressor is not None:
+        compressor.close()
+    logger.info("Exported %d objects", count)
+    return count
+
+
+def _read_members(archive: tarfile.TarFile) -> Iterator[Tuple[UUID, bytes, dict]]:
+    for tarinfo in archive:
+        if tarinfo.name == MANIFEST_NAME or not tarinfo.isfile():
+            continue
+        try:
+            file_id = UUID(hex=tarinfo.name)
+        except ValueError:
+            logger.warning("Skipping unknown archive member %s", tarinfo.name)
+            continue
+        member = archive.extractfile(tarinfo)
+        yield file_id, member.read(), tarinfo.pax_headers
+
+
+def import_archive(
+    storage: Storage,
+    fileobj: BinaryIO,
+    compression: Optional[str] = None,
+    workers: int = DefaultParams.WORKERS,
+    skip_existing: bool = True,
+) -> int:
+    """Store objects from an archive written by :func:`export_archive`.
+
+    Objects keep their ids, mime types, cache control and tags. The archive
+    is read sequentially, so `fileobj` may be a pipe, objects are stored by
+    `workers` threads.
+
+    :param storage: a storage to import to
+    :param fileobj: a readable binary file object
+    :param compression: `zstd` for zstd-compressed archive, gzip is detected
+    :param workers: count of concurrent writes
+    :param skip_existing: do not store objects that storage already has
+    :return: count of imported objects
+    """
+    _check_compression(compression)
+    if workers < 1:
+        raise ValueError("Invalid workers count " + str(workers))
+    if compression == COMPRESSION_ZSTD:
+        fileobj = _zstandard().ZstdDecompressor().stream_reader(fileobj)
+
+    def write(item: Tuple[UUID, bytes, dict]) -> bool:
+        file_id, content, pax_headers = item
+        if skip_existing and storage.exists(file_id):
+            return False
+        tags = pax_headers.get(PAX_TAGS)
+        storage.store(
+            content,
+            content_type=pax_headers.get(PAX_CONTENT_TYPE),
+            tags=json.loads(tags) if tags else None,
+            override_id=file_id,
+            cache_control=pax_headers.get(PAX_CACHE_CONTROL),
+        )
+        return True
+
+    count = 0
+    try:
+        with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                for stored in bounded_map(
+                    executor, write, _read_members(archive), workers * 2
+                ):
+                    count += int(stored)
+    except tarfile.TarError as e:
+        raise StorageError("Invalid archive: " + str(e)) from e
+    logger.info("Imported %d objects", count)
+    return count
@@ -0,0 +1,120 @@
+import hashlib
+import math
+import os
+import struct
+import threading
+import time
+from typing import Iterator
+from uuid import UUID
+
+
+class BloomFilter:
+    """A Bloom filter of file ids.
+
+    A filter answers whether an id may have been added. There are no false
+    negatives, false positives occur with a probability close to `error_rate`
+    while no more than `capacity` ids are added.
+    """
+
+    MAGIC = b"SFRBLOOM"
+    # magic, version, bit count, hash count, id count, build time
+    HEADER = struct.Struct("<8sBQBQd")
+    VERSION = 1
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        """Construct an empty filter.
+
+        :param capacity: expected count of ids
+        :param error_rate: a desired false positive probability at capacity
+        """
+        if capacity < 1:
+            raise ValueError("Invalid capacity " + str(capacity))
+        if not 0 < error_rate < 1:
+            raise ValueError("Invalid error rate " + str(error_rate))
+        bit_count = math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)
+        hash_count = max(1, round(bit_count / capacity * math.log(2)))
+        self._init(bit_count, hash_count, bytearray((bit_count + 7) // 8))
+        self.built_at = time.time()
+
+    def _init(self, bit_count: int, hash_count: int, bits: bytearray):
+        self.bit_count = bit_count
+        self.hash_count = hash_count
+        self.count = 0
+        self._bits = bits
+        self._lock = threading.Lock()
+
+    def _positions(self, file_id: UUID) -> Iterator[int]:
+        # double hashing, see Kirsch and Mitzenmacher
+        digest = hashlib.blake2b(file_id.bytes, digest_size=16).digest()
+        h1, h2 = struct.unpack("<QQ", digest)
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, file_id: UUID):
+        """Add an id to the filter."""
+        with self._lock:
+            for position in self._positions(file_id):
+                self._bits[position >> 3] |= 1 << (position & 7)
+            self.count += 1
+
+    def __contains__(self, file_id: UUID) -> bool:
+        return all(
+            self._bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(file_id)
+        )
+
+    def false_positive_rate(self) -> float:
+        """Estimate a current false positive probability from the filled bits."""
+        filled = sum(bin(byte).count("1") for byte in self._bits)
+        return (filled / self.bit_count) ** self.hash_count
+
+    def save(self, path: str):
+        """Write the filter to a file atomically."""
+        # unique, so concurrent writers do not mix their files
+        tmp_path = "{}.{}.{}.tmp".format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            with self._lock:
+                f.write(
+                    self.HEADER.pack(
+                        self.MAGIC,
+                        self.VERSION,
+                        self.bit_count,
+                        self.hash_count,
+                        self.count,
+                        self.built_at,
+                    )
+                )
+                f.write(self._bits)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "BloomFilter":
+        """Read a filter written by :meth:`save`.
+
+        :raises ValueError: if a file is not a valid filter
+        """
+        with open(path, "rb") as f:
+            header = f.read(cls.HEADER.size)
+            if len(header) != cls.HEADER.size:
+                raise ValueError("Truncated filter " + path)
+            magic, version, bit_count, hash_count, count, built_at = cls.HEADER.unpack(
+                header
+            )
+            if magic != cls.MAGIC or version != cls.VERSION:
+                raise ValueError("Unsupported filter " + path)
+            bits = bytearray(f.read())
+        if len(bits) != (bit_count + 7) // 8 or hash_count < 1:
+            raise ValueError("Truncated filter " + path)
+        bloom = cls.__new__(cls)
+        # pylint: disable=protected-access
+        bloom._init(bit_count, hash_count, bits)
+        bloom.count = count
+        bloom.built_at = built_at
+        return bloom
+
+    def __repr__(self) -> str:
+        return "BloomFilter bits={} hashes={} count={}".format(
+            self.bit_count, self.hash_count, self.count
+        )
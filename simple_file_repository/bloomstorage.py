@@ -0,0 +1,460 @@
+import fcntl
+import logging
+import os
+import threading
+import time
+from typing import Callable, Iterable, Optional, TypeVar
+from uuid import UUID
+
+from .bloom import BloomFilter
+from .exceptions import StorageError, StorageNotFoundError
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+
+R = TypeVar("R")
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    CAPACITY = 1000000
+    ERROR_RATE = 0.01
+    REBUILD_INTERVAL = 24 * 3600.0
+
+
+class BloomStorage(Storage):  # pylint: disable=too-many-public-methods
+    """Storage wrapper answering lookups of missing files without a backend.
+
+    A Bloom filter of stored ids is built by listing the underlying storage
+    and updated on `store` and `copy`. Lookups of ids that are definitely not
+    stored (`exists`, `get`, `stat`, ...) are answered from the filter, other
+    lookups go to the underlying storage. Deleted ids stay in the filter until
+    it is rebuilt every `rebuild_interval` seconds in background.
+
+    The filter is persisted to `path` on rebuild and on :meth:`close`, ids
+    stored in between are appended to a journal `<path>.journal`, so the
+    filter is loaded on start without listing. The journal is shared by all
+    `BloomStorage` instances of a `path`, e.g. in several worker processes:
+    before answering that an id is missing, ids appended by other writers
+    are read, and a filter saved by another writer is loaded. So every
+    writer of the underlying storage must store through a `BloomStorage`
+    of the same `path`. Without a `path` the filter knows only ids stored
+    through this instance, so it must be the only writer.
+    """
+
+    logger = logging.getLogger("BloomStorage")
+
+    def __init__(
+        self,
+        storage: Storage,
+        path: Optional[str] = None,
+        capacity: int = DefaultParams.CAPACITY,
+        error_rate: float = DefaultParams.ERROR_RATE,
+        rebuild_interval: Optional[float] = DefaultParams.REBUILD_INTERVAL,
+        build: bool = True,
+    ):
+        """Construct BloomStorage instance.
+
+        :param storage: an underlying storage
+        :param path: a file to persist the filter to, not persisted if `None`
+        :param capacity: expected count of files, grown on rebuild if exceeded
+        :param error_rate: a desired false positive probability
+        :param rebuild_interval: seconds between rebuilds, never rebuilt if `None`
+        :param build: build a filter in background if it is not persisted,
+          otherwise all lookups go to the underlying storage until
+          :meth:`rebuild` is called
+        """
+        self._storage = storage
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.rebuild_interval = rebuild_interval
+        # lookups answered by the filter and passed to the storage
+        self.filtered = 0
+        self.passed = 0
+        # passed lookups of missing files
+        self.false_positives = 0
+
+        self._filter: Optional[BloomFilter] = None
+        # a filter being built, receives stored ids as well
+        self._building: Optional[BloomFilter] = None
+        # an open journal, its inode and length of its part added to the filter
+        self._journal_fd: Optional[int] = None
+        self._journal_ino = None
+        self._journal_offset = 0
+        self._lock = threading.Lock()
+        self._rebuild_lock = threading.Lock()
+
+        if path:
+            self._load()
+        if self._filter is None and build:
+            self._start_rebuild()
+
+    def _journal_path(self) -> str:
+        return self.path + ".journal"
+
+    def _close_journal(self):
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+
+    def _lock_journal(self, operation: int):
+        """Open the current journal and lock it, must be called under lock.
+
+        Writers append under a shared lock, a journal is replaced by
+        :meth:`_save` under an exclusive lock. When a journal is opened, e.g.
+        replaced by another writer, the filter saved with it is loaded.
+        """
+        while True:
+            if self._journal_fd is None:
+                self._journal_fd = os.open(
+                    self._journal_path(),
+                    os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC,
+                    0o644,
+                )
+                self._journal_ino = os.fstat(self._journal_fd).st_ino
+                self._journal_offset = 0
+                try:
+                    # saved with all ids of the previous journal
+                    self._filter = BloomFilter.load(self.path)
+                except FileNotFoundError:
+                    self._filter = None
+            fcntl.flock(self._journal_fd, operation)
+            try:
+                current = os.stat(self._journal_path()).st_ino == self._journal_ino
+            except FileNotFoundError:
+                current = False
+            if current:
+                return
+            self._close_journal()
+
+    def _read_journal(self):
+        """Add ids appended to the locked journal since the last read."""
+        size = os.fstat(self._journal_fd).st_size
+        if size <= self._journal_offset:
+            return
+        data = os.pread(
+            self._journal_fd, size - self._journal_offset, self._journal_offset
+        )
+        # a line being appended is read next time
+        data = data[: data.rfind(b"\n") + 1]
+        self._journal_offset += len(data)
+        for line in data.split():
+            file_id = UUID(hex=line.decode("ascii"))
+            for bloom in (self._filter, self._building):
+                if bloom is not None:
+                    bloom.add(file_id)
+
+    def _sync(self):
+        """Catch up with other writers of the journal, must be called under lock."""
+        try:
+            self._lock_journal(fcntl.LOCK_SH)
+            try:
+                self._read_journal()
+            finally:
+                fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            # ids stored by other writers may be missed, do not trust the filter
+            self.logger.warning("Cannot load filter %s: %s", self.path, str(e))
+            self._filter = None
+            self._close_journal()
+
+    def _load(self):
+        with self._lock:
+            self._sync()
+        if self._filter is not None:
+            self.logger.info("Loaded %r", self._filter)
+
+    def _save(
+        self, rebuilt: Optional[BloomFilter] = None, journal_ino: Optional[int] = None
+    ) -> bool:
+        """Persist the filter and replace the journal, must be called under lock.
+
+        :param rebuilt: a rebuilt filter to save instead
+        :param journal_ino: the journal inode when the rebuild started, the
+          rebuilt filter is dropped if another writer replaced the journal
+          since then, as ids stored meanwhile may be missing in it
+        :return: `False` if the rebuilt filter is dropped
+        """
+        if not self.path:
+            if rebuilt is not None:
+                self._filter = rebuilt
+            return True
+        try:
+            self._lock_journal(fcntl.LOCK_EX)
+            try:
+                if rebuilt is not None:
+                    if self._journal_ino != journal_ino:
+                        return False
+                    self._filter = rebuilt
+                if self._filter is not None:
+                    self._replace_journal()
+            finally:
+                if self._journal_fd is not None:
+                    fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+        except (OSError, ValueError) as e:
+            self.logger.warning("Cannot save filter %s: %s", self.path, str(e))
+        return True
+
+    def _replace_journal(self):
+        """Save the filter with ids of the locked journal and start a new one."""
+        # ids of other writers are kept
+        self._read_journal()
+        self._filter.save(self.path)
+        tmp_path = "{}.{}.tmp".format(self._journal_path(), os.getpid())
+        fd = os.open(
+            tmp_path,
+            os.O_RDWR | os.O_APPEND | os.O_CREAT | os.O_TRUNC | os.O_CLOEXEC,
+            0o644,
+        )
+        try:
+            os.replace(tmp_path, self._journal_path())
+        except OSError:
+            os.close(fd)
+            raise
+        # opened before the replace, so a later save of another writer is noticed
+        self._close_journal()
+        self._journal_fd = fd
+        self._journal_ino = os.fstat(fd).st_ino
+        self._journal_offset = 0
+
+    def _rebuild(self):
+        with self._lock:
+            if self.path:
+                # ids stored by other writers during the listing are journaled
+                self._sync()
+            count = self._filter.count if self._filter else 0
+            building = BloomFilter(max(self.capacity, 2 * count), self.error_rate)
+            self._building = building
+            journal_ino = self._journal_ino
+        try:
+            for file_hex in self._storage.list():
+                building.add(UUID(hex=file_hex))
+        except BaseException:
+            with self._lock:
+                self._building = None
+            raise
+        # installed in the same critical section, so no id stored meanwhile
+        # is added only to the replaced filter
+        with self._lock:
+            self._building = None
+            if not self._save(building, journal_ino):
+                self.logger.info("Filter was saved by another writer, loading it")
+                self._sync()
+                return
+        self.logger.info("Rebuilt %r", building)
+
+    def rebuild(self):
+        """Build a new filter from a listing of the underlying storage."""
+        with self._rebuild_lock:
+            self._rebuild()
+
+    def _rebuild_background(self):
+        try:
+            self._rebuild()
+        except (StorageError, OSError, ValueError) as e:  # pragma: no cover
+            self.logger.warning("Cannot rebuild filter: %s", str(e))
+        finally:
+            self._rebuild_lock.release()
+
+    def _start_rebuild(self):
+        # at most one rebuild at a time, the thread releases the lock
+        # pylint: disable=consider-using-with
+        if not self._rebuild_lock.acquire(blocking=False):
+            return
+        threading.Thread(
+            target=self._rebuild_background, name="BloomStorage", daemon=True
+        ).start()
+
+    def _may_contain(self, file_id: UUID) -> bool:
+        bloom = self._filter
+        if bloom is None:
+            return True
+        stale = self.rebuild_interval is not None
+        stale = stale and time.time() - bloom.built_at > self.rebuild_interval
+        if stale:
+            self._start_rebuild()
+        if file_id in bloom or not self.path:
+            return file_id in bloom
+        # may be stored by another writer
+        with self._lock:
+            self._sync()
+            bloom = self._filter
+        return bloom is None or file_id in bloom
+
+    def _add_false_positive(self):
+        with self._lock:
+            # lookups are passed without a filter as well
+            if self._filter is not None:
+                self.false_positives += 1
+
+    def _lookup(self, file_id: UUID, fn: Callable[[], R]) -> R:
+        if not self._may_contain(file_id):
+            with self._lock:
+                self.filtered += 1
+            raise StorageNotFoundError("File {} does not exist".format(file_id))
+        with self._lock:
+            self.passed += 1
+        try:
+            return fn()
+        except StorageNotFoundError:
+            self._add_false_positive()
+            raise
+
+    def false_positive_rate(self) -> float:
+        """Estimate a false positive probability of the current filter.
+
+        :return: a probability, `1` if the filter is not built yet
+        """
+        bloom = self._filter
+        return bloom.false_positive_rate() if bloom else 1.0
+
+    def observed_false_positive_rate(self) -> float:
+        """Share of lookups of missing files that were passed to the storage."""
+        with self._lock:
+            misses = self.false_positives + self.filtered
+            return self.false_positives / misses if misses else 0.0
+
+    def close(self):
+        """Persist the filter and close the journal."""
+        with self._lock:
+            self._save()
+            self._close_journal()
+
+    def is_local(self) -> bool:
+        return self._storage.is_local()
+
+    def get(self, file_id: UUID) -> bytes:
+        return self._lookup(file_id, lambda: self._storage.get(file_id))
+
+    def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
+        return self._storage.get_path(file_id, params)
+
+    def exists(self, file_id: UUID) -> bool:
+        if not self._may_contain(file_id):
+            with self._lock:
+                self.filtered += 1
+            return False
+        with self._lock:
+            self.passed += 1
+        exists = self._storage.exists(file_id)
+        if not exists:
+            self._add_false_positive()
+        return exists
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        return self._lookup(file_id, lambda: self._storage.get_mimetype(file_id))
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        return self._lookup(
+            file_id, lambda: self._storage.stat(file_id, with_tags=with_tags)
+        )
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        return self._lookup(file_id, lambda: self._storage.get_checksum(file_id))
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        return self._lookup(file_id, lambda: self._storage.open_file(file_id))
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        return self._lookup(file_id, lambda: self._storage.read_head(file_id, size))
+
+    def store(
+        self,
+        content: bytes,
+        content_type: Optional[str] = None,
+        tags: Optional[dict] = None,
+        override_id: Optional[UUID] = None,
+        cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> UUID:
+        file_id = self._storage.store(
+            content,
+            content_type=content_type,
+            tags=tags,
+            override_id=override_id,
+            cache_control=cache_control,
+            ttl=ttl,
+        )
+        self._add(file_id)
+        return file_id
+
+    def _add(self, file_id: UUID):
+        with self._lock:
+            for bloom in (self._filter, self._building):
+                if bloom is not None:
+                    bloom.add(file_id)
+            if not self.path:
+                return
+            try:
+                # journaled while building as well for other writers
+                self._lock_journal(fcntl.LOCK_SH)
+                try:
+                    # a line is appended by one write
+                    os.write(self._journal_fd, (file_id.hex + "\n").encode("ascii"))
+                finally:
+                    fcntl.flock(self._journal_fd, fcntl.LOCK_UN)
+            except (OSError, ValueError) as e:
+                self.logger.warning("Cannot write filter journal: %s", str(e))
+                self._filter = None
+                self._close_journal()
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file by the underlying storage, e.g. server-side."""
+        local = destination is None or destination is self
+        copied_id = self._lookup(
+            src_id,
+            lambda: self._storage.copy(
+                src_id,
+                dst_id,
+                tags,
+                cache_control,
+                destination=self._storage if local else destination,
+            ),
+        )
+        if local:
+            self._add(copied_id)
+        return copied_id
+
+    def delete(self, file_id: UUID, silent: bool = False):
+        # deleted ids are dropped from the filter on rebuild
+        self._storage.delete(file_id, silent)
+
+    def prefetch(self, file_ids: Iterable[UUID], priority: int = 0):
+        self._storage.prefetch(
+            [file_id for file_id in file_ids if self._may_contain(file_id)], priority
+        )
+
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        self._storage.delete_many(file_ids, workers)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        return self._storage.purge_expired(now)
+
+    def usage(self) -> Usage:
+        return self._storage.usage()
+
+    def flush_usage(self):
+        self._storage.flush_usage()
+
+    def count(self) -> int:
+        return self._storage.count()
+
+    def list(self) -> Iterable[str]:
+        return self._storage.list()
+
+    def clean(self):
+        self._storage.clean()
+        with self._lock:
+            self._filter = BloomFilter(self.capacity, self.error_rate)
+            self._save()
+
+    def __repr__(self) -> str:
+        return "BloomStorage {!r}".format(self._storage)
@@ -0,0 +1,219 @@
+from typing import Dict, Iterable, Optional, Sequence, Set
+from uuid import UUID
+
+from .singleflight import SingleFlight
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+
+
+class CoalescingStorage(Storage):  # pylint: disable=too-many-public-methods
+    """Storage wrapper sharing one in-flight read between concurrent callers.
+
+    Concurrent identical reads of a file (`get`, `get_mimetype`, `stat`, ...)
+    make one request to the underlying storage and all callers receive its
+    result or exception. If the underlying storage is a `PhotoStorage`,
+    thumbnail generation is coalesced as well, so a popular image is converted
+    once. Results are kept only while the call is in flight unless `cache_ttl`
+    is set. Writes go directly to the underlying storage and drop cached reads.
+    Deleting an image drops its cached thumbnail ids, but deleting a thumbnail
+    does not, so its id can be returned for up to `cache_ttl` seconds.
+    """
+
+    def __init__(
+        self,
+        storage: Storage,
+        cache_ttl: Optional[float] = None,
+        cache_size: int = 1024,
+    ):
+        """Construct CoalescingStorage instance.
+
+        :param storage: an underlying storage or a `PhotoStorage`
+        :param cache_ttl: seconds to cache results of reads, not cached if `None`
+        :param cache_size: maximum count of cached results
+        """
+        self._storage = storage
+        self.flight = SingleFlight(cache_ttl=cache_ttl, cache_size=cache_size)
+
+    def _forget(self, file_id: UUID):
+        for method in ("get", "get_mimetype", "exists", "get_checksum", "image_info"):
+            self.flight.forget((method, file_id))
+        for with_tags in (False, True):
+            self.flight.forget(("stat", file_id, with_tags))
+
+    def _forget_thumbnails(self, image_ids: Set[UUID]):
+        self.flight.forget_matching(
+            lambda key: key[0] in ("thumbnail", "variants") and key[1] in image_ids
+        )
+
+    def is_local(self) -> bool:
+        return self._storage.is_local()
+
+    def get(self, file_id: UUID) -> bytes:
+        return self.flight.do(("get", file_id), lambda: self._storage.get(file_id))
+
+    async def get_async(self, file_id: UUID) -> bytes:
+        """Retrieve file by file_id from asyncio without blocking the event loop."""
+        return await self.flight.do_async(
+            ("get", file_id), lambda: self._storage.get(file_id)
+        )
+
+    def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
+        return self._storage.get_path(file_id, params)
+
+    def exists(self, file_id: UUID) -> bool:
+        return self.flight.do(
+            ("exists", file_id), lambda: self._storage.exists(file_id)
+        )
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        return self.flight.do(
+            ("get_mimetype", file_id), lambda: self._storage.get_mimetype(file_id)
+        )
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        return self.flight.do(
+            ("stat", file_id, with_tags),
+            lambda: self._storage.stat(file_id, with_tags=with_tags),
+        )
+
+    async def stat_async(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        """Retrieve file metadata from asyncio without blocking the event loop."""
+        return await self.flight.do_async(
+            ("stat", file_id, with_tags),
+            lambda: self._storage.stat(file_id, with_tags=with_tags),
+        )
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        return self.flight.do(
+            ("get_checksum", file_id), lambda: self._storage.get_checksum(file_id)
+        )
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        # a handle cannot be shared
+        return self._storage.open_file(file_id)
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        return self._storage.read_head(file_id, size)
+
+    def get_image_info(self, file_id: UUID):
+        """See :meth:`PhotoStorage.get_image_info`."""
+        return self.flight.do(
+            ("image_info", file_id), lambda: self._storage.get_image_info(file_id)
+        )
+
+    def generate_thumbnail(self, image_id: UUID, mime_type: str, **kwargs) -> UUID:
+        """See :meth:`PhotoStorage.generate_thumbnail`.
+
+        Concurrent calls with the same arguments return the same thumbnail.
+        """
+        return self.flight.do(
+            ("thumbnail", image_id, mime_type, tuple(sorted(kwargs.items()))),
+            lambda: self._storage.generate_thumbnail(image_id, mime_type, **kwargs),
+        )
+
+    async def generate_thumbnail_async(
+        self, image_id: UUID, mime_type: str, **kwargs
+    ) -> UUID:
+        """See :meth:`generate_thumbnail`, runs in the default executor."""
+        return await self.flight.do_async(
+            ("thumbnail", image_id, mime_type, tuple(sorted(kwargs.items()))),
+            lambda: self._storage.generate_thumbnail(image_id, mime_type, **kwargs),
+        )
+
+    def generate_thumbnail_variants(
+        self, image_id: UUID, mime_types: Sequence[str], **kwargs
+    ) -> Dict[str, UUID]:
+        """See :meth:`PhotoStorage.generate_thumbnail_variants`."""
+        return self.flight.do(
+            ("variants", image_id, tuple(mime_types), tuple(sorted(kwargs.items()))),
+            lambda: self._storage.generate_thumbnail_variants(
+                image_id, mime_types, **kwargs
+            ),
+        )
+
+    def store(
+        self,
+        content: bytes,
+        content_type: Optional[str] = None,
+        tags: Optional[dict] = None,
+        override_id: Optional[UUID] = None,
+        cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> UUID:
+        file_id = self._storage.store(
+            content,
+            content_type=content_type,
+            tags=tags,
+            override_id=override_id,
+            cache_control=cache_control,
+            ttl=ttl,
+        )
+        self._forget(file_id)
+        return file_id
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file by the underlying storage, e.g. server-side."""
+        destination = self if destination is None else destination
+        target = destination
+        if isinstance(destination, CoalescingStorage):
+            # pylint: disable=protected-access
+            target = destination._storage
+        copied_id = self._storage.copy(
+            src_id, dst_id, tags, cache_control, destination=target
+        )
+        if isinstance(destination, CoalescingStorage):
+            # pylint: disable=protected-access
+            destination._forget(copied_id)
+        return copied_id
+
+    def delete(self, file_id: UUID, silent: bool = False):
+        try:
+            self._storage.delete(file_id, silent)
+        finally:
+            self._forget(file_id)
+            self._forget_thumbnails({file_id})
+
+    def prefetch(self, file_ids: Iterable[UUID], priority: int = 0):
+        self._storage.prefetch(file_ids, priority)
+
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        file_ids = list(file_ids)
+        try:
+            self._storage.delete_many(file_ids, workers)
+        finally:
+            for file_id in file_ids:
+                self._forget(file_id)
+            self._forget_thumbnails(set(file_ids))
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        purged = self._storage.purge_expired(now)
+        if purged:
+            # purged ids are not known
+            self.flight.clear()
+        return purged
+
+    def usage(self) -> Usage:
+        return self._storage.usage()
+
+    def flush_usage(self):
+        self._storage.flush_usage()
+
+    def count(self) -> int:
+        return self._storage.count()
+
+    def list(self) -> Iterable[str]:
+        return self._storage.list()
+
+    def clean(self):
+        self._storage.clean()
+        self.flight.clear()
+
+    def __repr__(self) -> str:
+        return "CoalescingStorage {!r}".format(self._storage)
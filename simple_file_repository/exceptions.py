@@ -6,9 +6,17 @@ class StorageNotFoundError(StorageError):
     """File is not found."""
 
 
+class StorageExistsError(StorageError):
+    """File with the id is already stored."""
+
+
 class StorageNotInitializedError(StorageError):
     """Storage is not properly initiailized."""
 
 
 class PhotoStorageNotFoundError(StorageError):
     """Photo storage is not registered in :class:`~simple_file_repository.PhotoStorages`."""
+
+
+class StorageThrottledError(StorageError):
+    """Request is rejected by a client-side concurrency limiter."""
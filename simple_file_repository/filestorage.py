@@ -1,20 +1,118 @@
-import glob
+import calendar
+import collections
+import contextlib
+import errno
+import fcntl
+import json
 import logging
 import os
+import secrets
 import shutil
-import tempfile
-from typing import Iterable, Optional
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
 from uuid import UUID, uuid4
 
-from .exceptions import StorageError, StorageNotFoundError, StorageNotInitializedError
-from .storage import Storage
-from .utils import guess_mime_type
+from .exceptions import (
+    StorageError,
+    StorageExistsError,
+    StorageNotFoundError,
+    StorageNotInitializedError,
+)
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+from .utils import bounded_map, expiry_bucket, guess_mime_type, new_hasher
 
 
 class DefaultParams:
     """Default parameters"""
 
     STRIPES = 1000
+    WALK_WORKERS = 8
+    MIME_CACHE_SIZE = 10000
+    MIME_PEEK_SIZE = 500
+    WRITE_CHUNK_SIZE = 1024 * 1024
+    COPY_CHUNK_SIZE = 64 * 1024 * 1024
+    # a checksum without its file is left by an interrupted store after this time
+    CHECKSUM_GRACE = 60.0
+    # a claimed expiry bucket is purged again after this time
+    EXPIRY_CLAIM_TIMEOUT = 600.0
+
+
+# ioctl of Linux sharing extents of a file with another one, see ioctl_ficlone(2)
+FICLONE = getattr(fcntl, "FICLONE", 0x40049409)
+
+# errors of os.link meaning that hard links cannot be used
+LINK_UNSUPPORTED_ERRORS = (errno.EXDEV, errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK)
+
+
+def _write_all(fd: int, data: bytes):
+    view = memoryview(data)
+    while view:
+        written = os.write(fd, view)
+        view = view[written:]
+
+
+def _reflink(src_fd: int, dst_fd: int) -> bool:
+    if not sys.platform.startswith("linux"):
+        return False
+    try:
+        fcntl.ioctl(dst_fd, FICLONE, src_fd)
+        return True
+    except OSError:
+        return False
+
+
+def _copy_file_range(src_fd: int, dst_fd: int) -> bool:
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    try:
+        while True:
+            count = os.copy_file_range(src_fd, dst_fd, DefaultParams.COPY_CHUNK_SIZE)
+            if not count:
+                return True
+            copied += count
+    except OSError:
+        # not supported, e.g. between filesystems on older kernels
+        if copied:
+            raise
+        return False
+
+
+def clone_file(src_fd: int, dst_fd: int):
+    """Copy content of a file to an empty file in the cheapest way available.
+
+    Tries a reflink sharing extents of copy-on-write filesystems (`FICLONE`),
+    then an in-kernel `copy_file_range` and then a copy through user space.
+
+    :param src_fd: a file descriptor to read from its current offset
+    :param dst_fd: a file descriptor to write to
+    """
+    if _reflink(src_fd, dst_fd) or _copy_file_range(src_fd, dst_fd):
+        return
+    while True:
+        chunk = os.read(src_fd, DefaultParams.WRITE_CHUNK_SIZE)
+        if not chunk:
+            return
+        _write_all(dst_fd, chunk)
+
+
+def current_umask() -> int:
+    """Return the process umask, without changing it if `/proc` is available."""
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("Umask:"):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError):  # pragma: no cover
+        pass
+    # not thread-safe, so used only as a fallback
+    umask = os.umask(0o077)  # pragma: no cover
+    os.umask(umask)  # pragma: no cover
+    return umask  # pragma: no cover
 
 
 class FileStorage(Storage):
@@ -30,6 +128,10 @@ class FileStorage(Storage):
         initialize: bool = True,
         file_perm=0o660,
         dir_perm=0o770,
+        walk_workers: int = DefaultParams.WALK_WORKERS,
+        checksum_algorithm: Optional[str] = None,
+        track_usage: bool = False,
+        create_lazily: bool = False,
     ):
         """Constructs FileStorage instance.
 
@@ -42,6 +144,14 @@ class FileStorage(Storage):
         :param initialize: initialize immediately if `True`
         :param file_perm: permissions for created files
         :param dir_perm: permissions for created dirs
+        :param walk_workers: count of threads scanning stripes in
+          :meth:`count`, :meth:`list` and :meth:`clean`
+        :param checksum_algorithm: if set, a checksum of each stored file is
+          computed with this algorithm (e.g. `sha256`) and saved to a sidecar file
+        :param track_usage: maintain :meth:`usage` incrementally in a counter file
+          on each store and delete instead of scanning the whole database
+        :param create_lazily: create directories on first store instead of
+          on initialization, a database without them is empty
         """
         self.storage_directory = storage_directory
         self.database = database
@@ -49,6 +159,21 @@ class FileStorage(Storage):
         self.stripe_size = stripes or DefaultParams.STRIPES
         self._file_perm = file_perm
         self._dir_perm = dir_perm
+        self.walk_workers = walk_workers
+        self.checksum_algorithm = checksum_algorithm
+        if checksum_algorithm:
+            # fail early for unknown algorithms
+            new_hasher(checksum_algorithm)
+        self.track_usage = track_usage
+        self.create_lazily = create_lazily
+        self._usage_lock = threading.Lock()
+        # files are immutable, so a guessed mime type is valid until deletion
+        self._mime_cache = collections.OrderedDict()
+        self._mime_cache_lock = threading.Lock()
+        # permissions are set explicitly only if umask would drop some bits
+        self._umask = current_umask()
+        # stripe directories known to exist
+        self._created_stripes = set()
 
         if self.storage_directory and initialize:
             self.init_app()
@@ -74,12 +199,19 @@ class FileStorage(Storage):
             raise StorageError("Cannot create dirs: {}".format(str(e))) from e
 
     def _makedir(self, path):
-        if not os.path.isdir(path):
-            os.mkdir(path)
+        try:
+            os.mkdir(path, self._dir_perm)
+        except FileExistsError:
+            return
+        if self._dir_perm & self._umask:
             os.chmod(path, self._dir_perm)
 
     def _initialize_storage(self):
         self.database_directory = os.path.join(self.storage_directory, self.database)
+        if not self.create_lazily:
+            self._create_directories()
+
+    def _create_directories(self):
         self._makedir(self.storage_directory)
         self._makedir(self.database_directory)
 
@@ -88,18 +220,91 @@ class FileStorage(Storage):
         file_id = uuid4()
         return file_id
 
-    def _check_init(self):
-        if not self.database_directory or not os.path.isdir(self.database_directory):
+    def _check_init(self) -> bool:
+        """Check that storage is initialized.
+
+        :return: `False` if directories are not created lazily yet
+        """
+        if self.database_directory and os.path.isdir(self.database_directory):
+            return True
+        if self.database_directory and self.create_lazily:
+            return False
+        raise StorageNotInitializedError("Storage is not initialized")
+
+    def _check_configured(self):
+        # a cheap check for hot paths, a missing directory is detected on access
+        if not self.database_directory:
             raise StorageNotInitializedError("Storage is not initialized")
 
     def _select_stripe(self, file_id: UUID) -> str:
         stripe_name = "stripe_{}".format(file_id.int % self.stripe_size)
         return os.path.join(self.database_directory, stripe_name)
 
-    def _select_or_create_stripe(self, file_id: UUID) -> str:
-        stripe_directory = self._select_stripe(file_id)
-        self._makedir(stripe_directory)
-        return stripe_directory
+    def _create_stripe(self, stripe_dir: str):
+        try:
+            self._makedir(stripe_dir)
+        except FileNotFoundError as e:
+            if not self.create_lazily:
+                raise StorageNotInitializedError("Storage is not initialized") from e
+            self._create_directories()
+            self._makedir(stripe_dir)
+        self._created_stripes.add(stripe_dir)
+
+    def _create_temp(
+        self, file_id: UUID, stripe_dir: str, suffix: str = ".tmp"
+    ) -> Tuple[str, int]:
+        """Create a temporary file in a stripe directory.
+
+        The file is created next to its target, so it is published without
+        copying. Names start with a dot and are not listed as stored files.
+
+        :return: a path and an open file descriptor
+        """
+        tmp_path = os.path.join(
+            stripe_dir, ".{}.{}{}".format(file_id.hex, secrets.token_hex(4), suffix)
+        )
+        flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_CLOEXEC
+        if stripe_dir not in self._created_stripes:
+            self._create_stripe(stripe_dir)
+        try:
+            fd = os.open(tmp_path, flags, self._file_perm)
+        except FileNotFoundError:
+            # stripe was removed since it was created
+            self._created_stripes.discard(stripe_dir)
+            self._create_stripe(stripe_dir)
+            fd = os.open(tmp_path, flags, self._file_perm)
+        if self._file_perm & self._umask:
+            os.fchmod(fd, self._file_perm)
+        return tmp_path, fd
+
+    @staticmethod
+    def _link(tmp_path: str, path: str, temporary: bool = True) -> bool:
+        """Publish a file under a path unless the path exists.
+
+        :param temporary: the file is temporary and may be renamed
+          if the filesystem does not support hard links
+        :return: `False` if the path exists
+        """
+        try:
+            os.link(tmp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        except OSError as e:  # pragma: no cover
+            if not temporary or e.errno not in (errno.EPERM, errno.EOPNOTSUPP):
+                raise
+        # filesystem without hard links, publish racily
+        if os.path.exists(path):  # pragma: no cover
+            return False
+        os.rename(tmp_path, path)  # pragma: no cover
+        return True  # pragma: no cover
+
+    @staticmethod
+    def _unlink_quietly(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
 
     def is_local(self) -> bool:
         return True
@@ -107,12 +312,12 @@ class FileStorage(Storage):
     def get(self, file_id: UUID) -> bytes:
         stripe_dir = self._select_stripe(file_id)
         blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
-        if not os.path.isfile(blob_path):
-            raise StorageNotFoundError("File {} does not exist".format(file_id))
         try:
             with open(blob_path, "rb") as f:
                 content = f.read()
             return content
+        except FileNotFoundError as e:
+            raise StorageNotFoundError("File {} does not exist".format(file_id)) from e
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
 
@@ -124,10 +329,14 @@ class FileStorage(Storage):
         return blob_path
 
     def exists(self, file_id: UUID) -> bool:
-        self._check_init()
+        self._check_configured()
         stripe_dir = self._select_stripe(file_id)
         blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
-        return os.path.isfile(blob_path)
+        if os.path.isfile(blob_path):
+            return True
+        # only a miss pays for telling a removed database directory
+        self._check_init()
+        return False
 
     def store(
         self,
@@ -136,72 +345,610 @@ class FileStorage(Storage):
         tags: Optional[dict] = None,
         override_id: Optional[UUID] = None,
         cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
     ) -> UUID:
         # early check
-        self._check_init()
+        self._check_configured()
         file_id = override_id if override_id else self._generate_file_id()
         try:
-            # detect target path
-            stripe_dir = self._select_or_create_stripe(file_id)
-            blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
-            if os.path.isfile(blob_path):
-                raise StorageError("File {} already stored".format(file_id))
-
-            # open a temporary file
-            tmp_fd, tmp_path = tempfile.mkstemp(prefix="sfr-", suffix=".tmp")
+            stripe_dir = self._select_stripe(file_id)
+            tmp_path, tmp_fd = self._create_temp(file_id, stripe_dir)
             try:
-                os.write(tmp_fd, content)
-                os.close(tmp_fd)
-            except Exception as e:  # pragma: no cover
-                # remove tmp file
-                os.unlink(tmp_path)
-                raise StorageError(e) from e
-            # move to target path
-            shutil.move(tmp_path, blob_path)
-            os.chmod(blob_path, self._file_perm)
+                try:
+                    checksum = self._write_content(tmp_fd, content)
+                finally:
+                    os.close(tmp_fd)
+                with self._usage_change() as update_usage:
+                    self._publish(tmp_path, file_id, stripe_dir, checksum)
+                    update_usage(len(content), 1)
+            finally:
+                self._unlink_quietly(tmp_path)
+            if ttl is not None:
+                # recorded once published, so a failed store touches no index
+                self._expire_or_delete(file_id, stripe_dir, ttl)
             return file_id
         except StorageError:
             raise
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
 
+    def _publish(
+        self,
+        tmp_path: str,
+        file_id: UUID,
+        stripe_dir: str,
+        checksum: Optional[str],
+        temporary: bool = True,
+    ):
+        """Make a written file visible as a stored file."""
+        blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
+        if checksum:
+            # checksum must exist once the file becomes visible
+            self._store_checksum(file_id, stripe_dir, checksum, blob_path)
+        # a link fails instead of replacing an existing file
+        if not self._link(tmp_path, blob_path, temporary):
+            if checksum:
+                # no checksum was recorded for the existing file
+                self._unlink_quietly(os.path.join(stripe_dir, file_id.hex + ".sum"))
+            raise StorageExistsError("File {} already stored".format(file_id))
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file without reading it into memory.
+
+        Stored files are never modified, so a copy is a hard link to the
+        source if both storages are on one filesystem and use the same
+        permissions. Otherwise the copy is a reflink, a `copy_file_range` or
+        a streamed copy, whatever the filesystem supports. Tags and cache
+        control are not supported by `FileStorage` and ignored.
+        """
+        destination = destination if destination is not None else self
+        if not isinstance(destination, FileStorage):
+            return super().copy(src_id, dst_id, tags, cache_control, destination)
+        # raises if source does not exist
+        checksum = self.get_checksum(src_id)
+        src_path = os.path.join(self._select_stripe(src_id), src_id.hex + ".bin")
+        dst_id = dst_id if dst_id else self._generate_file_id()
+        # pylint: disable=protected-access
+        destination._check_configured()
+        try:
+            checksum = destination._copied_checksum(src_path, checksum)
+            destination._copy_from(
+                src_path, dst_id, checksum, destination._file_perm == self._file_perm
+            )
+        except StorageError:
+            raise
+        except FileNotFoundError as e:
+            # deleted concurrently
+            raise StorageNotFoundError("File {} does not exist".format(src_id)) from e
+        except Exception as e:  # pragma: no cover
+            raise StorageError(e) from e
+        return dst_id
+
+    def _copied_checksum(self, src_path: str, checksum: Optional[str]) -> Optional[str]:
+        """Return a checksum of a copied file in `checksum_algorithm`.
+
+        The source checksum is reused if it has the same algorithm,
+        otherwise the file is hashed.
+        """
+        if not self.checksum_algorithm:
+            return None
+        if checksum and checksum.split(":", 1)[0] == self.checksum_algorithm:
+            return checksum
+        hasher = new_hasher(self.checksum_algorithm)
+        with open(src_path, "rb") as src:
+            for chunk in iter(lambda: src.read(DefaultParams.WRITE_CHUNK_SIZE), b""):
+                hasher.update(chunk)
+        return "{}:{}".format(self.checksum_algorithm, hasher.hexdigest())
+
+    def _copy_from(
+        self, src_path: str, file_id: UUID, checksum: Optional[str], link: bool
+    ):
+        stripe_dir = self._select_stripe(file_id)
+        if stripe_dir not in self._created_stripes:
+            self._create_stripe(stripe_dir)
+        size = os.stat(src_path).st_size if self.track_usage else 0
+        if link:
+            try:
+                with self._usage_change() as update_usage:
+                    self._publish(src_path, file_id, stripe_dir, checksum, False)
+                    update_usage(size, 1)
+                return
+            except OSError as e:
+                if e.errno not in LINK_UNSUPPORTED_ERRORS:
+                    raise
+        tmp_path, tmp_fd = self._create_temp(file_id, stripe_dir)
+        try:
+            try:
+                with open(src_path, "rb") as src:
+                    clone_file(src.fileno(), tmp_fd)
+            finally:
+                os.close(tmp_fd)
+            with self._usage_change() as update_usage:
+                self._publish(tmp_path, file_id, stripe_dir, checksum)
+                update_usage(size, 1)
+        finally:
+            self._unlink_quietly(tmp_path)
+
+    def _store_checksum(
+        self, file_id: UUID, stripe_dir: str, checksum: str, blob_path: str
+    ):
+        checksum_path = os.path.join(stripe_dir, file_id.hex + ".sum")
+        tmp_path, tmp_fd = self._create_temp(file_id, stripe_dir, ".sum.tmp")
+        try:
+            try:
+                os.write(tmp_fd, checksum.encode("ascii"))
+            finally:
+                os.close(tmp_fd)
+            if not self._link(tmp_path, checksum_path):
+                if os.path.exists(blob_path):
+                    raise StorageExistsError("File {} already stored".format(file_id))
+                try:
+                    age = time.time() - os.stat(checksum_path).st_mtime
+                except FileNotFoundError:
+                    age = None
+                if age is not None and age < DefaultParams.CHECKSUM_GRACE:
+                    # a concurrent store is about to publish its file
+                    raise StorageError("File {} is being stored".format(file_id))
+                # left by an interrupted store
+                os.replace(tmp_path, checksum_path)
+        finally:
+            self._unlink_quietly(tmp_path)
+
+    def _write_content(self, fd: int, content: bytes) -> Optional[str]:
+        """Write content to a file descriptor computing a checksum on the way."""
+        hasher = (
+            new_hasher(self.checksum_algorithm) if self.checksum_algorithm else None
+        )
+        view = memoryview(content)
+        offset = 0
+        while offset < len(view):
+            end = offset + DefaultParams.WRITE_CHUNK_SIZE
+            chunk = view[offset:end]
+            written = os.write(fd, chunk)
+            if hasher:
+                hasher.update(chunk[:written])
+            offset += written
+        if hasher:
+            return "{}:{}".format(self.checksum_algorithm, hasher.hexdigest())
+        return None
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        stripe_dir = self._select_stripe(file_id)
+        try:
+            with open(
+                os.path.join(stripe_dir, file_id.hex + ".sum"), "r", encoding="ascii"
+            ) as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            if not os.path.isfile(os.path.join(stripe_dir, file_id.hex + ".bin")):
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("File {} does not exist".format(file_id))
+            return None
+        except Exception as e:  # pragma: no cover
+            raise StorageError(e) from e
+
     def delete(self, file_id: UUID, silent: bool = False):
         stripe_dir = self._select_stripe(file_id)
         blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
-        if not silent and not os.path.isfile(blob_path):
-            raise StorageNotFoundError("File {} does not exist".format(file_id))
+        self._forget_mimetype(file_id)
         try:
-            os.unlink(blob_path)
-        except FileNotFoundError:
+            with self._usage_change() as update_usage:
+                size = os.stat(blob_path).st_size if self.track_usage else 0
+                os.unlink(blob_path)
+                update_usage(size, -1)
+        except FileNotFoundError as e:
             if not silent:
-                raise
+                raise StorageNotFoundError(
+                    "File {} does not exist".format(file_id)
+                ) from e
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
+        if self.checksum_algorithm:
+            self._unlink_quietly(os.path.join(stripe_dir, file_id.hex + ".sum"))
+        # an entry left in the expiry bucket is skipped by a purge
+        self._unlink_quietly(os.path.join(stripe_dir, file_id.hex + ".exp"))
 
-    def get_mimetype(self, file_id: UUID) -> str:
+    def _expiry_directory(self) -> str:
+        return os.path.join(self.database_directory, ".expiry")
+
+    def _expire_or_delete(self, file_id: UUID, stripe_dir: str, ttl: float):
+        """Index a published file for expiry, delete it if that fails."""
         try:
-            with open(self.get_path(file_id), "rb") as f:
-                peek = f.read()[0:500]
-                return guess_mime_type(peek)
+            self._record_expiry(file_id, stripe_dir, ttl)
+        except BaseException:
+            self.delete(file_id, silent=True)
+            raise
+
+    def _record_expiry(self, file_id: UUID, stripe_dir: str, ttl: float):
+        """Record an expiry bucket of a file and append its id to the bucket file.
+
+        The bucket is saved to a sidecar file with the inode and mtime of the
+        file, a purge deletes only the very file whose sidecar names the
+        purged bucket. So an entry of a deleted file does not purge a file
+        stored again under the same id. The sidecar is removed with the file.
+
+        A line is written by one `write` to a file opened with `O_APPEND`,
+        so lines of concurrent writers do not interleave.
+        """
+        bucket = expiry_bucket(ttl)
+        stat_result = os.stat(os.path.join(stripe_dir, file_id.hex + ".bin"))
+        tmp_path, tmp_fd = self._create_temp(file_id, stripe_dir, ".exp.tmp")
+        try:
+            try:
+                os.write(
+                    tmp_fd,
+                    "{} {} {}".format(
+                        bucket, stat_result.st_ino, stat_result.st_mtime_ns
+                    ).encode("ascii"),
+                )
+            finally:
+                os.close(tmp_fd)
+            os.replace(tmp_path, os.path.join(stripe_dir, file_id.hex + ".exp"))
+        finally:
+            self._unlink_quietly(tmp_path)
+        path = os.path.join(self._expiry_directory(), bucket)
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT | os.O_CLOEXEC
+        try:
+            fd = os.open(path, flags, self._file_perm)
+        except FileNotFoundError:
+            self._makedir(self._expiry_directory())
+            fd = os.open(path, flags, self._file_perm)
+        try:
+            os.write(fd, (file_id.hex + "\n").encode("ascii"))
+        finally:
+            os.close(fd)
+
+    def _claim_bucket(self, name: str, current: str) -> Optional[str]:
+        """Rename an expired bucket file, so other purges skip it.
+
+        :param current: a name of the current hour bucket
+        :return: a path of the claimed file or `None`
+        """
+        path = os.path.join(self._expiry_directory(), name)
+        bucket = name.split(".")[0]
+        if not bucket.isdigit() or bucket >= current:
+            return None
+        if name != bucket:
+            # claimed by a purge that may have crashed
+            try:
+                claimed_at = os.stat(path).st_mtime
+            except FileNotFoundError:
+                return None
+            if time.time() - claimed_at < DefaultParams.EXPIRY_CLAIM_TIMEOUT:
+                return None
+        claimed_path = os.path.join(
+            self._expiry_directory(),
+            "{}.{}.purging".format(bucket, secrets.token_hex(4)),
+        )
+        try:
+            os.rename(path, claimed_path)
+            os.utime(claimed_path)
+        except FileNotFoundError:
+            # claimed by another purge
+            return None
+        return claimed_path
+
+    def _expires_in(self, file_id: UUID, bucket: str) -> bool:
+        """Tell if a file is stored with a TTL recorded in an expiry bucket.
+
+        A sidecar of this bucket left by a deleted file is removed.
+        """
+        stripe_dir = self._select_stripe(file_id)
+        sidecar_path = os.path.join(stripe_dir, file_id.hex + ".exp")
+        try:
+            with open(sidecar_path, "r", encoding="ascii") as f:
+                fields = f.read().split()
+        except FileNotFoundError:
+            return False
+        if not fields or fields[0] != bucket:
+            # stored again with another TTL
+            return False
+        try:
+            stat_result = os.stat(os.path.join(stripe_dir, file_id.hex + ".bin"))
+            identity = [str(stat_result.st_ino), str(stat_result.st_mtime_ns)]
+        except FileNotFoundError:
+            identity = None
+        if fields[1:] == identity:
+            return True
+        # deleted, possibly stored again without a TTL
+        self._unlink_quietly(sidecar_path)
+        return False
+
+    def _remaining_ttl(self, file_id: UUID) -> Optional[float]:
+        """Return a TTL that puts a copy of a file to its expiry bucket.
+
+        :return: seconds until the bucket starts, `None` if stored without a TTL
+        """
+        sidecar_path = os.path.join(self._select_stripe(file_id), file_id.hex + ".exp")
+        try:
+            with open(sidecar_path, "r", encoding="ascii") as f:
+                bucket = f.read().split()[0]
+        except (FileNotFoundError, IndexError):
+            return None
+        if not self._expires_in(file_id, bucket):
+            return None
+        expires_at = calendar.timegm(time.strptime(bucket, "%Y%m%d%H"))
+        return max(0.0, expires_at - time.time())
+
+    def _purge_bucket(self, path: str) -> int:
+        bucket = os.path.basename(path).split(".")[0]
+        file_ids = []
+        try:
+            with open(path, "r", encoding="ascii") as f:
+                for line in f:
+                    try:
+                        file_id = UUID(hex=line.strip())
+                    except ValueError:
+                        # a torn write of a crashed store
+                        self.logger.warning("Invalid expiry entry %r", line)
+                        continue
+                    if self._expires_in(file_id, bucket):
+                        file_ids.append(file_id)
+        except FileNotFoundError:
+            # reclaimed by another purge after a timeout
+            return 0
+        # sidecars are removed with files
+        self.delete_many(file_ids)
+        self._unlink_quietly(path)
+        return len(file_ids)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        if not self._check_init():
+            return 0
+        current = expiry_bucket(0, now)
+        try:
+            with os.scandir(self._expiry_directory()) as it:
+                names = sorted(entry.name for entry in it)
+        except FileNotFoundError:
+            return 0
+        purged = 0
+        try:
+            for name in names:
+                claimed_path = self._claim_bucket(name, current)
+                if claimed_path:
+                    purged += self._purge_bucket(claimed_path)
         except StorageError:
             raise
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
+        self.logger.info("Purged %d expired files", purged)
+        return purged
+
+    def _forget_mimetype(self, file_id: UUID):
+        with self._mime_cache_lock:
+            self._mime_cache.pop(file_id, None)
+
+    def _cached_mimetype(self, file_id: UUID, blob_path: str) -> str:
+        with self._mime_cache_lock:
+            mime_type = self._mime_cache.get(file_id)
+            if mime_type is not None:
+                self._mime_cache.move_to_end(file_id)
+                return mime_type
+        with open(blob_path, "rb") as f:
+            mime_type = guess_mime_type(f.read(DefaultParams.MIME_PEEK_SIZE))
+        with self._mime_cache_lock:
+            self._mime_cache[file_id] = mime_type
+            if len(self._mime_cache) > DefaultParams.MIME_CACHE_SIZE:
+                self._mime_cache.popitem(last=False)
+        return mime_type
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        stripe_dir = self._select_stripe(file_id)
+        blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
+        try:
+            stat_result = os.stat(blob_path)
+            return FileStat(
+                file_id,
+                size=stat_result.st_size,
+                content_type=self._cached_mimetype(file_id, blob_path),
+                mtime=stat_result.st_mtime,
+            )
+        except FileNotFoundError as e:
+            raise StorageNotFoundError("File {} does not exist".format(file_id)) from e
+        except Exception as e:  # pragma: no cover
+            raise StorageError(e) from e
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        return self.stat(file_id).content_type
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        stripe_dir = self._select_stripe(file_id)
+        blob_path = os.path.join(stripe_dir, file_id.hex + ".bin")
+        try:
+            # pylint: disable=consider-using-with
+            f = open(blob_path, "rb")
+        except FileNotFoundError as e:
+            raise StorageNotFoundError("File {} does not exist".format(file_id)) from e
+        except Exception as e:  # pragma: no cover
+            raise StorageError(e) from e
+        try:
+            size = os.fstat(f.fileno()).st_size
+            content_type = self._cached_mimetype(file_id, blob_path)
+            return FileHandle(f, size, content_type, path=blob_path)
+        except Exception as e:  # pragma: no cover
+            f.close()
+            raise StorageError(e) from e
+
+    def _list_stripes(self) -> List[str]:
+        with os.scandir(self.database_directory) as it:
+            return sorted(
+                entry.path
+                for entry in it
+                if entry.name.startswith("stripe_") and entry.is_dir()
+            )
+
+    @staticmethod
+    def _scan_stripe(stripe_dir: str) -> List[str]:
+        try:
+            with os.scandir(stripe_dir) as it:
+                return sorted(
+                    entry.name[0:-4] for entry in it if entry.name.endswith(".bin")
+                )
+        except FileNotFoundError:
+            return []
+
+    @staticmethod
+    def _count_stripe(stripe_dir: str) -> int:
+        count = 0
+        try:
+            with os.scandir(stripe_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".bin"):
+                        count += 1
+        except FileNotFoundError:
+            pass
+        return count
 
     def count(self) -> int:
-        self._check_init()
+        if not self._check_init():
+            return 0
         try:
-            return len(glob.glob(self.database_directory + "/*/*.bin"))
+            stripes = self._list_stripes()
+            with ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+                return sum(executor.map(self._count_stripe, stripes))
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
 
+    def _walk(self, stripes: List[str]) -> Iterable[str]:
+        with ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+            for file_hexes in bounded_map(
+                executor, self._scan_stripe, stripes, self.walk_workers * 2
+            ):
+                yield from file_hexes
+
     def list(self) -> Iterable[str]:
-        self._check_init()
+        if not self._check_init():
+            return []
+        try:
+            return self._walk(self._list_stripes())
+        except Exception as e:  # pragma: no cover
+            raise StorageError(e) from e
+
+    @staticmethod
+    def _scan_stripe_usage(stripe_dir: str) -> Usage:
+        usage = Usage()
+        try:
+            with os.scandir(stripe_dir) as it:
+                for entry in it:
+                    if entry.name.endswith(".bin"):
+                        try:
+                            usage.add(entry.stat().st_size)
+                        except FileNotFoundError:
+                            pass
+        except FileNotFoundError:
+            pass
+        return usage
+
+    def _scan_usage(self) -> Usage:
+        stripes = self._list_stripes()
+        with ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+            return sum(executor.map(self._scan_stripe_usage, stripes), Usage())
+
+    def _usage_path(self) -> str:
+        return os.path.join(self.database_directory, ".usage.json")
+
+    def _usage_lock_path(self) -> str:
+        return os.path.join(self.database_directory, ".usage.lock")
+
+    @contextlib.contextmanager
+    def _usage_change(self) -> Iterator[Callable[[int, int], None]]:
+        """Hold a shared lock over a change of files and its usage update.
+
+        :meth:`reconcile_usage` scans under an exclusive lock, so a change is
+        either seen by the scan or applied to its result, never both.
+
+        :return: a function updating usage by a size and a sign
+        """
+        if not self.track_usage:
+            yield lambda size, sign: None
+            return
+        try:
+            fd = os.open(
+                self._usage_lock_path(), os.O_RDWR | os.O_CREAT, self._file_perm
+            )
+        except FileNotFoundError:
+            # a lazy database is not created, so neither scanned nor counted
+            yield lambda size, sign: None
+            return
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            yield self._update_usage
+        finally:
+            os.close(fd)
+
+    def _update_usage(self, size: int, sign: int):
+        with self._usage_lock:
+            try:
+                fd = os.open(self._usage_path(), os.O_RDWR)
+            except FileNotFoundError:
+                # not reconciled yet, it will be done by usage()
+                return
+            try:
+                # protect from concurrent processes
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with os.fdopen(os.dup(fd), "r+", encoding="ascii") as f:
+                    try:
+                        usage = Usage.from_dict(json.load(f))
+                    except (ValueError, KeyError):
+                        # broken counter is reconciled by usage()
+                        os.unlink(self._usage_path())
+                        return
+                    usage.add(size, sign)
+                    f.seek(0)
+                    json.dump(usage.to_dict(), f)
+                    f.truncate()
+            finally:
+                os.close(fd)
+
+    def reconcile_usage(self) -> Usage:
+        """Recompute usage by a full scan and save it to the counter file.
+
+        Stores and deletes wait for the scan to finish.
+        """
+        if not self._check_init():
+            return Usage()
+        fd = os.open(self._usage_lock_path(), os.O_RDWR | os.O_CREAT, self._file_perm)
         try:
-            return (
-                path.split("/")[-1][0:-4]
-                for path in glob.glob(self.database_directory + "/*/*.bin")
+            # taken before the counter is read or replaced
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            usage = self._scan_usage()
+            tmp_path = "{}.{}.tmp".format(self._usage_path(), os.getpid())
+            tmp_fd = os.open(
+                tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, self._file_perm
             )
+            with os.fdopen(tmp_fd, "w", encoding="ascii") as f:
+                json.dump(usage.to_dict(), f)
+            os.replace(tmp_path, self._usage_path())
+            return usage
+        finally:
+            os.close(fd)
+
+    def usage(self) -> Usage:
+        """Returns object count, total size and a size histogram of storage.
+
+        If usage is tracked, reads the counter file (reconciling it once if
+        it does not exist yet), otherwise scans the whole database.
+        """
+        if not self._check_init():
+            return Usage()
+        try:
+            if not self.track_usage:
+                return self._scan_usage()
+            try:
+                with open(self._usage_path(), "r", encoding="ascii") as f:
+                    fcntl.flock(f.fileno(), fcntl.LOCK_SH)
+                    return Usage.from_dict(json.load(f))
+            except (FileNotFoundError, ValueError, KeyError):
+                return self.reconcile_usage()
+        except StorageError:
+            raise
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
 
@@ -209,10 +956,12 @@ class FileStorage(Storage):
         if not self.database_directory:
             return
         try:
-            for file in glob.glob(self.database_directory + "/*/*.bin"):
-                os.remove(file)
             if os.path.isdir(self.database_directory):
+                stripes = self._list_stripes()
+                with ThreadPoolExecutor(max_workers=self.walk_workers) as executor:
+                    list(executor.map(shutil.rmtree, stripes))
                 shutil.rmtree(self.database_directory)
+            self._created_stripes.clear()
         except Exception as e:  # pragma: no cover
             raise StorageError(e) from e
 
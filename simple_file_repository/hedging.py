@@ -0,0 +1,233 @@
+import collections
+import logging
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Deque, Dict, Optional, Tuple
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    PERCENTILE = 95.0
+    BUDGET = 0.05
+    MIN_DELAY = 0.005
+    MAX_DELAY = 1.0
+    WINDOW = 1000
+    MIN_SAMPLES = 20
+    WORKERS = 64
+
+
+class LatencyTracker:
+    """A thread-safe window of recent latencies."""
+
+    def __init__(self, window: int = DefaultParams.WINDOW):
+        self._samples: Deque[float] = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, latency: float):
+        """Record a latency in seconds."""
+        with self._lock:
+            self._samples.append(latency)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, percentile: float) -> float:
+        """Return a latency percentile of the window, `0` if it is empty."""
+        with self._lock:
+            samples = sorted(self._samples)
+        if not samples:
+            return 0.0
+        index = min(len(samples) - 1, int(len(samples) * percentile / 100))
+        return samples[index]
+
+
+class Cancelled(Exception):
+    """Raised by a request that stopped because another attempt succeeded."""
+
+
+class _Attempt:
+    """A request running on a hedger thread."""
+
+    def __init__(self):
+        self.future: Optional[Future] = None
+        self.started = threading.Event()
+        # set once another attempt has succeeded
+        self.cancelled = threading.Event()
+
+
+class Hedger:
+    """Sends a second identical request if the first one is slow.
+
+    A request is hedged if it has not completed within a percentile of recent
+    latencies of requests of the same kind. The first completed successful
+    response is returned, the other request is told to stop by an event
+    passed to it, so it can stop reading a response. Hedges are limited to
+    a `budget` share of requests.
+
+    Requests run on at most `workers` threads and never wait for a thread:
+    latencies and hedge delays are measured from the start of a request.
+    If all threads are busy, a request runs on the caller's thread without
+    hedging, and a hedge is not sent.
+    """
+
+    logger = logging.getLogger("Hedger")
+
+    _shared: Dict[Tuple, "Hedger"] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        percentile: float = DefaultParams.PERCENTILE,
+        budget: float = DefaultParams.BUDGET,
+        min_delay: float = DefaultParams.MIN_DELAY,
+        max_delay: float = DefaultParams.MAX_DELAY,
+        workers: int = DefaultParams.WORKERS,
+    ):
+        """Construct a hedger.
+
+        :param percentile: a latency percentile to wait before hedging
+        :param budget: maximum share of extra requests, e.g. `0.05` for 5%
+        :param min_delay: minimum seconds to wait before hedging
+        :param max_delay: maximum seconds to wait before hedging,
+          used until enough latencies are known
+        :param workers: count of threads making requests
+        """
+        if not 0 < percentile < 100:
+            raise ValueError("Invalid percentile " + str(percentile))
+        if not 0 <= budget <= 1:
+            raise ValueError("Invalid budget " + str(budget))
+        self.percentile = percentile
+        self.budget = budget
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.workers = workers
+        self.requests = 0
+        self.hedges_fired = 0
+        self.hedges_won = 0
+        self.inline = 0
+        self._busy = 0
+        self._trackers: Dict[str, LatencyTracker] = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="Hedger"
+        )
+
+    @classmethod
+    def shared(cls, key: str, **kwargs) -> "Hedger":
+        """Return a hedger shared by a key and parameters in this process.
+
+        Storages of one bucket share latency statistics, the budget and threads.
+
+        :param key: a key, e.g. an endpoint and a bucket
+        :param kwargs: constructor arguments
+        """
+        shared_key = (key,) + tuple(sorted(kwargs.items()))
+        with cls._shared_lock:
+            if shared_key not in cls._shared:
+                cls._shared[shared_key] = cls(**kwargs)
+            return cls._shared[shared_key]
+
+    def _tracker(self, kind: str) -> LatencyTracker:
+        with self._lock:
+            return self._trackers.setdefault(kind, LatencyTracker())
+
+    def delay(self, kind: str) -> float:
+        """Seconds to wait for a request of a kind before hedging it."""
+        tracker = self._tracker(kind)
+        if len(tracker) < DefaultParams.MIN_SAMPLES:
+            return self.max_delay
+        return min(
+            self.max_delay, max(self.min_delay, tracker.percentile(self.percentile))
+        )
+
+    def _take_budget(self) -> bool:
+        with self._lock:
+            if self.hedges_fired + 1 > self.budget * self.requests:
+                return False
+            self.hedges_fired += 1
+            return True
+
+    def _measure(
+        self, fn: Callable[[threading.Event], object], kind: str, attempt: _Attempt
+    ):
+        started = time.monotonic()
+        result = fn(attempt.cancelled)
+        if not attempt.cancelled.is_set():
+            self._tracker(kind).add(time.monotonic() - started)
+        return result
+
+    def _start(
+        self, fn: Callable[[threading.Event], object], kind: str
+    ) -> Optional[_Attempt]:
+        """Start a request on a free thread.
+
+        :return: `None` if all threads are busy
+        """
+        with self._lock:
+            if self._busy >= self.workers:
+                return None
+            self._busy += 1
+        attempt = _Attempt()
+
+        def run():
+            attempt.started.set()
+            try:
+                return self._measure(fn, kind, attempt)
+            finally:
+                with self._lock:
+                    self._busy -= 1
+
+        attempt.future = self._executor.submit(run)
+        return attempt
+
+    def call(self, fn: Callable[[threading.Event], object], kind: str = "default"):
+        """Call a function making a request, hedging it if it is slow.
+
+        :param fn: a function making an idempotent request, it is passed
+          an event set once another attempt has succeeded. It may stop then
+          by raising :class:`Cancelled`.
+        :param kind: a kind of request with its own latency statistics
+        :return: a result of the first successful call
+        """
+        with self._lock:
+            self.requests += 1
+        primary = self._start(fn, kind)
+        if primary is None:
+            with self._lock:
+                self.inline += 1
+            return self._measure(fn, kind, _Attempt())
+        primary.started.wait()
+        done, _ = wait([primary.future], timeout=self.delay(kind))
+        if done or not self._take_budget():
+            return primary.future.result()
+
+        hedge = self._start(fn, kind)
+        if hedge is None:
+            with self._lock:
+                self.hedges_fired -= 1
+            return primary.future.result()
+        attempts = {primary.future: primary, hedge.future: hedge}
+        pending = set(attempts)
+        while True:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            succeeded = [future for future in done if future.exception() is None]
+            if succeeded:
+                for other in pending:
+                    attempts[other].cancelled.set()
+                if hedge.future in succeeded and primary.future not in succeeded:
+                    with self._lock:
+                        self.hedges_won += 1
+                return succeeded[0].result()
+            if not pending:
+                return primary.future.result()
+
+    def close(self):
+        """Stop request threads."""
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __repr__(self) -> str:
+        return "Hedger requests={} fired={} won={} inline={}".format(
+            self.requests, self.hedges_fired, self.hedges_won, self.inline
+        )
@@ -0,0 +1,361 @@
+"""Pure-Python parser of image headers.
+
+Reads dimensions, EXIF orientation and format of JPEG, PNG, GIF and WebP
+images from the first bytes of a file without decoding pixels, and whether
+they carry metadata.
+"""
+
+import struct
+from typing import Dict, Optional, Tuple
+
+# enough for JPEG APP segments (EXIF is limited to 64 KiB) before SOF
+HEADER_SIZE = 64 * 1024
+
+# larger headers are read once more if the first read was not enough
+MAX_HEADER_SIZE = 1024 * 1024
+
+MIME_TYPES = {
+    "jpeg": "image/jpeg",
+    "png": "image/png",
+    "gif": "image/gif",
+    "webp": "image/webp",
+}
+
+# JPEG start of frame markers, except DHT, JPG and DAC
+_JPEG_SOF_MARKERS = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+_JPEG_PROGRESSIVE_MARKERS = {0xC2, 0xC6, 0xCA, 0xCE}
+# markers without a length
+_JPEG_STANDALONE_MARKERS = {0x01, 0xD8} | set(range(0xD0, 0xD8))
+# APP1-APP15 (EXIF, XMP, ICC, IPTC, ...) and comments, APP0 is JFIF
+_JPEG_METADATA_MARKERS = set(range(0xE1, 0xF0)) | {0xFE}
+_PNG_METADATA_CHUNKS = {b"eXIf", b"iTXt", b"tEXt", b"zTXt", b"iCCP"}
+# ICC, EXIF and XMP flags of VP8X
+_WEBP_METADATA_FLAGS = 0x20 | 0x08 | 0x04
+
+_EXIF_ORIENTATION_TAG = 0x0112
+_EXIF_THUMBNAIL_OFFSET_TAG = 0x0201
+_EXIF_THUMBNAIL_LENGTH_TAG = 0x0202
+
+
+class ImageInfo:
+    """Image properties read from a header."""
+
+    def __init__(
+        self,
+        image_format: str,
+        width: int,
+        height: int,
+        orientation: int = 1,
+        animated: bool = False,
+        progressive: bool = False,
+        exif_thumbnail: Optional[Tuple[int, int]] = None,
+        metadata: bool = False,
+    ):
+        """Construct image properties.
+
+        :param image_format: `jpeg`, `png`, `gif` or `webp`
+        :param width: stored width in pixels
+        :param height: stored height in pixels
+        :param orientation: EXIF orientation from 1 to 8, 1 is upright
+        :param animated: image has several frames
+        :param progressive: JPEG is progressive or PNG is interlaced
+        :param exif_thumbnail: offset and length of a JPEG thumbnail
+          embedded to EXIF
+        :param metadata: image has EXIF, XMP, ICC profile, comments or other
+          metadata, or it is not known as the data ends before the image does
+        """
+        self.format = image_format
+        self.width = width
+        self.height = height
+        self.orientation = orientation
+        self.animated = animated
+        self.progressive = progressive
+        self.exif_thumbnail = exif_thumbnail
+        self.metadata = metadata
+
+    @property
+    def mime_type(self) -> str:
+        """Mime type of the format."""
+        return MIME_TYPES[self.format]
+
+    @property
+    def display_size(self):
+        """Width and height after applying orientation."""
+        if self.orientation >= 5:
+            return self.height, self.width
+        return self.width, self.height
+
+    def __repr__(self) -> str:
+        return "ImageInfo {} {}x{} orientation={}".format(
+            self.format, self.width, self.height, self.orientation
+        )
+
+
+class NeedMoreData(ValueError):
+    """A header is longer than the given data."""
+
+
+def _unpack(fmt: str, data: bytes, offset: int) -> tuple:
+    try:
+        return struct.unpack_from(fmt, data, offset)
+    except struct.error as e:
+        raise NeedMoreData() from e
+
+
+def _read_ifd(exif: bytes, order: str, offset: int) -> Tuple[Dict[int, int], int]:
+    """Read scalar SHORT and LONG values of an IFD.
+
+    :return: values by tag and an offset of the next IFD
+    """
+    values = {}
+    (entries,) = struct.unpack_from(order + "H", exif, offset)
+    for index in range(entries):
+        entry_offset = offset + 2 + index * 12
+        tag, field_type, count = struct.unpack_from(order + "HHI", exif, entry_offset)
+        if count != 1:
+            continue
+        if field_type == 3:
+            (values[tag],) = struct.unpack_from(order + "H", exif, entry_offset + 8)
+        elif field_type == 4:
+            (values[tag],) = struct.unpack_from(order + "I", exif, entry_offset + 8)
+    (next_offset,) = struct.unpack_from(order + "I", exif, offset + 2 + entries * 12)
+    return values, next_offset
+
+
+def _parse_exif(exif: bytes) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """Read orientation from IFD0 and a thumbnail location from IFD1 of EXIF.
+
+    :param exif: a TIFF structure of EXIF
+    :return: orientation and an offset and length of the thumbnail in `exif`
+    """
+    orientation = 1
+    thumbnail = None
+    try:
+        if exif[:2] == b"II":
+            order = "<"
+        elif exif[:2] == b"MM":
+            order = ">"
+        else:
+            return orientation, thumbnail
+        (ifd_offset,) = struct.unpack_from(order + "I", exif, 4)
+        values, ifd_offset = _read_ifd(exif, order, ifd_offset)
+        value = values.get(_EXIF_ORIENTATION_TAG, 1)
+        orientation = value if 1 <= value <= 8 else 1
+        if ifd_offset:
+            values, _ = _read_ifd(exif, order, ifd_offset)
+            offset = values.get(_EXIF_THUMBNAIL_OFFSET_TAG)
+            length = values.get(_EXIF_THUMBNAIL_LENGTH_TAG)
+            if offset and length and offset + length <= len(exif):
+                thumbnail = (offset, length)
+    except struct.error:
+        pass
+    return orientation, thumbnail
+
+
+def _read_jpeg_marker(data: bytes, offset: int) -> Tuple[int, int]:
+    """Read a JPEG marker.
+
+    :return: a marker and an offset after it
+    """
+    (marker_prefix,) = _unpack("B", data, offset)
+    if marker_prefix != 0xFF:
+        raise ValueError("Invalid JPEG marker at {}".format(offset))
+    # skip fill bytes
+    while True:
+        offset += 1
+        (marker,) = _unpack("B", data, offset)
+        if marker != 0xFF:
+            return marker, offset + 1
+
+
+def _read_jpeg_segment(data: bytes, offset: int) -> Tuple[int, int, int]:
+    """Read a marker with a length, skipping standalone ones.
+
+    :return: a marker, an offset after it and a length of the segment,
+      `0` for a start of scan
+    """
+    while True:
+        marker, offset = _read_jpeg_marker(data, offset)
+        if marker in (0xD9, 0xDA):
+            return marker, offset, 0
+        if marker not in _JPEG_STANDALONE_MARKERS:
+            (length,) = _unpack(">H", data, offset)
+            return marker, offset, length
+
+
+def _read_jpeg_exif(
+    data: bytes, offset: int, length: int
+) -> Tuple[int, Optional[Tuple[int, int]]]:
+    """Read orientation and a thumbnail location in `data` of an APP1 segment."""
+    start = offset + 8
+    end = offset + length
+    if end > len(data):
+        raise NeedMoreData()
+    orientation, thumbnail = _parse_exif(data[start:end])
+    if thumbnail:
+        thumbnail = (start + thumbnail[0], thumbnail[1])
+    return orientation, thumbnail
+
+
+def _parse_jpeg(data: bytes) -> ImageInfo:
+    info = None
+    orientation = 1
+    thumbnail = None
+    metadata = False
+    offset = 2
+    while True:
+        try:
+            marker, offset, length = _read_jpeg_segment(data, offset)
+        except NeedMoreData:
+            if info is None:
+                raise
+            # segments between the frame header and the scan are not known
+            info.metadata = True
+            return info
+        if not length:
+            if info is None:
+                raise ValueError("No JPEG frame header")
+            info.metadata = metadata
+            return info
+        metadata = metadata or marker in _JPEG_METADATA_MARKERS
+        if marker == 0xE1 and data.startswith(b"Exif\x00\x00", offset + 2):
+            orientation, thumbnail = _read_jpeg_exif(data, offset, length)
+        elif marker in _JPEG_SOF_MARKERS and info is None:
+            height, width = _unpack(">HH", data, offset + 3)
+            info = ImageInfo(
+                "jpeg",
+                width,
+                height,
+                orientation=orientation,
+                progressive=marker in _JPEG_PROGRESSIVE_MARKERS,
+                exif_thumbnail=thumbnail,
+            )
+        offset += length
+
+
+def _parse_png(data: bytes) -> ImageInfo:
+    width, height, _, _, _, _, interlace = _unpack(">IIBBBBB", data, 16)
+    # metadata is not known until the end of the image
+    info = ImageInfo("png", width, height, progressive=interlace == 1, metadata=True)
+    offset = 8
+    while offset + 8 <= len(data):
+        length, chunk_type = struct.unpack_from(">I4s", data, offset)
+        if chunk_type == b"acTL":
+            # an animation control chunk precedes image data
+            info.animated = True
+        elif chunk_type in _PNG_METADATA_CHUNKS:
+            break
+        elif chunk_type == b"IEND":
+            info.metadata = False
+            break
+        offset += 12 + length
+    return info
+
+
+def _skip_gif_sub_blocks(data: bytes, offset: int) -> int:
+    while True:
+        (size,) = _unpack("B", data, offset)
+        offset += 1 + size
+        if size == 0:
+            return offset
+
+
+def _skip_gif_frame(data: bytes, offset: int) -> int:
+    (local_flags,) = _unpack("B", data, offset + 9)
+    offset += 10
+    if local_flags & 0x80:
+        offset += 3 * 2 ** ((local_flags & 0x07) + 1)
+    # skip LZW minimum code size and image data
+    return _skip_gif_sub_blocks(data, offset + 1)
+
+
+def _parse_gif(data: bytes) -> ImageInfo:
+    width, height, flags = _unpack("<HHB", data, 6)
+    # metadata is not known until the trailer
+    info = ImageInfo("gif", width, height, metadata=True)
+    metadata = False
+    offset = 13
+    if flags & 0x80:
+        offset += 3 * 2 ** ((flags & 0x07) + 1)
+    frames = 0
+    try:
+        while True:
+            (block,) = _unpack("B", data, offset)
+            if block == 0x21:
+                (label,) = _unpack("B", data, offset + 1)
+                if label == 0xFF and data.startswith(b"NETSCAPE2.0", offset + 3):
+                    info.animated = True
+                    break
+                # comments and application data, e.g. XMP
+                metadata = metadata or label in (0xFE, 0xFF)
+                offset = _skip_gif_sub_blocks(data, offset + 2)
+            elif block == 0x2C:
+                frames += 1
+                if frames > 1:
+                    info.animated = True
+                    break
+                offset = _skip_gif_frame(data, offset)
+            else:
+                if block == 0x3B:
+                    info.metadata = metadata
+                break
+    except NeedMoreData:
+        # frames beyond the header are not known
+        pass
+    return info
+
+
+def _parse_webp(data: bytes) -> ImageInfo:
+    (chunk_type,) = _unpack("4s", data, 12)
+    if chunk_type == b"VP8 ":
+        if data[23:26] != b"\x9d\x01\x2a":
+            raise ValueError("Invalid VP8 frame")
+        width, height = _unpack("<HH", data, 26)
+        return ImageInfo("webp", width & 0x3FFF, height & 0x3FFF)
+    if chunk_type == b"VP8L":
+        (bits,) = _unpack("<I", data, 21)
+        return ImageInfo("webp", (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1)
+    if chunk_type == b"VP8X":
+        (flags,) = _unpack("B", data, 20)
+        width = int.from_bytes(_unpack("3s", data, 24)[0], "little") + 1
+        height = int.from_bytes(_unpack("3s", data, 27)[0], "little") + 1
+        return ImageInfo(
+            "webp",
+            width,
+            height,
+            animated=bool(flags & 0x02),
+            metadata=bool(flags & _WEBP_METADATA_FLAGS),
+        )
+    raise ValueError("Unknown WebP chunk {!r}".format(chunk_type))
+
+
+def detect_format(data: bytes) -> Optional[str]:
+    """Detect an image format by a file signature.
+
+    :param data: first bytes of a file
+    :return: `jpeg`, `png`, `gif`, `webp` or `None` for other files
+    """
+    if data[:3] == b"\xff\xd8\xff":
+        return "jpeg"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "gif"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    return None
+
+
+def parse_image_info(data: bytes) -> Optional[ImageInfo]:
+    """Parse an image header.
+
+    :param data: first bytes of a file, usually :data:`HEADER_SIZE`
+    :return: image properties or `None` if format is not supported
+    :raises NeedMoreData: if the header is longer than `data`
+    :raises ValueError: if the header is broken
+    """
+    parsers = dict(jpeg=_parse_jpeg, png=_parse_png, gif=_parse_gif, webp=_parse_webp)
+    image_format = detect_format(data)
+    if image_format is None:
+        return None
+    return parsers[image_format](data)
@@ -0,0 +1,168 @@
+import logging
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+from .exceptions import StorageThrottledError
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    INITIAL_LIMIT = 32
+    MIN_LIMIT = 1
+    MAX_LIMIT = 512
+    BACKOFF_RATIO = 0.5
+    WAIT_TIMEOUT = 30.0
+
+
+class AdaptiveLimiter:
+    """A thread-safe AIMD limiter of concurrent requests.
+
+    The limit grows by one per limit of successful requests and is multiplied
+    by `backoff_ratio` when a request is throttled. Throttled requests started
+    before the last decrease do not decrease it again, so a burst of errors
+    of concurrent requests counts once.
+    """
+
+    logger = logging.getLogger("AdaptiveLimiter")
+
+    # key -> limiter and its constructor arguments
+    _shared: Dict[str, Tuple["AdaptiveLimiter", dict]] = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(
+        self,
+        initial_limit: int = DefaultParams.INITIAL_LIMIT,
+        min_limit: int = DefaultParams.MIN_LIMIT,
+        max_limit: int = DefaultParams.MAX_LIMIT,
+        backoff_ratio: float = DefaultParams.BACKOFF_RATIO,
+        wait_timeout: Optional[float] = DefaultParams.WAIT_TIMEOUT,
+    ):
+        """Construct a limiter.
+
+        :param initial_limit: initial count of concurrent requests
+        :param min_limit: minimum limit
+        :param max_limit: maximum limit
+        :param backoff_ratio: multiplier of the limit on throttling
+        :param wait_timeout: maximum seconds to wait for a free slot,
+          `0` to fail fast, `None` to wait forever
+        """
+        if not 1 <= min_limit <= initial_limit <= max_limit:
+            raise ValueError("Invalid limits")
+        if not 0 < backoff_ratio < 1:
+            raise ValueError("Invalid backoff ratio " + str(backoff_ratio))
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.backoff_ratio = backoff_ratio
+        self.wait_timeout = wait_timeout
+        self.throttled = 0
+        self.rejected = 0
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._waiting = 0
+        # incremented on each decrease
+        self._epoch = 0
+        self._cond = threading.Condition()
+
+    @classmethod
+    def shared(cls, key: str, **kwargs) -> "AdaptiveLimiter":
+        """Return a limiter shared by a key, e.g. a bucket, in this process.
+
+        :param key: a key
+        :param kwargs: constructor arguments, the same for all users of a key
+        :raises ValueError: if the limiter of the key has other arguments
+        """
+        with cls._shared_lock:
+            if key not in cls._shared:
+                cls._shared[key] = (cls(**kwargs), kwargs)
+            limiter, shared_kwargs = cls._shared[key]
+        if kwargs != shared_kwargs:
+            raise ValueError(
+                "Limiter {} is shared with other parameters {}".format(
+                    key, shared_kwargs
+                )
+            )
+        return limiter
+
+    @property
+    def limit(self) -> int:
+        """Current count of allowed concurrent requests."""
+        return int(self._limit)
+
+    @property
+    def in_flight(self) -> int:
+        """Count of running requests."""
+        return self._in_flight
+
+    @property
+    def queue_depth(self) -> int:
+        """Count of requests waiting for a free slot."""
+        return self._waiting
+
+    def acquire(self, timeout: Optional[float] = None) -> int:
+        """Wait for a free slot.
+
+        :param timeout: maximum seconds to wait, `wait_timeout` if `None`
+        :return: a token to pass to :meth:`release`
+        :raises StorageThrottledError: if no slot is free in time
+        """
+        if timeout is None:
+            timeout = self.wait_timeout
+        with self._cond:
+            self._waiting += 1
+            try:
+                acquired = self._cond.wait_for(
+                    lambda: self._in_flight < int(self._limit), timeout
+                )
+            finally:
+                self._waiting -= 1
+            if not acquired:
+                self.rejected += 1
+                raise StorageThrottledError(
+                    "Concurrency limit {} reached, {} requests queued".format(
+                        int(self._limit), self._waiting
+                    )
+                )
+            self._in_flight += 1
+            return self._epoch
+
+    def release(self, token: int, throttled: bool = False):
+        """Free a slot and adjust the limit.
+
+        :param token: a token returned by :meth:`acquire`
+        :param throttled: the request was throttled or timed out
+        """
+        with self._cond:
+            self._in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                if token == self._epoch:
+                    self._epoch += 1
+                    self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+                    self.logger.info("Throttled, limit is %d", int(self._limit))
+            else:
+                self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+            free = int(self._limit) - self._in_flight
+            if free > 0:
+                self._cond.notify(free)
+
+    def call(self, fn: Callable[[], object], is_throttled: Callable[[Exception], bool]):
+        """Call a function in a slot.
+
+        :param fn: a function making a request
+        :param is_throttled: tells if an exception raised by `fn` is a throttling
+        :return: a result of `fn`
+        """
+        token = self.acquire()
+        try:
+            result = fn()
+        except Exception as e:
+            self.release(token, throttled=is_throttled(e))
+            raise
+        self.release(token)
+        return result
+
+    def __repr__(self) -> str:
+        return "AdaptiveLimiter limit={} in_flight={} queued={}".format(
+            self.limit, self._in_flight, self._waiting
+        )
@@ -0,0 +1,222 @@
+import argparse
+import logging
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, Optional
+from uuid import UUID
+
+from .exceptions import StorageError
+from .filestorage import FileStorage
+from .s3storage import S3Storage
+from .storage import Storage
+from .utils import Checkpoint, bounded_map
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    WORKERS = 8
+    REPORT_INTERVAL = 10.0
+
+
+class MigrationStats:
+    """Counters of a migration run."""
+
+    def __init__(self):
+        self.copied = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+
+    @property
+    def elapsed(self) -> float:
+        """Seconds since migration start."""
+        return max(time.monotonic() - self.started, 1e-9)
+
+    @property
+    def objects_per_sec(self) -> float:
+        """Processed (copied or skipped) objects per second."""
+        return (self.copied + self.skipped) / self.elapsed
+
+    @property
+    def bytes_per_sec(self) -> float:
+        """Copied bytes per second."""
+        return self.bytes / self.elapsed
+
+    def __repr__(self) -> str:
+        return "copied {}, skipped {}, failed {}, {:.1f} obj/s, {:.2f} MiB/s".format(
+            self.copied,
+            self.skipped,
+            self.failed,
+            self.objects_per_sec,
+            self.bytes_per_sec / (1024 * 1024),
+        )
+
+
+class Migrator:
+    """Copies all objects of one storage to another.
+
+    Objects are copied by a pool of workers preserving file ids, mime types,
+    cache control and tags where the storages support them. A copy is made
+    by :meth:`Storage.copy` of the source, server-side between S3 storages
+    of one endpoint and by links between file storages. Expiry set with
+    `ttl` is not carried over.
+    Processed ids are recorded in a checkpoint file, so an interrupted
+    migration continues where it stopped.
+    """
+
+    logger = logging.getLogger("Migrator")
+
+    COPIED = "copied"
+    SKIPPED = "skipped"
+    FAILED = "failed"
+
+    def __init__(
+        self,
+        source: Storage,
+        destination: Storage,
+        workers: int = DefaultParams.WORKERS,
+        checkpoint_path: Optional[str] = None,
+        skip_existing: bool = True,
+        report_interval: float = DefaultParams.REPORT_INTERVAL,
+    ):
+        """Construct a migrator.
+
+        :param source: a storage to copy from
+        :param destination: a storage to copy to
+        :param workers: count of concurrent copy workers
+        :param checkpoint_path: a file to record progress to, progress is not saved if `None`
+        :param skip_existing: do not copy objects that destination already has
+        :param report_interval: seconds between progress reports in log
+        """
+        if workers < 1:
+            raise ValueError("Invalid workers count " + str(workers))
+        self.source = source
+        self.destination = destination
+        self.workers = workers
+        self.checkpoint_path = checkpoint_path
+        self.skip_existing = skip_existing
+        self.report_interval = report_interval
+
+    def _copy_one(self, checkpoint: Checkpoint, file_hex: str):
+        if file_hex in checkpoint:
+            return self.SKIPPED, 0
+        file_id = UUID(hex=file_hex)
+        try:
+            if self.skip_existing and self.destination.exists(file_id):
+                checkpoint.add(file_hex)
+                return self.SKIPPED, 0
+            size = self.source.stat(file_id).size
+            self.source.copy(file_id, file_id, destination=self.destination)
+            checkpoint.add(file_hex)
+            return self.COPIED, size
+        except StorageError as e:
+            self.logger.warning("Cannot copy %s: %s", file_hex, str(e))
+            return self.FAILED, 0
+
+    def run(self, file_ids: Optional[Iterable[str]] = None) -> MigrationStats:
+        """Run migration.
+
+        :param file_ids: hex ids to copy, all source objects if `None`
+        :return: migration statistics
+        """
+        stats = MigrationStats()
+        if file_ids is None:
+            file_ids = self.source.list()
+        last_report = stats.started
+        with Checkpoint(self.checkpoint_path) as checkpoint:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                results = bounded_map(
+                    executor,
+                    lambda file_hex: self._copy_one(checkpoint, file_hex),
+                    file_ids,
+                    self.workers * 4,
+                )
+                for status, size in results:
+                    setattr(stats, status, getattr(stats, status) + 1)
+                    stats.bytes += size
+                    now = time.monotonic()
+                    if now - last_report >= self.report_interval:
+                        last_report = now
+                        self.logger.info("Progress: %r", stats)
+        self.logger.info("Finished: %r", stats)
+        return stats
+
+
+def open_storage(url: str, args: argparse.Namespace) -> Storage:
+    """Open a storage by URL.
+
+    Supported URLs are `s3://<bucket>/<database>` and
+    `file://<storage_directory>/<database>` (a plain path is accepted as well).
+
+    :param url: a storage URL
+    :param args: parsed command line arguments with S3 settings
+    :return: a storage
+    """
+    if url.startswith("s3://"):
+        bucket, _, database = url.removeprefix("s3://").partition("/")
+        if not bucket or not database:
+            raise ValueError("Invalid S3 storage URL " + url)
+        return S3Storage(
+            database=database,
+            bucket=bucket,
+            region=args.region,
+            access_key_id=args.access_key_id,
+            secret_access_key=args.secret_access_key,
+            endpoint_url=args.endpoint_url,
+        )
+    url = url.removeprefix("file://")
+    storage_directory, database = os.path.split(os.path.normpath(url))
+    if not storage_directory or not database:
+        raise ValueError("Invalid file storage URL " + url)
+    return FileStorage(
+        storage_directory=storage_directory, database=database, stripes=args.stripes
+    )
+
+
+def main(argv=None) -> int:
+    """Entry point of `sfr-migrate` console script."""
+    parser = argparse.ArgumentParser(
+        prog="sfr-migrate",
+        description="Copy all objects of a database between storages.",
+    )
+    parser.add_argument("source", help="s3://<bucket>/<db> or file://<dir>/<db>")
+    parser.add_argument("destination", help="s3://<bucket>/<db> or file://<dir>/<db>")
+    parser.add_argument("--workers", type=int, default=DefaultParams.WORKERS)
+    parser.add_argument("--checkpoint", help="a file to save progress to")
+    parser.add_argument(
+        "--no-skip-existing",
+        dest="skip_existing",
+        action="store_false",
+        help="do not check if destination already has an object",
+    )
+    parser.add_argument(
+        "--report-interval", type=float, default=DefaultParams.REPORT_INTERVAL
+    )
+    parser.add_argument("--stripes", type=int, default=None)
+    parser.add_argument("--region", default=os.environ.get("AWS_DEFAULT_REGION"))
+    parser.add_argument("--endpoint-url", default=None)
+    parser.add_argument("--access-key-id", default=os.environ.get("AWS_ACCESS_KEY_ID"))
+    parser.add_argument(
+        "--secret-access-key", default=os.environ.get("AWS_SECRET_ACCESS_KEY")
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+    migrator = Migrator(
+        source=open_storage(args.source, args),
+        destination=open_storage(args.destination, args),
+        workers=args.workers,
+        checkpoint_path=args.checkpoint,
+        skip_existing=args.skip_existing,
+        report_interval=args.report_interval,
+    )
+    stats = migrator.run()
+    return 1 if stats.failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,405 @@
+import hashlib
+import itertools
+import logging
+import math
+import threading
+from typing import Iterable, Iterator, List, Optional, Sequence, Union
+from uuid import UUID, uuid4
+
+from .exceptions import StorageError, StorageExistsError, StorageNotFoundError
+from .filestorage import FileStorage
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+from .utils import RateLimiter
+
+
+class DiskRoot:
+    """A mount point of :class:`MultiFileStorage`."""
+
+    READ_WRITE = "rw"
+    READ_ONLY = "ro"
+    DRAINING = "draining"
+
+    def __init__(self, path: str, weight: float = 1.0, mode: str = READ_WRITE):
+        """Construct a disk root.
+
+        :param path: a root storage directory on the disk
+        :param weight: relative share of new objects, e.g. disk capacity
+        :param mode: `rw`, `ro` (no writes and deletes) or `draining`
+          (no new objects, existing ones are moved away by rebalance)
+        """
+        if weight <= 0:
+            raise ValueError("Invalid weight " + str(weight))
+        if mode not in (self.READ_WRITE, self.READ_ONLY, self.DRAINING):
+            raise ValueError("Invalid mode " + mode)
+        self.path = path
+        self.weight = weight
+        self.mode = mode
+
+    @property
+    def writable(self) -> bool:
+        """New objects can be placed on the root."""
+        return self.mode == self.READ_WRITE
+
+    def __repr__(self) -> str:
+        return "DiskRoot {} weight={} mode={}".format(self.path, self.weight, self.mode)
+
+
+class MultiFileStorage(Storage):  # pylint: disable=too-many-public-methods
+    """Filesystem-based storage spread over several disks.
+
+    Each object is placed on a root chosen by weighted rendezvous hashing
+    of its id, so lookups compute the location instead of probing all disks.
+    When a root is added or drained, only objects that must move are moved
+    by :meth:`rebalance`, and until then they are found on the root that
+    ranked next for them. Objects left behind by several root changes are
+    found by probing the remaining roots, so only lookups of such objects
+    and of missing ones touch every disk.
+    """
+
+    logger = logging.getLogger("MultiFileStorage")
+
+    def __init__(
+        self,
+        roots: Sequence[Union[str, DiskRoot]],
+        database: str,
+        stripes: Optional[int] = None,
+        file_perm=0o660,
+        dir_perm=0o770,
+        checksum_algorithm: Optional[str] = None,
+        rebalance_bytes_per_sec: Optional[float] = None,
+    ):
+        """Construct MultiFileStorage instance.
+
+        :param roots: root storage directories or :class:`DiskRoot` descriptions
+        :param database: a database name
+        :param stripes: count of directory stripes on each root
+        :param file_perm: permissions for created files
+        :param dir_perm: permissions for created dirs
+        :param checksum_algorithm: see :class:`FileStorage`
+        :param rebalance_bytes_per_sec: throughput limit of background rebalance
+        """
+        if not roots:
+            raise ValueError("No roots given")
+        self.database = database
+        self.rebalance_bytes_per_sec = rebalance_bytes_per_sec
+        self._storage_args = dict(
+            stripes=stripes,
+            file_perm=file_perm,
+            dir_perm=dir_perm,
+            checksum_algorithm=checksum_algorithm,
+        )
+        # copy-on-write lists, replaced atomically under lock
+        self._roots: List[DiskRoot] = []
+        self._storages: List[FileStorage] = []
+        self._lock = threading.Lock()
+        self._rebalance_thread = None
+        self._rebalance_pending = False
+        for root in roots:
+            self._add_root(root)
+
+    def _add_root(self, root: Union[str, DiskRoot]):
+        if not isinstance(root, DiskRoot):
+            root = DiskRoot(root)
+        if any(existing.path == root.path for existing in self._roots):
+            raise ValueError("Duplicate root " + root.path)
+        storage = FileStorage(
+            storage_directory=root.path, database=self.database, **self._storage_args
+        )
+        with self._lock:
+            # readers take indices from roots, so storages are extended first
+            self._storages = self._storages + [storage]
+            self._roots = self._roots + [root]
+
+    @property
+    def roots(self) -> List[DiskRoot]:
+        """Configured roots."""
+        return list(self._roots)
+
+    def _rank(self, file_id: UUID) -> List[int]:
+        """Return root indices ordered by weighted rendezvous score."""
+        scores = []
+        for index, root in enumerate(self._roots):
+            digest = hashlib.blake2b(
+                file_id.bytes + root.path.encode("utf-8"), digest_size=8
+            ).digest()
+            # uniform in (0, 1)
+            uniform = (int.from_bytes(digest, "big") + 0.5) / 2**64
+            scores.append((root.weight / -math.log(uniform), index))
+        scores.sort(reverse=True)
+        return [index for _, index in scores]
+
+    def _placement(self, file_id: UUID) -> int:
+        for index in self._rank(file_id):
+            if self._roots[index].writable:
+                return index
+        raise StorageError("No writable roots")
+
+    def _candidates(self, file_id: UUID) -> List[int]:
+        """Roots that may hold an object.
+
+        These are roots ranked up to the current placement and the next
+        writable one, that was the placement before the last root change.
+        """
+        candidates = []
+        writable = 0
+        for index in self._rank(file_id):
+            candidates.append(index)
+            if self._roots[index].writable:
+                writable += 1
+                if writable == 2:
+                    break
+        return candidates
+
+    def _lookup_order(self, file_id: UUID) -> Iterator[int]:
+        """Candidate roots first, then the remaining ones."""
+        candidates = self._candidates(file_id)
+        yield from candidates
+        for index in range(len(self._roots)):
+            if index not in candidates:
+                yield index
+
+    def _locate(self, file_id: UUID) -> FileStorage:
+        for index in self._lookup_order(file_id):
+            if self._storages[index].exists(file_id):
+                return self._storages[index]
+        raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def is_local(self) -> bool:
+        return True
+
+    def get(self, file_id: UUID) -> bytes:
+        for index in self._lookup_order(file_id):
+            try:
+                return self._storages[index].get(file_id)
+            except StorageNotFoundError:
+                continue
+        raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
+        return self._locate(file_id).get_path(file_id, params)
+
+    def exists(self, file_id: UUID) -> bool:
+        return any(
+            self._storages[index].exists(file_id)
+            for index in self._lookup_order(file_id)
+        )
+
+    def store(
+        self,
+        content: bytes,
+        content_type: Optional[str] = None,
+        tags: Optional[dict] = None,
+        override_id: Optional[UUID] = None,
+        cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> UUID:
+        if override_id and self.exists(override_id):
+            # the placement root checks only itself
+            raise StorageExistsError("File {} already stored".format(override_id))
+        file_id = override_id if override_id else uuid4()
+        return self._storages[self._placement(file_id)].store(
+            content,
+            content_type=content_type,
+            tags=tags,
+            override_id=file_id,
+            cache_control=cache_control,
+            ttl=ttl,
+        )
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file, linked if the copy is placed on the disk of the source."""
+        if destination is not None and destination is not self:
+            return self._locate(src_id).copy(
+                src_id, dst_id, tags, cache_control, destination
+            )
+        dst_id = dst_id if dst_id else uuid4()
+        return self._locate(src_id).copy(
+            src_id,
+            dst_id,
+            tags,
+            cache_control,
+            destination=self._storages[self._placement(dst_id)],
+        )
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        return self.stat(file_id).content_type
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        for index in self._lookup_order(file_id):
+            try:
+                return self._storages[index].stat(file_id)
+            except StorageNotFoundError:
+                continue
+        raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        for index in self._lookup_order(file_id):
+            try:
+                return self._storages[index].open_file(file_id)
+            except StorageNotFoundError:
+                continue
+        raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        return self._locate(file_id).get_checksum(file_id)
+
+    def delete(self, file_id: UUID, silent: bool = False):
+        for index in self._lookup_order(file_id):
+            if self._roots[index].mode == DiskRoot.READ_ONLY:
+                continue
+            if self._storages[index].exists(file_id):
+                self._storages[index].delete(file_id, silent=silent)
+                return
+        if not silent:
+            raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        # expiry is indexed on the disk a file was stored to
+        return sum(
+            storage.purge_expired(now)
+            for root, storage in zip(self._roots, self._storages)
+            if root.mode != DiskRoot.READ_ONLY
+        )
+
+    def count(self) -> int:
+        return sum(storage.count() for storage in self._storages)
+
+    def list(self) -> Iterable[str]:
+        return itertools.chain.from_iterable(
+            storage.list() for storage in self._storages
+        )
+
+    def usage(self) -> Usage:
+        return sum((storage.usage() for storage in self._storages), Usage())
+
+    def clean(self):
+        for root, storage in zip(self._roots, self._storages):
+            if root.mode != DiskRoot.READ_ONLY:
+                storage.clean()
+
+    def add_root(self, root: Union[str, DiskRoot], rebalance: bool = True):
+        """Add a root and optionally start a background rebalance.
+
+        :param root: a root storage directory or a :class:`DiskRoot`
+        :param rebalance: start :meth:`rebalance` in background
+        """
+        self._add_root(root)
+        if rebalance:
+            self.start_rebalance()
+
+    def set_mode(self, path: str, mode: str, rebalance: bool = True):
+        """Change mode of a root, e.g. mark it draining.
+
+        :param path: a root storage directory
+        :param mode: a new mode, see :class:`DiskRoot`
+        :param rebalance: start :meth:`rebalance` in background
+        """
+        with self._lock:
+            paths = [root.path for root in self._roots]
+            if path not in paths:
+                raise ValueError("Unknown root " + path)
+            index = paths.index(path)
+            roots = list(self._roots)
+            roots[index] = DiskRoot(path, roots[index].weight, mode)
+            self._roots = roots
+        if rebalance:
+            self.start_rebalance()
+
+    @staticmethod
+    def _move(storage: FileStorage, target: FileStorage, file_id: UUID):
+        """Copy a file to another root without reading it into memory."""
+        # pylint: disable=protected-access
+        ttl = storage._remaining_ttl(file_id)
+        storage.copy(file_id, file_id, destination=target)
+        if ttl is not None:
+            target._expire_or_delete(file_id, target._select_stripe(file_id), ttl)
+
+    def rebalance(
+        self,
+        bytes_per_sec: Optional[float] = None,
+        ops_per_sec: Optional[float] = None,
+    ) -> int:
+        """Move objects to roots where they are placed now.
+
+        Objects on read-only roots are not moved.
+
+        :param bytes_per_sec: throughput limit, unlimited if `None`
+        :param ops_per_sec: limit of moved objects per second, unlimited if `None`
+        :return: count of moved objects
+        """
+        bytes_limiter = RateLimiter(bytes_per_sec) if bytes_per_sec else None
+        ops_limiter = RateLimiter(ops_per_sec) if ops_per_sec else None
+        moved = 0
+        for index, (root, storage) in enumerate(zip(self._roots, self._storages)):
+            if root.mode == DiskRoot.READ_ONLY:
+                continue
+            for file_hex in storage.list():
+                file_id = UUID(hex=file_hex)
+                target_index = self._placement(file_id)
+                if target_index == index:
+                    continue
+                if ops_limiter:
+                    ops_limiter.acquire()
+                try:
+                    if bytes_limiter:
+                        bytes_limiter.acquire(storage.stat(file_id).size)
+                    target = self._storages[target_index]
+                    if not target.exists(file_id):
+                        self._move(storage, target, file_id)
+                    storage.delete(file_id, silent=True)
+                    moved += 1
+                except StorageError as e:
+                    self.logger.warning("Cannot move %s: %s", file_hex, str(e))
+        self.logger.info("Rebalance moved %d objects", moved)
+        return moved
+
+    def _run_rebalance(self):
+        while True:
+            with self._lock:
+                if not self._rebalance_pending:
+                    self._rebalance_thread = None
+                    return
+                self._rebalance_pending = False
+            self.rebalance(bytes_per_sec=self.rebalance_bytes_per_sec)
+
+    def start_rebalance(self):
+        """Start a throttled rebalance in background.
+
+        If a rebalance is already running, it is repeated after completion
+        to pick up root changes made meanwhile.
+        """
+        with self._lock:
+            self._rebalance_pending = True
+            if self._rebalance_thread:
+                return
+            self._rebalance_thread = threading.Thread(
+                target=self._run_rebalance,
+                name="MultiFileStorage-rebalance",
+                daemon=True,
+            )
+            self._rebalance_thread.start()
+
+    def wait_rebalance(self, timeout: Optional[float] = None) -> bool:
+        """Wait for a background rebalance.
+
+        :param timeout: maximum seconds to wait, wait forever if `None`
+        :return: `True` if no rebalance is running
+        """
+        thread = self._rebalance_thread
+        if thread:
+            thread.join(timeout)
+            return not thread.is_alive()
+        return True
+
+    def __repr__(self) -> str:
+        return "MultiFileStorage db={} roots={}".format(
+            self.database, ",".join(root.path for root in self._roots)
+        )
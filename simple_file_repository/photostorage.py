@@ -1,25 +1,48 @@
 import logging
-import mimetypes
-import os
-import subprocess
-import tempfile
-from typing import Optional
+from typing import Dict, Iterable, Optional, Sequence
 from uuid import UUID
 
 from .exceptions import StorageNotInitializedError
-from .storage import Storage
+from .imageinfo import (
+    HEADER_SIZE,
+    MAX_HEADER_SIZE,
+    ImageInfo,
+    NeedMoreData,
+    parse_image_info,
+)
+from .storage import FileHandle, FileStat, Storage
+from .thumbnailer import ImageMagickThumbnailer, Thumbnailer, ThumbnailProfile
+from .usage import Usage
 
+# mime types of files stored without one
+UNKNOWN_MIME_TYPES = ("application/octet-stream", "binary/octet-stream")
 
-class PhotoStorage(Storage):
+
+class PhotoStorage(Storage):  # pylint: disable=too-many-public-methods
     """Photo storage.
 
     A thin wrapper over file-based `Storage`"""
 
     logger = logging.getLogger("PhotoStorage")
 
-    def __init__(self, storage: Storage, imagemagick_convert: str):
+    def __init__(
+        self,
+        storage: Storage,
+        imagemagick_convert: str,
+        thumbnail_profile: ThumbnailProfile = ThumbnailProfile.QUALITY,
+        thumbnailer: Optional[Thumbnailer] = None,
+    ):
+        """Construct PhotoStorage instance.
+
+        :param storage: an underlying storage
+        :param imagemagick_convert: path to `convert` executable
+        :param thumbnail_profile: a default profile of :meth:`generate_thumbnail`
+        :param thumbnailer: a thumbnail backend, e.g. `PillowThumbnailer`,
+          `ImageMagickThumbnailer` running `imagemagick_convert` if `None`
+        """
         self._storage = storage
-        self._imagemagick_convert = imagemagick_convert
+        self.thumbnailer = thumbnailer or ImageMagickThumbnailer(imagemagick_convert)
+        self.thumbnail_profile = thumbnail_profile
 
     def _check_init(self):
         if not self._storage:
@@ -35,6 +58,7 @@ class PhotoStorage(Storage):
         tags: Optional[dict] = None,
         override_id: Optional[UUID] = None,
         cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
     ) -> UUID:
         self._check_init()
         return self._storage.store(
@@ -43,6 +67,7 @@ class PhotoStorage(Storage):
             tags=tags,
             override_id=override_id,
             cache_control=cache_control,
+            ttl=ttl,
         )
 
     def get(self, file_id: UUID) -> bytes:
@@ -57,6 +82,18 @@ class PhotoStorage(Storage):
         self._check_init()
         return self._storage.delete(file_id, silent)
 
+    def prefetch(self, file_ids: Iterable[UUID], priority: int = 0):
+        self._check_init()
+        self._storage.prefetch(file_ids, priority)
+
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        self._check_init()
+        self._storage.delete_many(file_ids, workers)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        self._check_init()
+        return self._storage.purge_expired(now)
+
     def clean(self):
         self._check_init()
         self._storage.clean()
@@ -69,6 +106,50 @@ class PhotoStorage(Storage):
         self._check_init()
         return self._storage.get_mimetype(file_id)
 
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        self._check_init()
+        return self._storage.stat(file_id, with_tags=with_tags)
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        self._check_init()
+        return self._storage.get_checksum(file_id)
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        self._check_init()
+        return self._storage.open_file(file_id)
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        self._check_init()
+        return self._storage.read_head(file_id, size)
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        self._check_init()
+        if isinstance(destination, PhotoStorage):
+            # pylint: disable=protected-access
+            destination = destination._storage
+        return self._storage.copy(
+            src_id,
+            dst_id=dst_id,
+            tags=tags,
+            cache_control=cache_control,
+            destination=destination,
+        )
+
+    def usage(self) -> Usage:
+        self._check_init()
+        return self._storage.usage()
+
+    def flush_usage(self):
+        self._check_init()
+        self._storage.flush_usage()
+
     def count(self):
         self._check_init()
         return self._storage.count()
@@ -77,66 +158,128 @@ class PhotoStorage(Storage):
         self._check_init()
         return self._storage.list()
 
-    def _run_imagemagick(self, source_path: str, target_path: str, thumb_size: int):
-        image_dim = "{0}x{0}".format(thumb_size)
-        command = [
-            self._imagemagick_convert,
-            source_path,
-            "-auto-orient",
-            "-thumbnail",
-            image_dim,
-            "-gravity",
-            "center",
-            "-background",
-            "transparent",
-            "-extent",
-            image_dim,
-            "-strip",
-            target_path,
-        ]
-        subprocess.run(
-            command,
-            shell=False,
-            check=True,
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.PIPE,
-        )
+    def get_image_info(self, file_id: UUID) -> Optional[ImageInfo]:
+        """Parse dimensions, orientation and format from an image header.
+
+        Only first bytes of a file are read, with a ranged request for S3.
+
+        :param file_id: a file id
+        :return: image properties or `None` if file is not a JPEG, PNG,
+          GIF or WebP image or its header is broken
+        """
+        self._check_init()
+        size = HEADER_SIZE
+        while True:
+            head = self._storage.read_head(file_id, size)
+            try:
+                return parse_image_info(head)
+            except NeedMoreData:
+                if len(head) < size or size >= MAX_HEADER_SIZE:
+                    return None
+                size = MAX_HEADER_SIZE
+            except ValueError:
+                return None
+
+    @staticmethod
+    def _parse_image_info(content: bytes) -> Optional[ImageInfo]:
+        try:
+            return parse_image_info(content)
+        except ValueError:
+            return None
+
+    def _may_be_image(self, image_id: UUID) -> bool:
+        # formats unknown to the header parser (TIFF, HEIC, BMP, ...) stored
+        # without a mime type are left to the thumbnailer
+        mime_type = self.get_mimetype(image_id)
+        return mime_type.startswith("image/") or mime_type in UNKNOWN_MIME_TYPES
 
     def generate_thumbnail(
-        self, image_id: UUID, mime_type: str, thumb_size: int = 200
+        self,
+        image_id: UUID,
+        mime_type: str,
+        thumb_size: int = 200,
+        passthrough: bool = False,
+        profile: Optional[ThumbnailProfile] = None,
     ) -> UUID:
         """Generate and store thumbnail for a given image.
 
-        Thumbnail is created using `convert` executable that was passed
-        in ctor in `imagemagick_convert`.
+        Thumbnail is created by `thumbnailer`, by default with `convert`
+        executable that was passed in ctor in `imagemagick_convert`. The image header
+        is parsed first, so files that are not images are rejected without
+        decoding and only the first frame of animated images is decoded.
+        Decoding of large images is sped up according to a thumbnail profile.
+
+        JPEG thumbnails are progressive, WebP and AVIF thumbnails are encoded
+        with quality tuned for small images, see `OUTPUT_FORMATS`.
 
         :param image_id: input file id
         :param mime_type: mime type of the thumbnail (can differ with the original file)
         :param thumb_size: width and height of the thumbnail
+        :param passthrough: store a copy of the image instead of converting it
+          if it is not larger than `thumb_size`, upright, has `mime_type` and
+          no metadata. Such thumbnail is not extended to a square.
+        :param profile: a thumbnail profile, `thumbnail_profile` if `None`
         :return: thumbnail id
         """
-        if not self._imagemagick_convert or not os.path.exists(
-            self._imagemagick_convert
-        ):
-            raise RuntimeError("Cannot find imagemagick")
-
-        with tempfile.TemporaryDirectory() as tmpdirname:
-            extension = mimetypes.guess_extension(mime_type)
-            if not extension:
-                raise RuntimeError(
-                    "Extension cannot be deduced for {}".format(mime_type)
-                )
-            content = self.get(image_id)
-            saved_path = os.path.join(
-                tmpdirname, "saved-{}.{}".format(image_id.hex, extension)
+        return self.generate_thumbnail_variants(
+            image_id,
+            [mime_type],
+            thumb_size=thumb_size,
+            passthrough=passthrough,
+            profile=profile,
+        )[mime_type]
+
+    def generate_thumbnail_variants(
+        self,
+        image_id: UUID,
+        mime_types: Sequence[str],
+        thumb_size: int = 200,
+        passthrough: bool = False,
+        profile: Optional[ThumbnailProfile] = None,
+    ) -> Dict[str, UUID]:
+        """Generate and store thumbnails of one size in several formats.
+
+        The image is decoded and resized once, all formats are written
+        by a single `convert` run or encoded from one in-process image.
+        A serving layer can pick a variant by `Accept` header
+        with :func:`~simple_file_repository.serving.negotiate_format`.
+
+        :param image_id: input file id
+        :param mime_types: mime types of thumbnails, e.g. `image/avif`,
+          `image/webp` and `image/jpeg`
+        :param thumb_size: width and height of thumbnails
+        :param passthrough: see :meth:`generate_thumbnail`
+        :param profile: a thumbnail profile, `thumbnail_profile` if `None`
+        :return: thumbnail ids by mime type
+        """
+        for mime_type in mime_types:
+            self.thumbnailer.check_format(mime_type)
+        # files that are not images are rejected by their header
+        info = self.get_image_info(image_id)
+        if info is None and not self._may_be_image(image_id):
+            raise RuntimeError("File {} is not an image".format(image_id))
+        content = self.get(image_id)
+        if info is None:
+            info = self._parse_image_info(content)
+
+        thumbnails = {}
+        fits = info is not None and max(info.width, info.height) <= thumb_size
+        fits = fits and info.orientation == 1 and info.mime_type in mime_types
+        # a copy would keep EXIF with GPS location, ICC profile and comments
+        fits = fits and not info.metadata
+        if passthrough and fits:
+            thumbnails[info.mime_type] = self._storage.store(
+                content, content_type=info.mime_type, tags=dict(kind="thumb")
+            )
+        pending = [mime_type for mime_type in mime_types if mime_type not in thumbnails]
+        if not pending:
+            return thumbnails
+
+        rendered = self.thumbnailer.render(
+            content, info, pending, thumb_size, profile or self.thumbnail_profile
+        )
+        for mime_type in pending:
+            thumbnails[mime_type] = self._storage.store(
+                rendered[mime_type], content_type=mime_type, tags=dict(kind="thumb")
             )
-            with open(saved_path, "wb") as f:
-                f.write(content)
-            target_file_path = tmpdirname + "/target" + extension
-            self._run_imagemagick(saved_path, target_file_path, thumb_size)
-            with open(target_file_path, "rb") as f:
-                content = f.read()
-                thumbnail_id = self._storage.store(
-                    content, content_type=mime_type, tags=dict(kind="thumb")
-                )
-                return thumbnail_id
+        return thumbnails
@@ -1,22 +1,63 @@
+import collections
+import fnmatch
 import logging
-from typing import Optional
+import re
+import secrets
+import threading
+from typing import Dict, Iterable, Optional
 
-from .exceptions import PhotoStorageNotFoundError, StorageNotInitializedError
+from .exceptions import (
+    PhotoStorageNotFoundError,
+    StorageError,
+    StorageNotInitializedError,
+)
 from .filestorage import FileStorage
-from .photostorage import PhotoStorage
+from .photostorage import PhotoStorage, ThumbnailProfile
 from .s3storage import S3Storage
+from .thumbnailer import Thumbnailer
+from .usage import Usage
+
+# database names are directory names and S3 key prefixes
+DATABASE_NAME_PATTERN = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    MAX_LIVE_STORAGES = 1024
 
 
 class PhotoStorages:
     """Photo storages for multiple databases.
 
-    Implemented as composition over file-based `Storage`"""
+    Implemented as composition over file-based `Storage`.
+
+    Databases are registered by name and their storages are created on first
+    access. At most `max_live_storages` recently used storages are kept,
+    others are dropped and created again when needed, so idle databases
+    do not pin memory. All S3 databases share one S3 client and file
+    databases create their directories on first store.
+    """
 
     logger = logging.getLogger("PhotoStorages")
 
-    def __init__(self):
+    def __init__(self, max_live_storages: int = DefaultParams.MAX_LIVE_STORAGES):
+        """Construct photo storages, :meth:`init_app` must be called before use.
+
+        :param max_live_storages: maximum count of storage objects kept alive
+        """
+        if max_live_storages < 1:
+            raise ValueError("Invalid live storages count " + str(max_live_storages))
+        self.max_live_storages = max_live_storages
         self._storages = None
         self._storage_directory = None
+        self._names = set()
+        self._s3_patterns = []
+        self._s3_client = None
+        self._params = {}
+        # one usage writer of a database for the process, kept over re-creation
+        self._usage_writers = {}
+        self._lock = threading.Lock()
 
     # False positive for Python 3.9, see pylint bug 3882
     # pylint: disable=unsubscriptable-object
@@ -33,13 +74,17 @@ class PhotoStorages:
         endpoint_url: Optional[str],
         default_cache_control: Optional[str],
         config=None,
+        track_usage: bool = False,
+        thumbnail_profile: ThumbnailProfile = ThumbnailProfile.QUALITY,
+        thumbnailer: Optional[Thumbnailer] = None,
     ):
         """Initialize photo storages.
 
-        :param names: a list of database names
+        :param names: a list of database names, more can be added by :meth:`register`
         :param storage_directory: a root storage directory
         :param imagemagick_convert: path to `convert` executable
-        :param names_for_s3: a list of database names that will be stored in `S3Storage`
+        :param names_for_s3: database names or :mod:`fnmatch` patterns
+          (e.g. `tenant-eu-*`) of databases that will be stored in `S3Storage`
         :param bucket: see :class:`S3Storage` for documentation
         :param region: see :class:`S3Storage` for documentation
         :param access_key_id: see :class:`S3Storage` for documentation
@@ -47,52 +92,189 @@ class PhotoStorages:
         :param endpoint_url: see :class:`S3Storage` for documentation
         :param default_cache_control: see :class:`S3Storage` for documentation
         :param config: extra config
+        :param track_usage: maintain usage statistics incrementally
+        :param thumbnail_profile: see :class:`PhotoStorage` for documentation
+        :param thumbnailer: see :class:`PhotoStorage` for documentation,
+          shared by all databases
         """
         self._storage_directory = storage_directory
+        self._s3_patterns = list(names_for_s3)
+        self._params = dict(
+            imagemagick_convert=imagemagick_convert,
+            bucket=bucket,
+            region=region,
+            access_key_id=access_key_id,
+            secret_access_key=secret_access_key,
+            endpoint_url=endpoint_url,
+            default_cache_control=default_cache_control,
+            config=config,
+            track_usage=track_usage,
+            thumbnail_profile=thumbnail_profile,
+            thumbnailer=thumbnailer,
+        )
+        self._reset(names)
 
-        self._storages = {}
+    def _reset(self, names: Iterable[str]):
+        with self._lock:
+            self._storages = collections.OrderedDict()
+            self._s3_client = None
+            self._names = set()
         for name in names:
-            if name in names_for_s3:
-                storage = S3Storage(
-                    database=name,
-                    bucket=bucket,
-                    region=region,
-                    access_key_id=access_key_id,
-                    secret_access_key=secret_access_key,
-                    endpoint_url=endpoint_url,
-                    default_cache_control=default_cache_control,
-                    config=config,
-                )
-            else:
-                storage = FileStorage(
-                    storage_directory=storage_directory, database=name, stripes=None
+            self.register(name)
+
+    def _check_init(self):
+        if not self._storage_directory:
+            raise StorageNotInitializedError("Call init_app")
+
+    def is_s3(self, name: str) -> bool:
+        """Tell if a database is routed to S3 by `names_for_s3` patterns."""
+        return any(fnmatch.fnmatchcase(name, pattern) for pattern in self._s3_patterns)
+
+    def register(self, name: str):
+        """Register a database, its storage is created on first access.
+
+        :param name: a database name of letters, digits, `_`, `.` and `-`,
+          except `.` and `..`
+        """
+        self._check_init()
+        valid = isinstance(name, str) and DATABASE_NAME_PATTERN.fullmatch(name)
+        if not valid or name in (".", ".."):
+            raise ValueError("Invalid database name " + str(name))
+        with self._lock:
+            self._names.add(name)
+
+    def _shared_s3_client(self):
+        with self._lock:
+            if self._s3_client is None:
+                self._s3_client = S3Storage.create_client(
+                    self._params["region"],
+                    self._params["access_key_id"],
+                    self._params["secret_access_key"],
+                    self._params["endpoint_url"],
+                    self._params["config"],
                 )
-            photo_storage = PhotoStorage(
-                storage=storage, imagemagick_convert=imagemagick_convert
+            return self._s3_client
+
+    def _usage_writer(self, name: str) -> str:
+        with self._lock:
+            return self._usage_writers.setdefault(name, secrets.token_hex(8))
+
+    def _create(self, name: str) -> PhotoStorage:
+        params = self._params
+        if self.is_s3(name):
+            storage = S3Storage(
+                database=name,
+                bucket=params["bucket"],
+                region=params["region"],
+                access_key_id=params["access_key_id"],
+                secret_access_key=params["secret_access_key"],
+                endpoint_url=params["endpoint_url"],
+                default_cache_control=params["default_cache_control"],
+                config=params["config"],
+                track_usage=params["track_usage"],
+                s3_client=self._shared_s3_client(),
+                usage_writer=self._usage_writer(name),
+            )
+        else:
+            storage = FileStorage(
+                storage_directory=self._storage_directory,
+                database=name,
+                stripes=None,
+                track_usage=params["track_usage"],
+                create_lazily=True,
             )
-            self._storages[name] = photo_storage
+        return PhotoStorage(
+            storage=storage,
+            imagemagick_convert=params["imagemagick_convert"],
+            thumbnail_profile=params["thumbnail_profile"],
+            thumbnailer=params["thumbnailer"],
+        )
+
+    def _get(self, name: str) -> PhotoStorage:
+        with self._lock:
+            storage = self._storages.get(name)
+            if storage is not None:
+                self._storages.move_to_end(name)
+                return storage
+        # created outside of lock, a concurrent duplicate is harmless
+        storage = self._create(name)
+        evicted = []
+        with self._lock:
+            storage = self._storages.setdefault(name, storage)
+            self._storages.move_to_end(name)
+            while len(self._storages) > self.max_live_storages:
+                evicted.append(self._storages.popitem(last=False))
+        for evicted_name, evicted_storage in evicted:
+            self._flush_usage(evicted_name, evicted_storage)
+        return storage
+
+    def _peek(self, name: str) -> PhotoStorage:
+        """Get a live storage or a throwaway one, the LRU order is kept."""
+        with self._lock:
+            storage = self._storages.get(name)
+        return storage if storage is not None else self._create(name)
+
+    def _flush_usage(self, name: str, storage: PhotoStorage):
+        # unsaved usage changes of a dropped storage would be lost
+        try:
+            storage.flush_usage()
+        except StorageError as e:
+            self.logger.warning("Cannot flush usage of %s: %s", name, str(e))
+
+    def get_or_create(self, name: str) -> PhotoStorage:
+        """Get a photo storage of a database, registering it if needed.
+
+        :param name: a database name
+        :return: a photo storage
+        """
+        if name not in self._names:
+            self.register(name)
+        return self._get(name)
+
+    def names(self) -> Iterable[str]:
+        """Names of registered databases."""
+        with self._lock:
+            return sorted(self._names)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._names
+
+    def __len__(self) -> int:
+        return len(self._names)
 
     def __getitem__(self, item: str) -> PhotoStorage:
         """Extract a photo storage by database name.
 
         :param item: a database name
         :return: a photo storage"""
-        if not self._storage_directory:
-            raise StorageNotInitializedError("Call init_app")
-        if item in self._storages:
-            return self._storages[item]
+        self._check_init()
+        if item in self._names:
+            return self._get(item)
         raise PhotoStorageNotFoundError(
             "PhotoStorage named {} not found in {}".format(item, repr(self))
         )
 
+    def usage_by_database(self) -> Dict[str, Usage]:
+        """Usage of each database."""
+        self._check_init()
+        # sweeps do not evict recently used storages
+        return {name: self._peek(name).usage() for name in self.names()}
+
+    def usage(self) -> Usage:
+        """Usage aggregated over all databases."""
+        return sum(self.usage_by_database().values(), Usage())
+
     def clean(self):
         """Clean all underlying storages."""
-        for storage in self._storages.values():
-            storage.clean()
+        for name in self.names():
+            self._peek(name).clean()
 
     def __repr__(self) -> str:
-        if self._storages:
-            return "<PhotoStorages: {} at dir {}>".format(
-                ",".join(self._storages.keys()), self._storage_directory
+        if self._names:
+            names = self.names()
+            return "<PhotoStorages: {}{} at dir {}>".format(
+                ",".join(names[:10]),
+                ",... ({} total)".format(len(names)) if len(names) > 10 else "",
+                self._storage_directory,
             )
         return "<PhotoStorages: empty>"
@@ -0,0 +1,414 @@
+import collections
+import heapq
+import itertools
+import logging
+import threading
+from typing import Iterable, List, Optional
+from uuid import UUID
+
+from .exceptions import StorageError, StorageNotFoundError
+from .singleflight import SingleFlight
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    WORKERS = 4
+    MAX_PENDING = 1024
+    CACHE_BYTES = 256 * 1024 * 1024
+
+
+class PrefetchingStorage(Storage):  # pylint: disable=too-many-public-methods
+    """Storage wrapper reading files in background before they are requested.
+
+    :meth:`prefetch` queues file ids and returns immediately, `workers`
+    threads read them from the underlying storage in order of priority into a
+    cache tier: memory, or a local `cache` storage such as a `FileStorage`.
+    Ids that are cached, queued or being read are not queued again. A `get`
+    of a cached file is served from the cache, a `get` of a file being read
+    waits for that read instead of making another request.
+
+    The cache keeps least recently used files up to `cache_bytes`. Counters
+    `prefetched`, `used` (prefetched files that were read at least once) and
+    `wasted` (evicted or invalidated before use) show whether prefetching
+    pays off.
+    """
+
+    logger = logging.getLogger("PrefetchingStorage")
+
+    def __init__(
+        self,
+        storage: Storage,
+        cache: Optional[Storage] = None,
+        cache_bytes: int = DefaultParams.CACHE_BYTES,
+        workers: int = DefaultParams.WORKERS,
+        max_pending: int = DefaultParams.MAX_PENDING,
+    ):
+        """Construct PrefetchingStorage instance.
+
+        :param storage: an underlying storage
+        :param cache: a local storage for prefetched files, kept in memory if `None`
+        :param cache_bytes: maximum total size of cached files
+        :param workers: count of background read threads
+        :param max_pending: maximum count of queued ids, more ids are dropped
+        """
+        if workers < 1:
+            raise ValueError("Invalid workers count " + str(workers))
+        self._storage = storage
+        self.cache = cache
+        self.cache_bytes = cache_bytes
+        self.workers = workers
+        self.max_pending = max_pending
+        self.flight = SingleFlight()
+
+        self.prefetched = 0
+        self.used = 0
+        self.wasted = 0
+        self.hits = 0
+        self.misses = 0
+        self.dropped = 0
+        self.cancelled = 0
+        self.failed = 0
+
+        # file id -> [size, used, content if kept in memory], LRU first
+        self._entries = collections.OrderedDict()
+        self._cached_bytes = 0
+        # heap of (-priority, sequence, file id), stale items are skipped
+        self._queue = []
+        # queued file id -> sequence of its current heap item
+        self._pending = {}
+        self._in_flight = set()
+        # in-flight ids a caller waited for or that were invalidated
+        self._joined = set()
+        self._invalidated = set()
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._stopped = False
+        self._threads = [
+            threading.Thread(
+                target=self._run,
+                name="PrefetchingStorage-{}".format(index),
+                daemon=True,
+            )
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def close(self):
+        """Stop background threads, queued ids are dropped."""
+        with self._cond:
+            self._stopped = True
+            self._queue.clear()
+            self._pending.clear()
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def prefetch(self, file_ids: Iterable[UUID], priority: int = 0):
+        """Queue files to be read in background, never blocks.
+
+        :param file_ids: file ids in order of expected access
+        :param priority: files of a higher priority are read first,
+          a queued id is moved up if queued again with a higher priority
+        """
+        with self._cond:
+            for file_id in file_ids:
+                if file_id in self._entries or file_id in self._in_flight:
+                    continue
+                full = len(self._pending) >= self.max_pending
+                if full and file_id not in self._pending:
+                    self.dropped += 1
+                    continue
+                sequence = next(self._sequence)
+                current = self._pending.get(file_id)
+                if current is not None and current[0] <= -priority:
+                    continue
+                self._pending[file_id] = (-priority, sequence)
+                heapq.heappush(self._queue, (-priority, sequence, file_id))
+            self._cond.notify_all()
+
+    def cancel(self, file_ids: Optional[Iterable[UUID]] = None) -> int:
+        """Remove files from the prefetch queue, reads in progress are not stopped.
+
+        :param file_ids: file ids, all queued ids if `None`
+        :return: count of removed ids
+        """
+        with self._cond:
+            if file_ids is None:
+                count = len(self._pending)
+                self._pending.clear()
+                self._queue.clear()
+            else:
+                count = sum(
+                    self._pending.pop(file_id, None) is not None for file_id in file_ids
+                )
+            self.cancelled += count
+            return count
+
+    def pending_count(self) -> int:
+        """Count of queued ids."""
+        with self._cond:
+            return len(self._pending)
+
+    def _next_task(self) -> Optional[UUID]:
+        with self._cond:
+            while not self._stopped:
+                while self._queue:
+                    neg_priority, sequence, file_id = heapq.heappop(self._queue)
+                    if self._pending.get(file_id) == (neg_priority, sequence):
+                        del self._pending[file_id]
+                        self._in_flight.add(file_id)
+                        return file_id
+                self._cond.wait()
+            return None
+
+    def _fetch(self, file_id: UUID) -> Optional[bytes]:
+        try:
+            content = self.flight.do(
+                ("get", file_id), lambda: self._storage.get(file_id)
+            )
+        except StorageNotFoundError:
+            return None
+        except StorageError as e:
+            self.logger.info("Prefetch of %s failed: %s", file_id, str(e))
+            return None
+        if self.cache is not None and len(content) <= self.cache_bytes:
+            try:
+                self.cache.delete(file_id, silent=True)
+                self.cache.store(content, override_id=file_id)
+            except StorageError as e:
+                self.logger.warning("Cannot cache %s: %s", file_id, str(e))
+                return None
+        return content
+
+    def _run(self):
+        while True:
+            file_id = self._next_task()
+            if file_id is None:
+                return
+            content = self._fetch(file_id)
+            with self._cond:
+                self._in_flight.discard(file_id)
+                used = file_id in self._joined
+                self._joined.discard(file_id)
+                invalidated = file_id in self._invalidated
+                self._invalidated.discard(file_id)
+                if content is None:
+                    self.failed += 1
+                    continue
+                if invalidated:
+                    evicted = [file_id]
+                else:
+                    evicted = self._add(file_id, content, used)
+            self._delete_cached(evicted)
+
+    def _add(self, file_id: UUID, content: bytes, used: bool) -> List[UUID]:
+        """Add a cache entry, must be called under lock.
+
+        :return: ids of evicted entries
+        """
+        self.prefetched += 1
+        self.used += int(used)
+        if len(content) > self.cache_bytes:
+            self.wasted += int(not used)
+            return []
+        self._drop(file_id)
+        memory_content = content if self.cache is None else None
+        self._entries[file_id] = [len(content), used, memory_content]
+        self._cached_bytes += len(content)
+        evicted = []
+        while self._cached_bytes > self.cache_bytes:
+            evicted_id, entry = self._entries.popitem(last=False)
+            self._account_removed(entry)
+            evicted.append(evicted_id)
+        return evicted
+
+    def _account_removed(self, entry: List):
+        """Update counters for a removed entry, must be called under lock."""
+        self._cached_bytes -= entry[0]
+        if not entry[1]:
+            self.wasted += 1
+
+    def _drop(self, file_id: UUID) -> bool:
+        """Remove a cache entry, must be called under lock."""
+        entry = self._entries.pop(file_id, None)
+        if entry is None:
+            return False
+        self._account_removed(entry)
+        return True
+
+    def _delete_cached(self, file_ids: Iterable[UUID]):
+        if self.cache is None:
+            return
+        for file_id in file_ids:
+            try:
+                self.cache.delete(file_id, silent=True)
+            except StorageError as e:  # pragma: no cover
+                self.logger.warning("Cannot evict %s: %s", file_id, str(e))
+
+    def _invalidate(self, file_id: UUID):
+        with self._cond:
+            self._pending.pop(file_id, None)
+            if file_id in self._in_flight:
+                self._invalidated.add(file_id)
+            dropped = self._drop(file_id)
+        self.flight.forget(("get", file_id))
+        if dropped:
+            self._delete_cached([file_id])
+
+    def _get_cached(self, file_id: UUID) -> Optional[bytes]:
+        with self._cond:
+            entry = self._entries.get(file_id)
+            if entry is None:
+                return None
+            self._entries.move_to_end(file_id)
+            if not entry[1]:
+                entry[1] = True
+                self.used += 1
+            self.hits += 1
+            content = entry[2]
+        if content is None:
+            try:
+                content = self.cache.get(file_id)
+            except StorageNotFoundError:
+                # removed from the cache storage by someone else
+                with self._cond:
+                    self._drop(file_id)
+                return None
+        return content
+
+    def _clear_cache(self):
+        with self._cond:
+            file_ids = list(self._entries)
+            for file_id in file_ids:
+                self._drop(file_id)
+            self._invalidated.update(self._in_flight)
+        self._delete_cached(file_ids)
+        self.flight.clear()
+
+    def is_local(self) -> bool:
+        return self._storage.is_local()
+
+    def get(self, file_id: UUID) -> bytes:
+        content = self._get_cached(file_id)
+        if content is not None:
+            return content
+        with self._cond:
+            if file_id in self._in_flight:
+                self._joined.add(file_id)
+                self.hits += 1
+            else:
+                self.misses += 1
+        return self.flight.do(("get", file_id), lambda: self._storage.get(file_id))
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        content = self._get_cached(file_id)
+        if content is not None:
+            return content[:size]
+        return self._storage.read_head(file_id, size)
+
+    def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
+        return self._storage.get_path(file_id, params)
+
+    def exists(self, file_id: UUID) -> bool:
+        with self._cond:
+            if file_id in self._entries:
+                return True
+        return self._storage.exists(file_id)
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        return self._storage.get_mimetype(file_id)
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        return self._storage.stat(file_id, with_tags=with_tags)
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        return self._storage.get_checksum(file_id)
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        return self._storage.open_file(file_id)
+
+    def store(
+        self,
+        content: bytes,
+        content_type: Optional[str] = None,
+        tags: Optional[dict] = None,
+        override_id: Optional[UUID] = None,
+        cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> UUID:
+        file_id = self._storage.store(
+            content,
+            content_type=content_type,
+            tags=tags,
+            override_id=override_id,
+            cache_control=cache_control,
+            ttl=ttl,
+        )
+        self._invalidate(file_id)
+        return file_id
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file by the underlying storage, e.g. server-side."""
+        local = destination is None or destination is self
+        copied_id = self._storage.copy(
+            src_id,
+            dst_id,
+            tags,
+            cache_control,
+            destination=self._storage if local else destination,
+        )
+        if local:
+            self._invalidate(copied_id)
+        return copied_id
+
+    def delete(self, file_id: UUID, silent: bool = False):
+        try:
+            self._storage.delete(file_id, silent)
+        finally:
+            self._invalidate(file_id)
+
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        file_ids = list(file_ids)
+        try:
+            self._storage.delete_many(file_ids, workers)
+        finally:
+            for file_id in file_ids:
+                self._invalidate(file_id)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        purged = self._storage.purge_expired(now)
+        if purged:
+            # purged ids are not known
+            self._clear_cache()
+        return purged
+
+    def usage(self) -> Usage:
+        return self._storage.usage()
+
+    def flush_usage(self):
+        self._storage.flush_usage()
+
+    def count(self) -> int:
+        return self._storage.count()
+
+    def list(self) -> Iterable[str]:
+        return self._storage.list()
+
+    def clean(self):
+        self._storage.clean()
+        self.cancel()
+        self._clear_cache()
+
+    def __repr__(self) -> str:
+        return "PrefetchingStorage {!r}".format(self._storage)
@@ -1,21 +1,143 @@
+# pylint: disable=too-many-lines
+import base64
 import datetime
+import hashlib
+import itertools
+import json
 import logging
-from typing import Iterable, Optional
+import os
+import secrets
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterable, List, Optional, Tuple
 from uuid import UUID, uuid4
 
 import boto3
-from botocore.exceptions import IncompleteReadError
+from botocore.exceptions import (
+    ClientError,
+    ConnectionClosedError,
+    ConnectTimeoutError,
+    IncompleteReadError,
+    ReadTimeoutError,
+)
 
 from .exceptions import StorageError, StorageNotFoundError
-from .storage import Storage
+from .hedging import Cancelled, Hedger
+from .limiter import AdaptiveLimiter
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+from .utils import backoff_delay, bounded_map, expiry_bucket, new_hasher
 
+HEX_DIGITS = "0123456789abcdef"
 
-class S3Storage(Storage):
+# key layouts: `<database>/<hex>` and `<database>/<hashed sub-prefix>/<hex>`
+KEY_LAYOUT_FLAT = 1
+KEY_LAYOUT_HASHED = 2
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    LIST_WORKERS = 16
+    LIST_MAX_DEPTH = 2
+    LIST_PAGE_SIZE = 1000
+    GET_ATTEMPTS = 5
+    RETRY_BASE_DELAY = 0.1
+    RETRY_MAX_DELAY = 5.0
+    PART_SIZE = 8 * 1024 * 1024
+    DOWNLOAD_WORKERS = 8
+    READ_CHUNK_SIZE = 1024 * 1024
+    USAGE_CACHE_TTL = 10.0
+    USAGE_RECONCILE_INTERVAL = 3600.0
+    USAGE_FLUSH_INTERVAL = 60.0
+    KEY_FANOUT = 256
+    LIMITER_WAIT_TIMEOUT = 30.0
+    HEDGE_BUDGET = 0.05
+    # larger objects cannot be copied by a single CopyObject request
+    MAX_COPY_OBJECT_SIZE = 5 * 1024 * 1024 * 1024
+    COPY_PART_SIZE = 512 * 1024 * 1024
+    COPY_WORKERS = 8
+    MAX_PARTS = 10000
+    # maximum count of keys deleted by one DeleteObjects request
+    DELETE_BATCH_SIZE = 1000
+
+
+# checksum algorithms that S3 can verify on upload
+S3_CHECKSUM_ALGORITHMS = {"sha256": "SHA256", "sha1": "SHA1"}
+
+CHECKSUM_METADATA = "sfr-checksum"
+# an hourly expiry bucket of an object stored with a TTL
+EXPIRY_METADATA = "sfr-expires"
+
+# errors of reading a response body that are worth a retry
+RETRIABLE_READ_ERRORS = (IncompleteReadError, ReadTimeoutError, ConnectionClosedError)
+
+# error codes of S3 and compatible services asking to slow down
+THROTTLING_ERROR_CODES = {
+    "SlowDown",
+    "Throttling",
+    "ThrottlingException",
+    "RequestLimitExceeded",
+    "RequestThrottled",
+    "TooManyRequests",
+    "ServiceUnavailable",
+}
+
+
+def is_throttling_error(e: Exception) -> bool:
+    """Tell if an error of an S3 request means that the service is overloaded."""
+    if isinstance(e, (ReadTimeoutError, ConnectTimeoutError)):
+        return True
+    if isinstance(e, ClientError):
+        code = e.response.get("Error", {}).get("Code")
+        status = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode")
+        return code in THROTTLING_ERROR_CODES or status in (429, 503)
+    return False
+
+
+class LimitedBody:
+    """A streaming response body holding a limiter slot until read or closed."""
+
+    def __init__(self, body, limiter: AdaptiveLimiter, token: int):
+        self._body = body
+        self._limiter = limiter
+        self._token = token
+        self._released = False
+        self._lock = threading.Lock()
+
+    def _release(self, throttled: bool = False):
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        self._limiter.release(self._token, throttled=throttled)
+
+    def read(self, size: int = -1) -> bytes:
+        try:
+            data = self._body.read(size)
+        except Exception as e:
+            self._release(throttled=is_throttling_error(e))
+            raise
+        if not data or size < 0:
+            # the whole body is read
+            self._release()
+        return data
+
+    def close(self):
+        try:
+            self._body.close()
+        finally:
+            self._release()
+
+
+class S3Storage(Storage):  # pylint: disable=too-many-public-methods
     """S3-based storage"""
 
     logger = logging.getLogger("S3Storage")
 
-    def __init__(
+    # arguments are counted as locals
+    def __init__(  # pylint: disable=too-many-locals
         self,
         database: str,
         bucket: str,
@@ -25,6 +147,20 @@ class S3Storage(Storage):
         endpoint_url: Optional[str] = None,
         default_cache_control: Optional[str] = None,
         config=None,
+        list_workers: int = DefaultParams.LIST_WORKERS,
+        list_max_depth: int = DefaultParams.LIST_MAX_DEPTH,
+        checksum_algorithm: Optional[str] = None,
+        track_usage: bool = False,
+        usage_reconcile_interval: float = DefaultParams.USAGE_RECONCILE_INTERVAL,
+        key_layout: int = KEY_LAYOUT_FLAT,
+        key_fanout: int = DefaultParams.KEY_FANOUT,
+        fallback_key_layout: Optional[int] = None,
+        adaptive_concurrency: bool = False,
+        limiter_wait_timeout: Optional[float] = DefaultParams.LIMITER_WAIT_TIMEOUT,
+        hedge_percentile: Optional[float] = None,
+        hedge_budget: float = DefaultParams.HEDGE_BUDGET,
+        s3_client=None,
+        usage_writer: Optional[str] = None,
     ):
         """Initialize a photo storages.
 
@@ -37,6 +173,118 @@ class S3Storage(Storage):
         :param default_cache_control: optional default cache control for operations.
           It will be passed to `CacheControl` field in S3 calls.
         :param config: a botocore config
+        :param list_workers: count of threads listing key prefixes in parallel
+        :param list_max_depth: maximum length of hex prefix shards
+          that a large listing is split to
+        :param checksum_algorithm: if set, a checksum of each stored file is
+          computed with this algorithm (e.g. `sha256`) and saved to object metadata.
+          For `sha256` and `sha1` S3 also verifies it on upload.
+        :param track_usage: maintain :meth:`usage` as a summary object reconciled
+          by a full listing every `usage_reconcile_interval` seconds plus
+          in-process changes since then, instead of listing the whole database
+        :param usage_reconcile_interval: seconds between usage reconciliations
+        :param key_layout: `KEY_LAYOUT_FLAT` stores objects as `<database>/<hex>`,
+          `KEY_LAYOUT_HASHED` spreads them over `key_fanout` sub-prefixes
+          `<database>/<xx>/<hex>`, so request rate limits of S3 per prefix
+          are not hit by write bursts
+        :param key_fanout: count of hashed sub-prefixes, from 2 to 4096
+        :param fallback_key_layout: a previous layout to read objects from
+          until they are moved by :meth:`migrate_key_layout`
+        :param adaptive_concurrency: pass all requests through an AIMD concurrency
+          limiter shared by storages of the bucket in this process. It shrinks
+          on throttling errors and timeouts and grows on successes.
+          See `limiter` for its current limit and queue depth. A slot is held
+          until a response body is read, a handle of :meth:`open_file` holds
+          it until closed.
+        :param limiter_wait_timeout: maximum seconds a request waits for the
+          limiter before failing with `StorageThrottledError`, `0` to fail fast
+        :param hedge_percentile: if set, a GET or HEAD request that has not
+          completed within this percentile of recent latencies is sent again
+          and the first response is taken, the other one stops reading its
+          body. Storages of a bucket share one `Hedger`, see it for counters.
+        :param hedge_budget: maximum share of hedged requests
+        :param s3_client: a boto3 S3 client shared with other storages,
+          connection parameters are ignored if set
+        :param usage_writer: a name of usage changes flushed by this instance,
+          random by default. A storage created again with the name of a dropped
+          one resumes its changes, so changes of a database are kept in one object.
+        """
+        if s3_client is None:
+            s3_client = self.create_client(
+                region, access_key_id, secret_access_key, endpoint_url, config
+            )
+        self.s3_client = s3_client
+
+        self.bucket = bucket
+        self.database = database
+        self.default_cache_control = default_cache_control
+        self.list_workers = list_workers
+        self.list_max_depth = list_max_depth
+        self.list_page_size = DefaultParams.LIST_PAGE_SIZE
+        self.checksum_algorithm = checksum_algorithm
+        if checksum_algorithm:
+            # fail early for unknown algorithms
+            new_hasher(checksum_algorithm)
+        self.track_usage = track_usage
+        self.usage_reconcile_interval = usage_reconcile_interval
+        self._usage_lock = threading.Lock()
+        # changes of this instance since the summary, saved by flush_usage
+        self._usage_delta = Usage()
+        self._usage_flushed_at = time.time()
+        self._usage_writer = usage_writer or secrets.token_hex(8)
+        # changes flushed by other instances
+        self._usage_others = Usage()
+        self._usage_summary = None
+        self._usage_loaded_at = 0.0
+        self._usage_reconciled_at = 0.0
+        self._usage_reconciling = False
+        self.get_attempts = DefaultParams.GET_ATTEMPTS
+        self.retry_base_delay = DefaultParams.RETRY_BASE_DELAY
+        self.retry_max_delay = DefaultParams.RETRY_MAX_DELAY
+
+        if not self.database or not self.database.strip() or "/" in self.database:
+            raise ValueError("Invalid database name " + self.database)
+        for layout in (key_layout, fallback_key_layout):
+            if layout not in (KEY_LAYOUT_FLAT, KEY_LAYOUT_HASHED, None):
+                raise ValueError("Invalid key layout " + str(layout))
+        if not 2 <= key_fanout <= 4096:
+            raise ValueError("Invalid key fanout " + str(key_fanout))
+        self.key_layout = key_layout
+        self.key_fanout = key_fanout
+        self.fallback_key_layout = (
+            fallback_key_layout if fallback_key_layout != key_layout else None
+        )
+        # hex digits of a hashed sub-prefix
+        self._fanout_width = len("{:x}".format(key_fanout - 1))
+        # keyed by the endpoint actually used, `endpoint_url` is ignored for
+        # a shared client
+        shared_key = "{} {}".format(self.s3_client.meta.endpoint_url, bucket)
+        self.hedger = None
+        if hedge_percentile is not None:
+            self.hedger = Hedger.shared(
+                shared_key,
+                percentile=hedge_percentile,
+                budget=hedge_budget,
+            )
+        self.limiter = None
+        if adaptive_concurrency:
+            self.limiter = AdaptiveLimiter.shared(
+                shared_key,
+                wait_timeout=limiter_wait_timeout,
+            )
+
+    @staticmethod
+    def create_client(
+        region: str,
+        access_key_id: str,
+        secret_access_key: str,
+        endpoint_url: Optional[str] = None,
+        config=None,
+    ):
+        """Create a boto3 S3 client, that can be shared by several storages.
+
+        Clients are thread-safe. A client holds a connection pool, so sharing
+        one saves connections and memory when there are many databases.
         """
         session = boto3.session.Session()
         client_args = dict(
@@ -48,48 +296,311 @@ class S3Storage(Storage):
         )
         if endpoint_url is not None:
             client_args["endpoint_url"] = endpoint_url
-        self.s3_client = session.client(**client_args)
+        return session.client(**client_args)
 
-        self.bucket = bucket
-        self.database = database
-        self.default_cache_control = default_cache_control
+    def _call(self, method: Callable, **kwargs):
+        """Make an S3 request, through the concurrency limiter if enabled."""
+        if self.limiter is None:
+            return method(**kwargs)
+        return self.limiter.call(lambda: method(**kwargs), is_throttling_error)
 
-        if not self.database or not self.database.strip() or "/" in self.database:
-            raise ValueError("Invalid database name " + self.database)
+    def _hedged(self, kind: str, fn: Callable[[Optional[threading.Event]], object]):
+        """Call a function making an idempotent request, hedged if enabled.
+
+        :param fn: a function of an event set when a hedged request is not needed
+        """
+        if self.hedger is None:
+            return fn(None)
+        return self.hedger.call(fn, kind)
+
+    def _get_body(self, cancelled: Optional[threading.Event] = None, **kwargs) -> bytes:
+        """Make a GET request and read its body in one limiter slot.
+
+        :param cancelled: an event to stop reading the body when set
+        """
+
+        def get_and_read(**args) -> bytes:
+            body = self.s3_client.get_object(**args)["Body"]
+            if cancelled is None:
+                return body.read()
+            chunks = []
+            try:
+                for chunk in body.iter_chunks(DefaultParams.READ_CHUNK_SIZE):
+                    if cancelled.is_set():
+                        raise Cancelled()
+                    chunks.append(chunk)
+            finally:
+                body.close()
+            return b"".join(chunks)
+
+        return self._call(get_and_read, **kwargs)
+
+    def _open_body(self, **kwargs) -> dict:
+        """Make a GET request with a body holding a limiter slot until closed."""
+        if self.limiter is None:
+            return self.s3_client.get_object(**kwargs)
+        token = self.limiter.acquire()
+        try:
+            response = self.s3_client.get_object(**kwargs)
+        except Exception as e:
+            self.limiter.release(token, throttled=is_throttling_error(e))
+            raise
+        response["Body"] = LimitedBody(response["Body"], self.limiter, token)
+        return response
 
     @staticmethod
     def _generate_file_id():
         file_id = uuid4()
         return file_id
 
-    def _get_key(self, file_id) -> str:
-        return self.database + "/" + file_id.hex
+    def _get_prefix(self) -> str:
+        return self.database + "/"
+
+    def _get_key(self, file_id, layout: Optional[int] = None) -> str:
+        if (layout or self.key_layout) == KEY_LAYOUT_HASHED:
+            digest = hashlib.blake2b(file_id.bytes, digest_size=4).digest()
+            return "{}{:0{}x}/{}".format(
+                self._get_prefix(),
+                int.from_bytes(digest, "big") % self.key_fanout,
+                self._fanout_width,
+                file_id.hex,
+            )
+        return self._get_prefix() + file_id.hex
+
+    def _get_keys(self, file_id) -> List[str]:
+        """Keys a file may be stored under, the current layout goes first."""
+        keys = [self._get_key(file_id)]
+        if self.fallback_key_layout:
+            keys.append(self._get_key(file_id, self.fallback_key_layout))
+        return keys
+
+    def _with_fallback(self, file_id: UUID, operation: Callable[[str], object]):
+        """Call an operation with a file key, retry with the fallback layout key.
+
+        :param operation: a function of a key raising `StorageNotFoundError`
+        """
+        keys = self._get_keys(file_id)
+        for key in keys[:-1]:
+            try:
+                return operation(key)
+            except StorageNotFoundError:
+                continue
+        return operation(keys[-1])
 
     def is_local(self) -> bool:
         return False
 
+    def _read_object(
+        self,
+        key: str,
+        byte_range: Optional[Tuple[int, int]] = None,
+        etag: Optional[str] = None,
+    ) -> bytes:
+        """Read an object or its byte range with retries.
+
+        botocore does not retry errors of reading a body, so retry them here
+        with exponential backoff.
+
+        :param key: an object key
+        :param byte_range: an inclusive range of bytes to read
+        :param etag: fail if the object has changed
+        """
+        args = dict(Bucket=self.bucket, Key=key)
+        if byte_range:
+            args["Range"] = "bytes={}-{}".format(*byte_range)
+        if etag:
+            args["IfMatch"] = etag
+        for attempt in range(self.get_attempts):
+            try:
+                body = self._hedged(
+                    "get", lambda cancelled: self._get_body(cancelled, **args)
+                )
+                if byte_range and len(body) != byte_range[1] - byte_range[0] + 1:
+                    raise IncompleteReadError(
+                        actual_bytes=len(body),
+                        expected_bytes=byte_range[1] - byte_range[0] + 1,
+                    )
+                return body
+            except RETRIABLE_READ_ERRORS as e:
+                if attempt + 1 >= self.get_attempts:
+                    raise StorageError(
+                        "Cannot get {} due to read errors".format(key)
+                    ) from e
+                delay = backoff_delay(
+                    attempt, self.retry_base_delay, self.retry_max_delay
+                )
+                self.logger.info(
+                    "Got %s %s, retry #%d in %.2f s",
+                    type(e).__name__,
+                    str(e),
+                    attempt,
+                    delay,
+                )
+                time.sleep(delay)
+        raise StorageError("Cannot get {} due to read errors".format(key))
+
     def get(self, file_id: UUID) -> bytes:
-        key = self._get_key(file_id)
+        def read(key: str) -> bytes:
+            try:
+                return self._read_object(key)
+            except self.s3_client.exceptions.NoSuchKey:
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("File {} does not exist".format(file_id))
+            except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+                raise StorageError(e) from e
+
+        return self._with_fallback(file_id, read)
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        """Open a streaming body of a file with a single GET request."""
+
+        def open_key(key: str) -> FileHandle:
+            try:
+                response = self._open_body(Bucket=self.bucket, Key=key)
+                return FileHandle(
+                    response["Body"],
+                    response["ContentLength"],
+                    response.get("ContentType") or "application/octet-stream",
+                )
+            except self.s3_client.exceptions.NoSuchKey:
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("File {} does not exist".format(file_id))
+            except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+                raise StorageError(e) from e
+
+        return self._with_fallback(file_id, open_key)
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        """Read first bytes of a file with a ranged GET request."""
+        if size <= 0:
+            # there is no range of no bytes
+            return b""
+
+        def read(key: str) -> bytes:
+            try:
+                return self._hedged(
+                    "get",
+                    lambda cancelled: self._get_body(
+                        cancelled,
+                        Bucket=self.bucket,
+                        Key=key,
+                        Range="bytes=0-{}".format(size - 1),
+                    ),
+                )
+            except self.s3_client.exceptions.NoSuchKey:
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("File {} does not exist".format(file_id))
+            except self.s3_client.exceptions.ClientError as e:
+                if e.response["ResponseMetadata"]["HTTPStatusCode"] == 416:
+                    # an empty object has no satisfiable range
+                    return b""
+                raise StorageError(e) from e  # pragma: no cover
+
+        return self._with_fallback(file_id, read)
+
+    def _download_parts(
+        self,
+        file_id: UUID,
+        size_callback: Callable[[int], None],
+        part_callback: Callable[[int, bytes], None],
+        part_size: int,
+        workers: int,
+    ):
+        key, response = self._head_object(file_id)
         try:
-            # make retries because botocore does not
-            for attempt in range(5):
-                try:
-                    response = self.s3_client.get_object(Bucket=self.bucket, Key=key)
-                    body = response["Body"].read()
-                    return body
-                except IncompleteReadError as e:
-                    self.logger.info(
-                        "Got IncompleteReadError %s, retry #%d", str(e), attempt
-                    )
-            raise StorageError("Cannot get file due to IncompleteReadError")
-        except self.s3_client.exceptions.NoSuchKey:
-            # pylint: disable=raise-missing-from
-            raise StorageNotFoundError("File {} does not exist".format(file_id))
-        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            size = response["ContentLength"]
+            size_callback(size)
+            ranges = [
+                (start, min(start + part_size, size) - 1)
+                for start in range(0, size, part_size)
+            ]
+
+            def fetch(byte_range: Tuple[int, int]):
+                part_callback(
+                    byte_range[0],
+                    self._read_object(key, byte_range, etag=response.get("ETag")),
+                )
+
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(fetch, ranges))
+        except self.s3_client.exceptions.ClientError as e:
+            if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("File {} does not exist".format(file_id))
             raise StorageError(e) from e
 
+    def get_ranged(
+        self,
+        file_id: UUID,
+        part_size: int = DefaultParams.PART_SIZE,
+        workers: int = DefaultParams.DOWNLOAD_WORKERS,
+    ) -> bytearray:
+        """Retrieve a large file by concurrent ranged requests.
+
+        Parts are assembled into a preallocated buffer. Each part is retried
+        separately, so a broken connection does not restart the whole download.
+
+        :param file_id: a file id
+        :param part_size: size of a part in bytes
+        :param workers: count of concurrent requests
+        :return: file content
+        """
+        buffers = []
+
+        def allocate(size: int):
+            buffers.append(bytearray(size))
+
+        def assemble(offset: int, data: bytes):
+            end = offset + len(data)
+            buffers[0][offset:end] = data
+
+        self._download_parts(file_id, allocate, assemble, part_size, workers)
+        return buffers[0]
+
+    def download(
+        self,
+        file_id: UUID,
+        path: str,
+        part_size: int = DefaultParams.PART_SIZE,
+        workers: int = DefaultParams.DOWNLOAD_WORKERS,
+    ):
+        """Download a large file to a local path by concurrent ranged requests.
+
+        Parts are written directly to their offsets in a temporary file next
+        to the target, which replaces the target once all parts are written.
+        A failed download leaves the target untouched.
+
+        :param file_id: a file id
+        :param path: a target path
+        :param part_size: size of a part in bytes
+        :param workers: count of concurrent requests
+        """
+        tmp_path = "{}.{}.tmp".format(path, secrets.token_hex(8))
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+        try:
+            try:
+                self._download_parts(
+                    file_id,
+                    lambda size: os.ftruncate(fd, size),
+                    lambda offset, data: os.pwrite(fd, data, offset),
+                    part_size,
+                    workers,
+                )
+            finally:
+                os.close(fd)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
     def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
         key = self._get_key(file_id)
+        if self.fallback_key_layout:
+            # a presigned URL cannot fall back, so find the key now
+            try:
+                key, _ = self._head_object(file_id)
+            except StorageNotFoundError:
+                pass
         expires_sec = int(datetime.timedelta(hours=24).total_seconds())
         effective_params = {"Bucket": self.bucket, "Key": key}
         if params:
@@ -100,17 +611,64 @@ class S3Storage(Storage):
         # self.logger.debug("Presigned url {}".format(url))
         return url
 
-    def exists(self, file_id: UUID) -> bool:
-        key = self._get_key(file_id)
+    def _head_object_with_key(self, key: str) -> Tuple[str, dict]:
         try:
-            self.s3_client.head_object(Bucket=self.bucket, Key=key)
-            return True
+            return key, self._hedged(
+                "head",
+                lambda _: self._call(
+                    self.s3_client.head_object, Bucket=self.bucket, Key=key
+                ),
+            )
         except self.s3_client.exceptions.ClientError as e:
             # boto3 HEAD will not throw NoSuchKey but a generic 404 error
             if e.response["ResponseMetadata"]["HTTPStatusCode"] == 404:
-                return False
+                # pylint: disable=raise-missing-from
+                raise StorageNotFoundError("Key {} does not exist".format(key))
             raise StorageError(e) from e
 
+    def _head_object(self, file_id: UUID) -> Tuple[str, dict]:
+        """Make a HEAD request for a file.
+
+        :return: a tuple of an object key and a response
+        """
+        try:
+            return self._with_fallback(file_id, self._head_object_with_key)
+        except StorageNotFoundError:
+            # pylint: disable=raise-missing-from
+            raise StorageNotFoundError("File {} does not exist".format(file_id))
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        """Retrieve file metadata with a single HEAD request.
+
+        Tags are not returned by HEAD, so `with_tags` costs an extra request.
+        """
+        key, response = self._head_object(file_id)
+        try:
+            tags = self._get_tags(key) if with_tags else None
+            last_modified = response.get("LastModified")
+            return FileStat(
+                file_id,
+                size=response["ContentLength"],
+                content_type=response.get("ContentType") or "application/octet-stream",
+                mtime=last_modified.timestamp() if last_modified else None,
+                etag=response.get("ETag"),
+                cache_control=response.get("CacheControl"),
+                tags=tags,
+            )
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        _, response = self._head_object(file_id)
+        return response.get("Metadata", {}).get(CHECKSUM_METADATA)
+
+    def exists(self, file_id: UUID) -> bool:
+        try:
+            self.stat(file_id)
+            return True
+        except StorageNotFoundError:
+            return False
+
     def store(
         self,
         content: bytes,
@@ -118,63 +676,651 @@ class S3Storage(Storage):
         tags: Optional[dict] = None,
         override_id: Optional[UUID] = None,
         cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
     ) -> UUID:
         file_id = override_id if override_id else self._generate_file_id()
         key = self._get_key(file_id)
+        bucket = expiry_bucket(ttl) if ttl is not None else None
         try:
-            client_args = dict(Bucket=self.bucket, Key=key, Body=content)
-            if tags:
-                tag_str = "&".join("{}={}".format(k, v) for k, v in tags.items())
-                client_args["Tagging"] = tag_str
-            if content_type:
-                client_args["ContentType"] = content_type
-            if cache_control is not None:
-                client_args["CacheControl"] = cache_control
-            elif self.default_cache_control is not None:
-                client_args["CacheControl"] = self.default_cache_control
-            self.s3_client.put_object(**client_args)
+            client_args = self._put_args(
+                key, content, content_type, tags, cache_control
+            )
+            if bucket:
+                client_args["Metadata"][EXPIRY_METADATA] = bucket
+            self._call(self.s3_client.put_object, **client_args)
+            if self.track_usage:
+                self._add_usage([len(content)])
+            if bucket:
+                # recorded once stored, so a failed store touches no index
+                self._expire_or_delete(file_id, bucket)
             return file_id
         except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
             raise StorageError(e) from e
 
+    def _put_args(
+        self,
+        key: str,
+        content: bytes,
+        content_type: Optional[str],
+        tags: Optional[dict],
+        cache_control: Optional[str],
+    ) -> dict:
+        client_args = dict(Bucket=self.bucket, Key=key, Body=content, Metadata={})
+        if tags:
+            client_args["Tagging"] = self._format_tags(tags)
+        if content_type:
+            client_args["ContentType"] = content_type
+        if cache_control is not None:
+            client_args["CacheControl"] = cache_control
+        elif self.default_cache_control is not None:
+            client_args["CacheControl"] = self.default_cache_control
+        if self.checksum_algorithm:
+            self._add_checksum_args(client_args, content)
+        return client_args
+
+    def _add_checksum_args(self, client_args: dict, content: bytes):
+        hasher = new_hasher(self.checksum_algorithm)
+        hasher.update(content)
+        client_args["Metadata"][CHECKSUM_METADATA] = "{}:{}".format(
+            self.checksum_algorithm, hasher.hexdigest()
+        )
+        if self.checksum_algorithm in S3_CHECKSUM_ALGORITHMS:
+            # S3 verifies the digest, so the content is not hashed again by botocore
+            argument = "Checksum" + S3_CHECKSUM_ALGORITHMS[self.checksum_algorithm]
+            client_args[argument] = base64.b64encode(hasher.digest()).decode("ascii")
+
+    @staticmethod
+    def _format_tags(tags: dict) -> str:
+        return "&".join("{}={}".format(k, v) for k, v in tags.items())
+
+    def _get_tags(self, key: str) -> dict:
+        tagging = self._call(
+            self.s3_client.get_object_tagging, Bucket=self.bucket, Key=key
+        )
+        return {tag["Key"]: tag["Value"] for tag in tagging["TagSet"]}
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file by server-side requests without downloading it.
+
+        Objects up to 5 GiB are copied by a `CopyObject` request, larger ones
+        by a multipart upload of `UploadPartCopy` parts. A destination
+        `S3Storage` of the same endpoint, possibly of another database or
+        bucket, is copied to server-side as well, its credentials must allow
+        reading the source. Other destinations fall back to a generic copy.
+        Copies are stored without a TTL.
+        """
+        destination = destination if destination is not None else self
+        same_endpoint = isinstance(destination, S3Storage) and (
+            destination.s3_client.meta.endpoint_url == self.s3_client.meta.endpoint_url
+        )
+        if not same_endpoint:
+            return super().copy(src_id, dst_id, tags, cache_control, destination)
+        key, response = self._head_object(src_id)
+        dst_id = dst_id if dst_id else self._generate_file_id()
+        source = {"Bucket": self.bucket, "Key": key}
+        size = response["ContentLength"]
+        try:
+            # pylint: disable=protected-access
+            if size > DefaultParams.MAX_COPY_OBJECT_SIZE:
+                if tags is None:
+                    tags = self._get_tags(key)
+                destination._copy_multipart(
+                    source, dst_id, response, tags, cache_control
+                )
+            else:
+                destination._copy_object(source, dst_id, response, tags, cache_control)
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+        if destination.track_usage:
+            # pylint: disable=protected-access
+            destination._add_usage([size])
+        return dst_id
+
+    def _copy_object(
+        self,
+        source: dict,
+        dst_id: UUID,
+        response: dict,
+        tags: Optional[dict],
+        cache_control: Optional[str],
+    ):
+        client_args = dict(
+            Bucket=self.bucket, Key=self._get_key(dst_id), CopySource=source
+        )
+        if cache_control is None and EXPIRY_METADATA not in response.get(
+            "Metadata", {}
+        ):
+            client_args["MetadataDirective"] = "COPY"
+        else:
+            # metadata can only be copied or replaced as a whole
+            client_args.update(
+                MetadataDirective="REPLACE",
+                ContentType=response.get("ContentType") or "application/octet-stream",
+                Metadata=self._copied_metadata(response),
+            )
+            if cache_control is None:
+                cache_control = response.get("CacheControl")
+            if cache_control is not None:
+                client_args["CacheControl"] = cache_control
+        if tags is None:
+            client_args["TaggingDirective"] = "COPY"
+        else:
+            client_args.update(
+                TaggingDirective="REPLACE", Tagging=self._format_tags(tags)
+            )
+        self._call(self.s3_client.copy_object, **client_args)
+
+    @staticmethod
+    def _copied_metadata(response: dict) -> dict:
+        # copies are stored without a TTL, their expiry is not carried over
+        metadata = dict(response.get("Metadata", {}))
+        metadata.pop(EXPIRY_METADATA, None)
+        return metadata
+
+    def _copy_multipart(
+        self,
+        source: dict,
+        dst_id: UUID,
+        response: dict,
+        tags: dict,
+        cache_control: Optional[str],
+    ):
+        key = self._get_key(dst_id)
+        size = response["ContentLength"]
+        client_args = dict(
+            Bucket=self.bucket,
+            Key=key,
+            ContentType=response.get("ContentType") or "application/octet-stream",
+            Metadata=self._copied_metadata(response),
+        )
+        if cache_control is None:
+            cache_control = response.get("CacheControl")
+        if cache_control is not None:
+            client_args["CacheControl"] = cache_control
+        if tags:
+            client_args["Tagging"] = self._format_tags(tags)
+        upload_id = self._call(self.s3_client.create_multipart_upload, **client_args)[
+            "UploadId"
+        ]
+        part_size = max(
+            DefaultParams.COPY_PART_SIZE, -(-size // DefaultParams.MAX_PARTS)
+        )
+
+        def copy_part(part: Tuple[int, int]) -> dict:
+            number, start = part
+            end = min(start + part_size, size) - 1
+            result = self._call(
+                self.s3_client.upload_part_copy,
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                PartNumber=number,
+                CopySource=source,
+                CopySourceRange="bytes={}-{}".format(start, end),
+            )
+            return {"ETag": result["CopyPartResult"]["ETag"], "PartNumber": number}
+
+        try:
+            with ThreadPoolExecutor(max_workers=DefaultParams.COPY_WORKERS) as executor:
+                parts = list(
+                    executor.map(
+                        copy_part, enumerate(range(0, size, part_size), start=1)
+                    )
+                )
+            self._call(
+                self.s3_client.complete_multipart_upload,
+                Bucket=self.bucket,
+                Key=key,
+                UploadId=upload_id,
+                MultipartUpload={"Parts": parts},
+            )
+        except BaseException:
+            try:
+                self._call(
+                    self.s3_client.abort_multipart_upload,
+                    Bucket=self.bucket,
+                    Key=key,
+                    UploadId=upload_id,
+                )
+            except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+                self.logger.warning("Cannot abort upload %s: %s", upload_id, str(e))
+            raise
+
     def delete(self, file_id: UUID, silent: bool = False):
-        key = self._get_key(file_id)
+        size = None
+        if self.track_usage:
+            try:
+                size = self.stat(file_id).size
+            except StorageNotFoundError:
+                if not silent:
+                    raise
         # must throw an error if no key found
-        if not silent and not self.exists(file_id):
+        elif not silent and not self.exists(file_id):
             raise StorageNotFoundError("File {} does not exist".format(file_id))
         # now delete (will not throw error if no such key)
         try:
-            self.s3_client.delete_object(Bucket=self.bucket, Key=key)
+            for key in self._get_keys(file_id):
+                self._call(self.s3_client.delete_object, Bucket=self.bucket, Key=key)
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+        if size is not None:
+            self._add_usage([size], -1)
+
+    def _delete_keys(self, keys: List[str]):
+        size = DefaultParams.DELETE_BATCH_SIZE
+        while keys:
+            batch, keys = keys[:size], keys[size:]
+            response = self._call(
+                self.s3_client.delete_objects,
+                Bucket=self.bucket,
+                Delete={"Objects": [{"Key": key} for key in batch], "Quiet": True},
+            )
+            errors = response.get("Errors")
+            if errors:
+                raise StorageError(
+                    "Cannot delete {}: {}".format(
+                        errors[0]["Key"], errors[0]["Message"]
+                    )
+                )
+
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        """Delete several files by `DeleteObjects` requests of up to 1000 keys."""
+        file_ids = list(file_ids)
+        sizes = []
+        if self.track_usage:
+            stats = self.stat_many(file_ids, workers=workers)
+            sizes = [stat.size for stat in stats if stat]
+        self._delete_files(file_ids, sizes)
+
+    def _delete_files(self, file_ids: List[UUID], sizes: List[int]):
+        """Delete files of known sizes by `DeleteObjects` requests."""
+        try:
+            self._delete_keys(
+                [key for file_id in file_ids for key in self._get_keys(file_id)]
+            )
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+        if self.track_usage:
+            self._add_usage(sizes, -1)
+
+    def _get_expiry_prefix(self) -> str:
+        return "_sfr/expiry/{}/".format(self.database)
+
+    def _expire_or_delete(self, file_id: UUID, bucket: str):
+        """Put an expiry marker of a stored object, delete the object if that fails."""
+        marker = "{}{}/{}".format(self._get_expiry_prefix(), bucket, file_id.hex)
+        try:
+            self._call(
+                self.s3_client.put_object, Bucket=self.bucket, Key=marker, Body=b""
+            )
+        except BaseException:
+            self.delete(file_id, silent=True)
+            raise
+
+    def _list_keys(self, prefix: str, delimiter: Optional[str] = None) -> Iterable[str]:
+        args = dict(Bucket=self.bucket, Prefix=prefix, MaxKeys=self.list_page_size)
+        if delimiter:
+            args["Delimiter"] = delimiter
+        while True:
+            page = self._call(self.s3_client.list_objects_v2, **args)
+            for common_prefix in page.get("CommonPrefixes", []):
+                yield common_prefix["Prefix"]
+            for content in page.get("Contents", []):
+                yield content["Key"]
+            if not page.get("IsTruncated"):
+                return
+            args["ContinuationToken"] = page["NextContinuationToken"]
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Delete expired objects indexed by empty marker objects.
+
+        Markers are keyed `_sfr/expiry/<database>/<hour>/<hex>`, so a purge
+        lists only the markers of past hours. An object is deleted only if its
+        metadata names the hour of the marker, so a marker of a deleted object
+        does not purge an object stored again under the same id. Objects and
+        markers are deleted by `DeleteObjects` requests. Deletes are
+        idempotent, so concurrent purges are safe but may repeat work.
+        """
+        prefix = self._get_expiry_prefix()
+        current = prefix + expiry_bucket(0, now) + "/"
+        purged = 0
+        try:
+            for bucket_prefix in list(self._list_keys(prefix, delimiter="/")):
+                if bucket_prefix >= current:
+                    break
+                bucket = bucket_prefix.split("/")[-2]
+                markers = []
+                for marker in self._list_keys(bucket_prefix):
+                    markers.append(marker)
+                    if len(markers) == DefaultParams.DELETE_BATCH_SIZE:
+                        purged += self._purge_markers(markers, bucket)
+                        markers = []
+                purged += self._purge_markers(markers, bucket)
         except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
             raise StorageError(e) from e
+        self.logger.info("Purged %d expired objects", purged)
+        return purged
+
+    def _expires_in(self, file_id: UUID, bucket: str) -> Optional[int]:
+        """Return a size of an object stored with a TTL recorded in an expiry bucket.
+
+        :return: `None` if the object is deleted or stored again without the TTL
+        """
+        try:
+            _, response = self._head_object(file_id)
+        except StorageNotFoundError:
+            return None
+        if response.get("Metadata", {}).get(EXPIRY_METADATA) != bucket:
+            return None
+        return response["ContentLength"]
+
+    def _purge_markers(self, markers: List[str], bucket: str) -> int:
+        file_ids = []
+        for marker in markers:
+            try:
+                file_ids.append(UUID(hex=marker.split("/")[-1]))
+            except ValueError:
+                self.logger.warning("Invalid expiry marker %s", marker)
+        with ThreadPoolExecutor(max_workers=self.list_workers) as executor:
+            sizes = list(
+                executor.map(
+                    lambda file_id: self._expires_in(file_id, bucket), file_ids
+                )
+            )
+        expired = [
+            file_id for file_id, size in zip(file_ids, sizes) if size is not None
+        ]
+        self._delete_files(expired, [size for size in sizes if size is not None])
+        # markers go last, so an interrupted purge is repeated
+        self._delete_keys(markers)
+        return len(expired)
 
     def get_mimetype(self, file_id: UUID) -> str:
-        key = self._get_key(file_id)
+        return self.stat(file_id).content_type
+
+    def _list_shard(self, prefix: str, mapper: Callable[[List[dict]], object]):
+        """List keys by a hex prefix shard.
+
+        If a shard is large and not too deep, it is not listed
+        but split to 16 child shards.
+
+        :return: a tuple of mapped pages and child shards
+        """
+        depth = len(prefix) - len(self._get_prefix())
+        max_depth = self.list_max_depth
+        if KEY_LAYOUT_HASHED in (self.key_layout, self.fallback_key_layout):
+            # deeper shards would not match the slash after a hashed sub-prefix
+            max_depth = min(max_depth, self._fanout_width)
+        args = dict(Bucket=self.bucket, Prefix=prefix, MaxKeys=self.list_page_size)
+        results = []
+        while True:
+            page = self._call(self.s3_client.list_objects_v2, **args)
+            if page.get("IsTruncated") and not results and depth < max_depth:
+                return [], [prefix + char for char in HEX_DIGITS]
+            results.append(mapper(page.get("Contents", [])))
+            if not page.get("IsTruncated"):
+                return results, []
+            args["ContinuationToken"] = page["NextContinuationToken"]
+
+    def _list_sharded(self, mapper: Callable[[List[dict]], object]) -> Iterable:
+        """List all keys of a database with hex prefix shards in parallel.
+
+        :param mapper: a function applied to each page of listed objects
+        :return: mapped pages in arbitrary order
+        """
+        shards = (self._get_prefix() + char for char in HEX_DIGITS)
+        executor = ThreadPoolExecutor(max_workers=self.list_workers)
         try:
-            response = self.s3_client.head_object(Bucket=self.bucket, Key=key)
-            content_type = response.get("ContentType", None)
-            if content_type is None:
-                content_type = "application/octet-stream"
-            return content_type
+            pending = {
+                executor.submit(self._list_shard, shard, mapper) for shard in shards
+            }
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results, children = future.result()
+                    for child in children:
+                        pending.add(executor.submit(self._list_shard, child, mapper))
+                    yield from results
         except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
             raise StorageError(e) from e
+        finally:
+            executor.shutdown(wait=True, cancel_futures=True)
 
     def count(self) -> int:
-        paginator = self.s3_client.get_paginator("list_objects_v2")
-        keys_count = sum(
-            (
-                page["KeyCount"]
-                for page in paginator.paginate(Bucket=self.bucket, Prefix=self.database)
+        return sum(self._list_sharded(len))
+
+    def list(self) -> Iterable[str]:
+        for names in self._list_sharded(
+            lambda contents: [content["Key"].split("/")[-1] for content in contents]
+        ):
+            yield from names
+
+    def migrate_key_layout(self, workers: int = DefaultParams.LIST_WORKERS) -> int:
+        """Move objects stored with other key layouts to the current layout.
+
+        An object is copied to its new key and then deleted, so set
+        `fallback_key_layout` to keep objects readable during a migration.
+
+        :param workers: count of concurrent copy requests
+        :return: count of moved objects
+        """
+
+        def move(content: Tuple[str, int]) -> int:
+            key, size = content
+            try:
+                file_id = UUID(hex=key.split("/")[-1])
+            except ValueError:
+                return 0
+            if key == self._get_key(file_id):
+                return 0
+            source = {"Bucket": self.bucket, "Key": key}
+            try:
+                if size > DefaultParams.MAX_COPY_OBJECT_SIZE:
+                    _, response = self._head_object_with_key(key)
+                    self._copy_multipart(
+                        source, file_id, response, self._get_tags(key), None
+                    )
+                else:
+                    self._copy_object(source, file_id, {}, None, None)
+                self._call(self.s3_client.delete_object, Bucket=self.bucket, Key=key)
+            except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+                raise StorageError(e) from e
+            return 1
+
+        keys = itertools.chain.from_iterable(
+            self._list_sharded(
+                lambda contents: [
+                    (content["Key"], content["Size"]) for content in contents
+                ]
             )
         )
-        return keys_count
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            moved = sum(bounded_map(executor, move, keys, workers * 4))
+        self.logger.info("Moved %d objects to key layout %d", moved, self.key_layout)
+        return moved
 
-    def list(self) -> Iterable[str]:
-        paginator = self.s3_client.get_paginator("list_objects_v2")
-        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.database):
-            yield from (
-                content["Key"].split("/")[-1] for content in page.get("Contents", [])
+    def _scan_usage(self) -> Usage:
+        return Usage.from_sizes(
+            size
+            for sizes in self._list_sharded(
+                lambda contents: [content["Size"] for content in contents]
+            )
+            for size in sizes
+        )
+
+    def _get_usage_key(self) -> str:
+        return "_sfr/usage/{}.json".format(self.database)
+
+    def _get_usage_delta_prefix(self, reconciled_at: Optional[float] = None) -> str:
+        prefix = "_sfr/usage/{}/".format(self.database)
+        if reconciled_at is None:
+            return prefix
+        return "{}{:.6f}/".format(prefix, reconciled_at)
+
+    def _add_usage(self, sizes: Iterable[int], sign: int = 1):
+        with self._usage_lock:
+            for size in sizes:
+                self._usage_delta.add(size, sign)
+            elapsed = time.time() - self._usage_flushed_at
+        if elapsed > DefaultParams.USAGE_FLUSH_INTERVAL:
+            try:
+                self.flush_usage()
+            except StorageError as e:  # pragma: no cover
+                self.logger.warning("Cannot flush usage: %s", str(e))
+
+    def flush_usage(self):
+        """Save usage changes made by this instance to the bucket.
+
+        Changes are saved every minute on store and delete, so they are
+        counted by other processes and are not lost on a restart. Call it
+        before dropping a storage to save the rest.
+        """
+        if not self.track_usage:
+            return
+        if not self._usage_reconciled_at:
+            # changes are flushed next to the summary they are made after
+            self._load_usage_summary()
+        with self._usage_lock:
+            self._usage_flushed_at = time.time()
+            key = "{}{}.json".format(
+                self._get_usage_delta_prefix(self._usage_reconciled_at),
+                self._usage_writer,
+            )
+            body = json.dumps(self._usage_delta.to_dict())
+        try:
+            self._call(
+                self.s3_client.put_object,
+                Bucket=self.bucket,
+                Key=key,
+                Body=body,
+                ContentType="application/json",
+            )
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+
+    def reconcile_usage(self) -> Usage:
+        """Recompute usage by a full listing and save it to the summary object.
+
+        Flushed changes of older summaries are deleted.
+        """
+        with self._usage_lock:
+            # changes made during listing may be counted twice until next reconcile
+            self._usage_delta = Usage()
+            self._usage_others = Usage()
+        reconciled_at = time.time()
+        usage = self._scan_usage()
+        try:
+            self._call(
+                self.s3_client.put_object,
+                Bucket=self.bucket,
+                Key=self._get_usage_key(),
+                Body=json.dumps(dict(usage.to_dict(), reconciled_at=reconciled_at)),
+                ContentType="application/json",
             )
+            current = self._get_usage_delta_prefix(reconciled_at)
+            self._delete_keys(
+                [
+                    key
+                    for key in self._list_keys(self._get_usage_delta_prefix())
+                    if not key.startswith(current)
+                ]
+            )
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+        with self._usage_lock:
+            self._usage_summary = usage
+            self._usage_loaded_at = time.time()
+            self._usage_reconciled_at = reconciled_at
+        return usage
+
+    def _reconcile_usage_in_background(self):
+        try:
+            self.reconcile_usage()
+        except StorageError as e:  # pragma: no cover
+            self.logger.warning("Cannot reconcile usage: %s", str(e))
+        finally:
+            with self._usage_lock:
+                self._usage_reconciling = False
+
+    def _load_flushed_usage(
+        self, reconciled_at: float, with_own: bool
+    ) -> Tuple[Usage, Usage]:
+        """Load changes flushed by other writers and, if asked, by this one."""
+        own_key = "{}{}.json".format(
+            self._get_usage_delta_prefix(reconciled_at), self._usage_writer
+        )
+        others, own = Usage(), Usage()
+        for key in self._list_keys(self._get_usage_delta_prefix(reconciled_at)):
+            if key == own_key and not with_own:
+                continue
+            try:
+                data = self._get_body(Bucket=self.bucket, Key=key)
+            except self.s3_client.exceptions.NoSuchKey:  # pragma: no cover
+                # deleted by a reconcile
+                continue
+            if key == own_key:
+                own = Usage.from_dict(json.loads(data))
+            else:
+                others += Usage.from_dict(json.loads(data))
+        return others, own
+
+    def _load_usage_summary(self) -> bool:
+        try:
+            data = json.loads(
+                self._get_body(Bucket=self.bucket, Key=self._get_usage_key())
+            )
+            others, own = self._load_flushed_usage(
+                data["reconciled_at"], not self._usage_reconciled_at
+            )
+        except self.s3_client.exceptions.NoSuchKey:
+            return False
+        except self.s3_client.exceptions.ClientError as e:  # pragma: no cover
+            raise StorageError(e) from e
+        with self._usage_lock:
+            if not self._usage_reconciled_at:
+                # changes flushed under the name by a dropped instance are resumed
+                self._usage_delta += own
+                self._usage_reconciled_at = data["reconciled_at"]
+            elif data["reconciled_at"] > self._usage_reconciled_at:
+                # reconciled by another process, local changes are included
+                self._usage_delta = Usage()
+                self._usage_reconciled_at = data["reconciled_at"]
+            self._usage_summary = Usage.from_dict(data)
+            self._usage_others = others
+            self._usage_loaded_at = time.time()
+        return True
+
+    def usage(self) -> Usage:
+        """Returns object count, total size and a size histogram of storage.
+
+        If usage is tracked, returns a cached summary object with changes
+        flushed by other processes and made by this instance since last
+        reconciliation. A stale summary is reconciled in background. Changes
+        not flushed by other processes yet are missing, and changes made during
+        a reconciliation may be counted twice or lost until the next one.
+        Otherwise lists the whole database.
+        """
+        if not self.track_usage:
+            return self._scan_usage()
+        now = time.time()
+        if now - self._usage_loaded_at > DefaultParams.USAGE_CACHE_TTL:
+            if not self._load_usage_summary():
+                return self.reconcile_usage()
+        with self._usage_lock:
+            stale = now - self._usage_reconciled_at > self.usage_reconcile_interval
+            if stale and not self._usage_reconciling:
+                self._usage_reconciling = True
+                threading.Thread(
+                    target=self._reconcile_usage_in_background, daemon=True
+                ).start()
+            return self._usage_summary + self._usage_others + self._usage_delta
 
     def clean(self):
         # Do not ever try to clean bucket
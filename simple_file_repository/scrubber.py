@@ -0,0 +1,164 @@
+import logging
+import time
+from typing import Iterable, List, Optional
+from uuid import UUID
+
+from .exceptions import StorageError, StorageNotFoundError
+from .storage import Storage
+from .utils import Checkpoint, RateLimiter, new_hasher
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    CHUNK_SIZE = 1024 * 1024
+    REPORT_INTERVAL = 60.0
+
+
+class ScrubReport:
+    """Results of a scrubber run."""
+
+    def __init__(self):
+        self.checked = 0
+        self.ok = 0
+        self.unchecksummed = 0
+        self.mismatched: List[str] = []
+        self.unverifiable: List[str] = []
+        self.errors: List[str] = []
+
+    def __repr__(self) -> str:
+        return (
+            "checked {}, ok {}, mismatched {}, unchecksummed {}, unverifiable {}, "
+            "errors {}".format(
+                self.checked,
+                self.ok,
+                len(self.mismatched),
+                self.unchecksummed,
+                len(self.unverifiable),
+                len(self.errors),
+            )
+        )
+
+
+class Scrubber:
+    """Verifies stored files against checksums recorded at store time.
+
+    Reads are throttled in bytes and operations per second,
+    so scrubbing can run alongside production traffic.
+    """
+
+    logger = logging.getLogger("Scrubber")
+
+    OK = "ok"
+    MISMATCH = "mismatch"
+    UNCHECKSUMMED = "unchecksummed"
+    UNVERIFIABLE = "unverifiable"
+
+    def __init__(
+        self,
+        storage: Storage,
+        bytes_per_sec: Optional[float] = None,
+        ops_per_sec: Optional[float] = None,
+        checkpoint_path: Optional[str] = None,
+        report_interval: float = DefaultParams.REPORT_INTERVAL,
+    ):
+        """Construct a scrubber.
+
+        :param storage: a storage to verify
+        :param bytes_per_sec: maximum read throughput, unlimited if `None`
+        :param ops_per_sec: maximum storage requests per second, unlimited if `None`
+        :param checkpoint_path: a file to record progress to, progress is not saved if `None`
+        :param report_interval: seconds between progress reports in log
+        """
+        self.storage = storage
+        self.checkpoint_path = checkpoint_path
+        self.report_interval = report_interval
+        self._bytes_limiter = RateLimiter(bytes_per_sec) if bytes_per_sec else None
+        self._ops_limiter = RateLimiter(ops_per_sec) if ops_per_sec else None
+
+    def _throttle(self, ops: int = 0, size: int = 0):
+        if ops and self._ops_limiter:
+            self._ops_limiter.acquire(ops)
+        if size and self._bytes_limiter:
+            self._bytes_limiter.acquire(size)
+
+    def verify(self, file_id: UUID) -> str:
+        """Verify a single file.
+
+        :param file_id: a file id
+        :return: one of :attr:`OK`, :attr:`MISMATCH`, :attr:`UNCHECKSUMMED` or
+          :attr:`UNVERIFIABLE` if the checksum algorithm is not available,
+          e.g. `xxhash` is not installed
+        """
+        self._throttle(ops=1)
+        checksum = self.storage.get_checksum(file_id)
+        if not checksum:
+            return self.UNCHECKSUMMED
+        algorithm, _, expected = checksum.partition(":")
+        try:
+            hasher = new_hasher(algorithm)
+        except ValueError:
+            return self.UNVERIFIABLE
+        self._throttle(ops=1)
+        with self.storage.open_file(file_id) as handle:
+            while True:
+                chunk = handle.read(DefaultParams.CHUNK_SIZE)
+                if not chunk:
+                    break
+                self._throttle(size=len(chunk))
+                hasher.update(chunk)
+        return self.OK if hasher.hexdigest() == expected else self.MISMATCH
+
+    def _record(self, report: ScrubReport, file_hex: str, result: str) -> bool:
+        """Add a result to a report, return `False` if file must be verified again."""
+        if result == self.UNVERIFIABLE:
+            # left for a run with the algorithm available
+            self.logger.warning("Cannot verify %s: unknown algorithm", file_hex)
+            report.unverifiable.append(file_hex)
+            return False
+        report.checked += 1
+        if result == self.OK:
+            report.ok += 1
+        elif result == self.MISMATCH:
+            self.logger.error("Checksum mismatch for %s", file_hex)
+            report.mismatched.append(file_hex)
+        else:
+            report.unchecksummed += 1
+        return True
+
+    def run(self, file_ids: Optional[Iterable[str]] = None) -> ScrubReport:
+        """Verify all files of a storage.
+
+        Files processed in a previous interrupted run with the same
+        checkpoint are skipped.
+
+        :param file_ids: hex ids to verify, all files if `None`
+        :return: a report
+        """
+        report = ScrubReport()
+        if file_ids is None:
+            file_ids = self.storage.list()
+        last_report = time.monotonic()
+        with Checkpoint(self.checkpoint_path) as checkpoint:
+            for file_hex in file_ids:
+                if file_hex in checkpoint:
+                    continue
+                try:
+                    file_id = UUID(hex=file_hex)
+                    result = self.verify(file_id)
+                except StorageNotFoundError:
+                    # deleted while scrubbing
+                    checkpoint.add(file_hex)
+                    continue
+                except StorageError as e:
+                    self.logger.warning("Cannot verify %s: %s", file_hex, str(e))
+                    report.errors.append(file_hex)
+                    continue
+                if self._record(report, file_hex, result):
+                    checkpoint.add(file_hex)
+                now = time.monotonic()
+                if now - last_report >= self.report_interval:
+                    last_report = now
+                    self.logger.info("Progress: %r", report)
+        self.logger.info("Finished: %r", report)
+        return report
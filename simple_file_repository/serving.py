@@ -0,0 +1,227 @@
+"""Helpers to serve stored files from WSGI and ASGI applications.
+
+Files of local storages are sent with `os.sendfile` (directly or via
+`wsgi.file_wrapper` and the ASGI zero-copy send extension) when possible,
+other files are streamed in chunks.
+"""
+
+import asyncio
+import os
+import socket
+from typing import Iterator, List, Optional, Sequence, Tuple
+from uuid import UUID
+
+from .exceptions import StorageNotFoundError
+from .storage import FileHandle, Storage
+
+CHUNK_SIZE = 256 * 1024
+
+ZEROCOPY_EXTENSION = "http.response.zerocopysend"
+
+
+def _parse_accept(accept: str) -> List[Tuple[str, float]]:
+    """Parse media ranges of an `Accept` header with their quality values."""
+    ranges = []
+    for item in accept.split(","):
+        media_range, *params = [part.strip() for part in item.split(";")]
+        if not media_range:
+            continue
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        ranges.append((media_range.lower(), quality))
+    return ranges
+
+
+def negotiate_format(accept: Optional[str], available: Sequence[str]) -> Optional[str]:
+    """Pick a mime type of a file variant by an `Accept` request header.
+
+    The most specific matching media range defines a quality of a type,
+    ties are broken by order of `available`. Responses should carry
+    `Vary: Accept` header, so caches keep variants apart.
+
+    :param accept: `Accept` header value, any type is accepted if `None`
+    :param available: mime types of available variants by server preference,
+      e.g. `["image/avif", "image/webp", "image/jpeg"]`
+    :return: a chosen mime type or `None` if no variant is acceptable
+    """
+    if not accept:
+        return available[0] if available else None
+    ranges = _parse_accept(accept)
+    best = None
+    best_quality = 0.0
+    for mime_type in available:
+        major = mime_type.split("/")[0]
+        matches = [
+            (media_range.count("*"), quality)
+            for media_range, quality in ranges
+            if media_range in (mime_type, major + "/*", "*/*")
+        ]
+        if not matches:
+            continue
+        # fewer wildcards is more specific
+        _, quality = min(matches)
+        if quality > best_quality:
+            best, best_quality = mime_type, quality
+    return best
+
+
+def iter_chunks(handle: FileHandle, chunk_size: int = CHUNK_SIZE) -> Iterator[bytes]:
+    """Read a file handle in chunks and close it afterwards.
+
+    :param handle: an open file handle
+    :param chunk_size: size of a chunk in bytes
+    :return: an iterator of chunks
+    """
+    try:
+        while True:
+            chunk = handle.read(chunk_size)
+            if not chunk:
+                return
+            yield chunk
+    finally:
+        handle.close()
+
+
+def sendfile(
+    handle: FileHandle, sock: socket.socket, chunk_size: int = CHUNK_SIZE
+) -> int:
+    """Send a whole file to a connected socket.
+
+    Uses `os.sendfile` if the handle has an OS file descriptor,
+    falls back to chunked `sendall` otherwise.
+
+    :param handle: an open file handle, it is not closed
+    :param sock: a connected blocking socket
+    :param chunk_size: size of a chunk for the fallback in bytes
+    :return: count of bytes sent
+    """
+    fd = handle.fileno()
+    if fd is not None and hasattr(os, "sendfile"):
+        offset = 0
+        while offset < handle.size:
+            sent = os.sendfile(sock.fileno(), fd, offset, handle.size - offset)
+            if sent == 0:
+                break
+            offset += sent
+        return offset
+    total = 0
+    while True:
+        chunk = handle.read(chunk_size)
+        if not chunk:
+            return total
+        sock.sendall(chunk)
+        total += len(chunk)
+
+
+def _response_headers(
+    handle: FileHandle, headers: Optional[List[Tuple[str, str]]]
+) -> List[Tuple[str, str]]:
+    return [
+        ("Content-Type", handle.content_type),
+        ("Content-Length", str(handle.size)),
+    ] + list(headers or [])
+
+
+def wsgi_response(
+    storage: Storage,
+    file_id: UUID,
+    environ: dict,
+    start_response,
+    headers: Optional[List[Tuple[str, str]]] = None,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """Serve a file from a WSGI application.
+
+    Local files are passed to `wsgi.file_wrapper` if the server provides it,
+    so the server can use `sendfile`. Responds 404 for missing files.
+
+    :param storage: a storage
+    :param file_id: a file id
+    :param environ: WSGI environment
+    :param start_response: WSGI `start_response` callable
+    :param headers: extra response headers
+    :param chunk_size: size of a chunk in bytes
+    :return: WSGI response iterable
+    """
+    try:
+        handle = storage.open_file(file_id)
+    except StorageNotFoundError:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return [b"Not Found"]
+    start_response("200 OK", _response_headers(handle, headers))
+    file_wrapper = environ.get("wsgi.file_wrapper")
+    if file_wrapper is not None and handle.fileno() is not None:
+        return file_wrapper(handle.fileobj, chunk_size)
+    return iter_chunks(handle, chunk_size)
+
+
+async def asgi_response(
+    storage: Storage,
+    file_id: UUID,
+    scope: dict,
+    send,
+    headers: Optional[List[Tuple[str, str]]] = None,
+    chunk_size: int = CHUNK_SIZE,
+):
+    """Serve a file from an ASGI application.
+
+    Local files are sent with the `http.response.zerocopysend` extension
+    if the server supports it. Storage calls are made in the default executor,
+    so the event loop is not blocked. Responds 404 for missing files.
+
+    :param storage: a storage
+    :param file_id: a file id
+    :param scope: ASGI connection scope
+    :param send: ASGI `send` callable
+    :param headers: extra response headers
+    :param chunk_size: size of a chunk in bytes
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        handle = await loop.run_in_executor(None, storage.open_file, file_id)
+    except StorageNotFoundError:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 404,
+                "headers": [(b"content-type", b"text/plain")],
+            }
+        )
+        await send({"type": "http.response.body", "body": b"Not Found"})
+        return
+    try:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in _response_headers(handle, headers)
+                ],
+            }
+        )
+        extensions = scope.get("extensions") or {}
+        if ZEROCOPY_EXTENSION in extensions and handle.fileno() is not None:
+            await send(
+                {
+                    "type": ZEROCOPY_EXTENSION,
+                    "file": handle.fileobj,
+                    "count": handle.size,
+                }
+            )
+            return
+        while True:
+            chunk = await loop.run_in_executor(None, handle.read, chunk_size)
+            await send(
+                {"type": "http.response.body", "body": chunk, "more_body": bool(chunk)}
+            )
+            if not chunk:
+                return
+    finally:
+        handle.close()
@@ -0,0 +1,189 @@
+import asyncio
+import collections
+import itertools
+import threading
+import time
+from typing import Any, Callable, Hashable, List, Optional
+
+
+class _Call:
+    """An in-flight call shared by its callers."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.exception: Optional[BaseException] = None
+        # futures of asyncio callers
+        self.waiters: List[asyncio.Future] = []
+        # the key was forgotten while the call ran, its result may be outdated
+        self.stale = False
+
+
+def _resolve(future: asyncio.Future, call: _Call):
+    if future.done():
+        return
+    if call.exception is not None:
+        future.set_exception(call.exception)
+    else:
+        future.set_result(call.result)
+
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one execution.
+
+    The first caller of a key runs a function, callers arriving while it runs
+    wait and receive the same result or exception. Thread and asyncio callers
+    of the same key share one execution. A result is not kept after
+    completion unless a cache is configured. A call running when its key is
+    forgotten is not joined by new callers and its result is not cached.
+    """
+
+    def __init__(self, cache_ttl: Optional[float] = None, cache_size: int = 1024):
+        """Construct a coalescer.
+
+        :param cache_ttl: seconds to keep successful results, not cached if `None`
+        :param cache_size: maximum count of cached results
+        """
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.executions = 0
+        self.coalesced = 0
+        self._calls = {}
+        # key -> (expiration time, result), least recently used first
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def _lookup(self, key: Hashable):
+        """Find a cached result or join an in-flight call.
+
+        Must be called under lock.
+
+        :return: a call and whether the caller runs it,
+          a cached result is returned as a completed call
+        """
+        cached = self._cache.get(key)
+        if cached is not None:
+            expires, result = cached
+            if expires > time.monotonic():
+                self._cache.move_to_end(key)
+                call = _Call()
+                call.result = result
+                call.event.set()
+                return call, False
+            del self._cache[key]
+        call = self._calls.get(key)
+        if call is not None:
+            self.coalesced += 1
+            return call, False
+        call = _Call()
+        self._calls[key] = call
+        self.executions += 1
+        return call, True
+
+    def _finish(self, key: Hashable, call: _Call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+            if self.cache_ttl is not None and call.exception is None and not call.stale:
+                self._cache[key] = (time.monotonic() + self.cache_ttl, call.result)
+                self._cache.move_to_end(key)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+            waiters = list(call.waiters)
+            call.waiters.clear()
+            call.event.set()
+        for future in waiters:
+            future.get_loop().call_soon_threadsafe(_resolve, future, call)
+
+    def _run(self, key: Hashable, call: _Call, fn: Callable[[], Any]):
+        try:
+            call.result = fn()
+        except BaseException as e:  # pylint: disable=broad-exception-caught
+            call.exception = e
+        self._finish(key, call)
+
+    @staticmethod
+    def _outcome(call: _Call):
+        if call.exception is not None:
+            raise call.exception
+        return call.result
+
+    def do(self, key: Hashable, fn: Callable[[], Any]):
+        """Call a function once for concurrent callers of a key.
+
+        :param key: a hashable key of a call, e.g. a method name and arguments
+        :param fn: a function to call
+        :return: a result of the function
+        """
+        with self._lock:
+            call, leader = self._lookup(key)
+        if leader:
+            self._run(key, call, fn)
+        else:
+            call.event.wait()
+        return self._outcome(call)
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Any]):
+        """Call a function once for concurrent callers of a key from asyncio.
+
+        A blocking function is run in the default executor, a coroutine
+        function is awaited. Waiting callers do not occupy threads.
+
+        :param key: a hashable key of a call
+        :param fn: a function or a coroutine function to call
+        :return: a result of the function
+        """
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            call, leader = self._lookup(key)
+            if not leader:
+                if call.event.is_set():
+                    return self._outcome(call)
+                future = loop.create_future()
+                call.waiters.append(future)
+        if not leader:
+            return await future
+        if asyncio.iscoroutinefunction(fn):
+            try:
+                call.result = await fn()
+            except BaseException as e:  # pylint: disable=broad-exception-caught
+                call.exception = e
+            self._finish(key, call)
+        else:
+            await loop.run_in_executor(None, self._run, key, call, fn)
+        return self._outcome(call)
+
+    def _forget(self, key: Hashable):
+        """Drop a cached result and detach a running call, must be called under lock."""
+        self._cache.pop(key, None)
+        call = self._calls.pop(key, None)
+        if call is not None:
+            call.stale = True
+
+    def forget(self, key: Hashable):
+        """Drop a cached result of a key, a running call is not cached."""
+        with self._lock:
+            self._forget(key)
+
+    def forget_matching(self, predicate: Callable[[Hashable], bool]):
+        """Drop cached results of keys matching a predicate.
+
+        :param predicate: a function returning `True` for a key to drop
+        """
+        with self._lock:
+            for key in list(itertools.chain(self._cache, self._calls)):
+                if predicate(key):
+                    self._forget(key)
+
+    def clear(self):
+        """Drop all cached results."""
+        with self._lock:
+            for call in self._calls.values():
+                call.stale = True
+            self._calls.clear()
+            self._cache.clear()
+
+    def __repr__(self) -> str:
+        return "SingleFlight executions={} coalesced={}".format(
+            self.executions, self.coalesced
+        )
@@ -1,10 +1,102 @@
 import abc
+import io
 from abc import ABCMeta, abstractmethod
-from typing import Iterable, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import BinaryIO, Iterable, List, Optional
 from uuid import UUID
 
+from .exceptions import StorageNotFoundError
+from .usage import Usage
 
-class Storage(abc.ABC, metaclass=ABCMeta):
+
+class FileStat:
+    """File metadata returned by :meth:`Storage.stat`."""
+
+    def __init__(
+        self,
+        file_id: UUID,
+        size: int,
+        content_type: str,
+        mtime: Optional[float] = None,
+        etag: Optional[str] = None,
+        cache_control: Optional[str] = None,
+        tags: Optional[dict] = None,
+    ):
+        """Construct file metadata.
+
+        :param file_id: a file id
+        :param size: file size in bytes
+        :param content_type: a mime type
+        :param mtime: modification time as a POSIX timestamp if known
+        :param etag: an entity tag if supported by storage
+        :param cache_control: a cache control if supported by storage
+        :param tags: file tags if requested and supported by storage
+        """
+        self.file_id = file_id
+        self.size = size
+        self.content_type = content_type
+        self.mtime = mtime
+        self.etag = etag
+        self.cache_control = cache_control
+        self.tags = tags
+
+    def __repr__(self) -> str:
+        return "FileStat {} size={} content_type={}".format(
+            self.file_id, self.size, self.content_type
+        )
+
+
+class FileHandle:
+    """An open file returned by :meth:`Storage.open_file`.
+
+    Should be closed after use, can be used as a context manager.
+    """
+
+    def __init__(
+        self,
+        fileobj: BinaryIO,
+        size: int,
+        content_type: str,
+        path: Optional[str] = None,
+    ):
+        """Construct a file handle.
+
+        :param fileobj: a readable binary file object
+        :param size: file size in bytes
+        :param content_type: a mime type
+        :param path: a local filesystem path if file is local
+        """
+        self.fileobj = fileobj
+        self.size = size
+        self.content_type = content_type
+        self.path = path
+
+    def fileno(self) -> Optional[int]:
+        """Return an OS file descriptor suitable for `os.sendfile` or `None`."""
+        try:
+            return self.fileobj.fileno()
+        except (AttributeError, io.UnsupportedOperation, OSError):
+            return None
+
+    def read(self, size: int = -1) -> bytes:
+        """Read up to `size` bytes."""
+        return self.fileobj.read(size)
+
+    def close(self):
+        """Close the underlying file object."""
+        self.fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __repr__(self) -> str:
+        return "FileHandle size={} content_type={}".format(self.size, self.content_type)
+
+
+class Storage(abc.ABC, metaclass=ABCMeta):  # pylint: disable=too-many-public-methods
     """Generic storage for files."""
 
     @abstractmethod
@@ -31,17 +123,179 @@ class Storage(abc.ABC, metaclass=ABCMeta):
         tags: Optional[dict] = None,
         override_id: Optional[UUID] = None,
         cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
     ) -> UUID:
-        """Stores file and returns a file-id."""
+        """Stores file and returns a file-id.
+
+        A file stored with `ttl` seconds is deleted by :meth:`purge_expired`
+        within an hour after it expires.
+        """
 
     @abstractmethod
     def get_mimetype(self, file_id: UUID) -> str:
         """Retrieve mimetype by file_id."""
 
+    # pylint: disable=unused-argument
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        """Retrieve file metadata by file_id.
+
+        Generic implementation reads the whole file, so storages override it
+        with a cheaper one.
+
+        :param file_id: a file id
+        :param with_tags: retrieve tags as well if storage supports them
+        :return: file metadata
+        """
+        content = self.get(file_id)
+        return FileStat(file_id, len(content), self.get_mimetype(file_id))
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        """Open a file for serving by file_id.
+
+        Local storages return a handle with an OS file descriptor, so content
+        can be sent without copying through user space. Generic implementation
+        reads the whole file into memory.
+
+        :param file_id: a file id
+        :return: an open file handle
+        """
+        content = self.get(file_id)
+        return FileHandle(io.BytesIO(content), len(content), self.get_mimetype(file_id))
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        """Read first bytes of a file by file_id, e.g. to parse a header.
+
+        Generic implementation reads from :meth:`open_file`,
+        remote storages make a ranged request.
+
+        :param file_id: a file id
+        :param size: maximum count of bytes
+        :return: up to `size` first bytes
+        """
+        with self.open_file(file_id) as handle:
+            return handle.read(size)
+
+    # pylint: disable=unused-argument
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        """Retrieve a checksum recorded when the file was stored.
+
+        :param file_id: a file id
+        :return: a checksum as `<algorithm>:<hexdigest>` or `None` if not recorded
+        """
+        return None
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional["Storage"] = None,
+    ) -> UUID:
+        """Copy a file to a new file id.
+
+        Generic implementation reads the whole file and stores it again,
+        storages override it with a copy that does not transfer content
+        through the application if possible.
+
+        :param src_id: a source file id
+        :param dst_id: a file id of the copy, generated if `None`
+        :param tags: tags of the copy, tags of the source are kept if `None`
+        :param cache_control: a cache control of the copy, kept if `None`
+        :param destination: a storage to copy to (e.g. another database),
+          this storage if `None`
+        :return: a file id of the copy
+        """
+        destination = destination if destination is not None else self
+        stat = self.stat(src_id, with_tags=tags is None)
+        content = self.get(src_id)
+        return destination.store(
+            content,
+            content_type=stat.content_type,
+            tags=tags if tags is not None else stat.tags,
+            override_id=dst_id,
+            cache_control=(
+                cache_control if cache_control is not None else stat.cache_control
+            ),
+        )
+
+    # pylint: disable=unused-argument
+    def prefetch(self, file_ids: Iterable[UUID], priority: int = 0):
+        """Hint that files will be read soon, never blocks.
+
+        Storages without a cache ignore the hint, wrap a storage
+        in `PrefetchingStorage` to read files in background.
+
+        :param file_ids: file ids in order of expected access
+        :param priority: files of a higher priority are read first
+        """
+
+    def stat_many(
+        self, file_ids: Iterable[UUID], workers: int = 8, with_tags: bool = False
+    ) -> List[Optional[FileStat]]:
+        """Retrieve metadata of several files concurrently.
+
+        :param file_ids: file ids
+        :param workers: count of concurrent requests
+        :param with_tags: retrieve tags as well if storage supports them
+        :return: file metadata in order of `file_ids`, `None` for missing files
+        """
+
+        def stat_or_none(file_id: UUID) -> Optional[FileStat]:
+            try:
+                return self.stat(file_id, with_tags=with_tags)
+            except StorageNotFoundError:
+                return None
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(stat_or_none, file_ids))
+
+    def usage(self) -> Usage:
+        """Returns object count, total size and a size histogram of storage.
+
+        Generic implementation stats every file, storages override it
+        with an incrementally maintained one.
+        """
+        stats = self.stat_many(UUID(hex=file_hex) for file_hex in self.list())
+        return Usage.from_sizes(stat.size for stat in stats if stat)
+
+    def flush_usage(self):
+        """Save usage changes kept in memory, e.g. before dropping a storage.
+
+        Generic implementation does nothing, storages keeping changes
+        in memory override it.
+        """
+
     @abstractmethod
     def delete(self, file_id: UUID, silent: bool = False):
         """Deletes a file by file_id."""
 
+    def delete_many(self, file_ids: Iterable[UUID], workers: int = 8):
+        """Delete several files, missing files are ignored.
+
+        Generic implementation deletes files one by one concurrently,
+        storages override it with a batch request.
+
+        :param file_ids: file ids
+        :param workers: count of concurrent requests
+        """
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda file_id: self.delete(file_id, True), file_ids))
+
+    # pylint: disable=unused-argument
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Delete files stored with a TTL that expired.
+
+        Expiring files are indexed by hourly buckets, so a purge reads only
+        buckets of the past hours and does not list the whole storage. It is
+        safe to purge from several processes at once. Storages that do not
+        support TTLs keep no expiring files, so by default nothing is purged.
+
+        :param now: current time, `time.time()` if `None`
+        :return: count of purged files
+        """
+        return 0
+
     @abstractmethod
     def count(self) -> int:
         """Returns file count in storage.
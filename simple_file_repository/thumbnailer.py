@@ -0,0 +1,416 @@
+import abc
+import io
+import mimetypes
+import os
+import subprocess
+import tempfile
+from abc import ABCMeta, abstractmethod
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from .imageinfo import ImageInfo, parse_image_info
+
+# extensions and `convert` options of thumbnail formats
+OUTPUT_FORMATS = {
+    # progressive with chroma subsampling
+    "image/jpeg": (
+        ".jpg",
+        ["-quality", "82", "-interlace", "JPEG", "-sampling-factor", "4:2:0"],
+    ),
+    "image/png": (".png", ["-define", "png:compression-level=9"]),
+    "image/gif": (".gif", []),
+    "image/webp": (".webp", ["-quality", "80", "-define", "webp:method=5"]),
+    # needs ImageMagick built with libheif
+    "image/avif": (".avif", ["-quality", "55", "-define", "heic:speed=6"]),
+}
+
+# Pillow formats and save options matching `OUTPUT_FORMATS`
+PILLOW_OUTPUT_FORMATS = {
+    "image/jpeg": ("JPEG", dict(quality=82, progressive=True, subsampling="4:2:0")),
+    "image/png": ("PNG", dict(compress_level=9)),
+    "image/gif": ("GIF", {}),
+    "image/webp": ("WEBP", dict(quality=80, method=5)),
+    "image/avif": ("AVIF", dict(quality=55, speed=6)),
+}
+
+# ImageMagick names of EXIF orientations
+ORIENTATION_NAMES = {
+    1: "TopLeft",
+    2: "TopRight",
+    3: "BottomRight",
+    4: "BottomLeft",
+    5: "LeftTop",
+    6: "RightTop",
+    7: "RightBottom",
+    8: "LeftBottom",
+}
+
+
+class ThumbnailProfile:
+    """Quality and performance trade-offs of thumbnail generation.
+
+    Predefined profiles are `QUALITY` (full decode, the default),
+    `BALANCED` (JPEG shrink-on-load) and `FAST` (shrink-on-load, sampling
+    and embedded EXIF thumbnails).
+    """
+
+    # decoded and sampled images are kept at least this many times larger
+    # than a thumbnail, so final resize still has pixels to filter
+    OVERSIZE = 2
+
+    QUALITY: "ThumbnailProfile"
+    BALANCED: "ThumbnailProfile"
+    FAST: "ThumbnailProfile"
+
+    def __init__(
+        self,
+        name: str,
+        decode_size_hint: bool = False,
+        sample: bool = False,
+        exif_thumbnail: bool = False,
+    ):
+        """Construct a profile.
+
+        :param name: a profile name
+        :param decode_size_hint: let libjpeg decode a JPEG at a reduced scale
+          with `-define jpeg:size`
+        :param sample: reduce an image by pixel sampling with `-sample`
+          before filtered `-thumbnail` resize
+        :param exif_thumbnail: make a thumbnail from a JPEG thumbnail embedded
+          to EXIF if it is large enough and has the same aspect ratio
+        """
+        self.name = name
+        self.decode_size_hint = decode_size_hint
+        self.sample = sample
+        self.exif_thumbnail = exif_thumbnail
+
+    def __repr__(self) -> str:
+        return "ThumbnailProfile {}".format(self.name)
+
+
+ThumbnailProfile.QUALITY = ThumbnailProfile("quality")
+ThumbnailProfile.BALANCED = ThumbnailProfile("balanced", decode_size_hint=True)
+ThumbnailProfile.FAST = ThumbnailProfile(
+    "fast", decode_size_hint=True, sample=True, exif_thumbnail=True
+)
+
+
+def embedded_thumbnail(
+    content: bytes, info: ImageInfo, thumb_size: int
+) -> Optional[bytes]:
+    """Return an EXIF thumbnail suitable to make a thumbnail from."""
+    if not info.exif_thumbnail:
+        return None
+    start, length = info.exif_thumbnail
+    end = start + length
+    embedded = content[start:end]
+    try:
+        embedded_info = parse_image_info(embedded)
+    except ValueError:
+        return None
+    if not embedded_info or embedded_info.format != "jpeg":
+        return None
+    if max(embedded_info.width, embedded_info.height) < thumb_size:
+        return None
+    # letterboxed thumbnails have a different aspect ratio
+    ratio = info.width * embedded_info.height / (info.height * embedded_info.width)
+    if abs(ratio - 1) > 0.02:
+        return None
+    return embedded
+
+
+class Thumbnailer(abc.ABC, metaclass=ABCMeta):
+    """A backend of `PhotoStorage` making thumbnails.
+
+    A thumbnail is the first frame of an image, auto-oriented, resized to fit
+    a `thumb_size` square, centered on a transparent square of that size
+    and stripped of metadata.
+    """
+
+    @abstractmethod
+    def check_format(self, mime_type: str):
+        """Raise `RuntimeError` if thumbnails cannot be encoded as a mime type."""
+
+    @abstractmethod
+    def render(
+        self,
+        content: bytes,
+        info: Optional[ImageInfo],
+        mime_types: Sequence[str],
+        thumb_size: int,
+        profile: ThumbnailProfile,
+    ) -> Dict[str, bytes]:
+        """Make a thumbnail of an image encoded in one or several formats.
+
+        :param content: an image
+        :param info: image properties parsed from its header, `None` if unknown
+        :param mime_types: mime types of thumbnails
+        :param thumb_size: width and height of thumbnails
+        :param profile: a thumbnail profile
+        :return: encoded thumbnails by mime type
+        """
+
+
+class ImageMagickThumbnailer(Thumbnailer):
+    """Thumbnailer running ImageMagick `convert` executable."""
+
+    def __init__(self, imagemagick_convert: str):
+        """Construct ImageMagickThumbnailer instance.
+
+        :param imagemagick_convert: path to `convert` executable
+        """
+        self.imagemagick_convert = imagemagick_convert
+
+    @staticmethod
+    def _output_format(mime_type: str) -> Tuple[str, List[str]]:
+        """Return an extension and `convert` options of an output format."""
+        if mime_type in OUTPUT_FORMATS:
+            return OUTPUT_FORMATS[mime_type]
+        extension = mimetypes.guess_extension(mime_type)
+        if not extension:
+            raise RuntimeError("Extension cannot be deduced for {}".format(mime_type))
+        return extension, []
+
+    def check_format(self, mime_type: str):
+        self._output_format(mime_type)
+
+    @staticmethod
+    def _decode_options(
+        content: bytes,
+        info: Optional[ImageInfo],
+        thumb_size: int,
+        profile: ThumbnailProfile,
+    ) -> Tuple[bytes, List[str], List[str]]:
+        """Choose a source and `convert` options to decode it according to a profile.
+
+        :return: source content, input options and transform options
+        """
+        input_options = []
+        transform_options = []
+        is_jpeg = info is not None and info.format == "jpeg"
+        embedded = None
+        if is_jpeg and profile.exif_thumbnail:
+            embedded = embedded_thumbnail(content, info, thumb_size)
+        if embedded:
+            # orientation is not stored in the embedded thumbnail
+            content = embedded
+            transform_options += ["-orient", ORIENTATION_NAMES[info.orientation]]
+        decode_size = thumb_size * ThumbnailProfile.OVERSIZE
+        if is_jpeg and profile.decode_size_hint and not embedded:
+            input_options += ["-define", "jpeg:size={0}x{0}".format(decode_size)]
+        if profile.sample:
+            transform_options += ["-sample", "{0}x{0}>".format(decode_size)]
+        return content, input_options, transform_options
+
+    def _run(
+        self,
+        source_path: str,
+        outputs: Sequence[Tuple[str, Sequence[str]]],
+        thumb_size: int,
+        input_options: Sequence[str] = (),
+        transform_options: Sequence[str] = (),
+    ):
+        """Run `convert` once writing a thumbnail to one or several files.
+
+        :param outputs: target paths with their output options
+        """
+        image_dim = "{0}x{0}".format(thumb_size)
+        command = [
+            self.imagemagick_convert,
+            *input_options,
+            source_path,
+            *transform_options,
+            "-auto-orient",
+            "-thumbnail",
+            image_dim,
+            "-gravity",
+            "center",
+            "-background",
+            "transparent",
+            "-extent",
+            image_dim,
+            "-strip",
+        ]
+        if len(outputs) > 1:
+            # keep output options of each clone local
+            command.insert(1, "-respect-parentheses")
+        *clones, (target_path, output_options) = outputs
+        for clone_path, clone_options in clones:
+            command += ["(", "+clone", *clone_options, "-write", clone_path]
+            command += ["+delete", ")"]
+        command += [*output_options, target_path]
+        subprocess.run(
+            command,
+            shell=False,
+            check=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE,
+        )
+
+    def _outputs(
+        self, tmpdirname: str, mime_types: Sequence[str]
+    ) -> Dict[str, Tuple[str, List[str]]]:
+        outputs = {}
+        for index, mime_type in enumerate(mime_types):
+            extension, output_options = self._output_format(mime_type)
+            target_path = os.path.join(
+                tmpdirname, "target-{}{}".format(index, extension)
+            )
+            outputs[mime_type] = (target_path, output_options)
+        return outputs
+
+    def render(
+        self,
+        content: bytes,
+        info: Optional[ImageInfo],
+        mime_types: Sequence[str],
+        thumb_size: int,
+        profile: ThumbnailProfile,
+    ) -> Dict[str, bytes]:
+        """Make thumbnails in all formats by a single `convert` run."""
+        if not self.imagemagick_convert or not os.path.exists(self.imagemagick_convert):
+            raise RuntimeError("Cannot find imagemagick")
+
+        with tempfile.TemporaryDirectory() as tmpdirname:
+            saved_path = os.path.join(tmpdirname, "saved-image")
+            content, input_options, transform_options = self._decode_options(
+                content, info, thumb_size, profile
+            )
+            with open(saved_path, "wb") as f:
+                f.write(content)
+            if info is not None and info.animated:
+                # decode only the first frame
+                saved_path += "[0]"
+            outputs = self._outputs(tmpdirname, mime_types)
+            self._run(
+                saved_path,
+                list(outputs.values()),
+                thumb_size,
+                input_options=input_options,
+                transform_options=transform_options,
+            )
+            thumbnails = {}
+            for mime_type, (target_path, _) in outputs.items():
+                with open(target_path, "rb") as f:
+                    thumbnails[mime_type] = f.read()
+            return thumbnails
+
+    def __repr__(self) -> str:
+        return "ImageMagickThumbnailer {}".format(self.imagemagick_convert)
+
+
+def _pillow():
+    try:
+        # pylint: disable=import-outside-toplevel
+        from PIL import Image, ImageOps
+    except ImportError as e:
+        raise RuntimeError("Install Pillow to use PillowThumbnailer") from e
+    return Image, ImageOps
+
+
+class PillowThumbnailer(Thumbnailer):
+    """Thumbnailer decoding and encoding images in process with Pillow.
+
+    Saves a fork of `convert` and temporary files per thumbnail. JPEG images
+    are decoded at a reduced scale with `draft` if a profile sets
+    `decode_size_hint`, so large photos are not fully decoded.
+    """
+
+    # EXIF orientations as transpositions of Pillow
+    TRANSPOSITIONS = {
+        2: "FLIP_LEFT_RIGHT",
+        3: "ROTATE_180",
+        4: "FLIP_TOP_BOTTOM",
+        5: "TRANSPOSE",
+        6: "ROTATE_270",
+        7: "TRANSVERSE",
+        8: "ROTATE_90",
+    }
+
+    def __init__(self):
+        """Construct PillowThumbnailer instance.
+
+        :raises RuntimeError: if Pillow is not installed
+        """
+        self._image, self._image_ops = _pillow()
+
+    def check_format(self, mime_type: str):
+        if mime_type not in PILLOW_OUTPUT_FORMATS:
+            raise RuntimeError("Unsupported thumbnail format {}".format(mime_type))
+
+    def _decode(
+        self,
+        content: bytes,
+        info: Optional[ImageInfo],
+        thumb_size: int,
+        profile: ThumbnailProfile,
+    ):
+        """Decode the first frame of an image upright according to a profile."""
+        Image = self._image
+        is_jpeg = info is not None and info.format == "jpeg"
+        embedded = None
+        if is_jpeg and profile.exif_thumbnail:
+            embedded = embedded_thumbnail(content, info, thumb_size)
+        image = Image.open(io.BytesIO(embedded or content))
+        decode_size = thumb_size * ThumbnailProfile.OVERSIZE
+        if profile.decode_size_hint and not embedded:
+            # libjpeg scales by 1/2, 1/4 or 1/8 keeping at least the requested size
+            image.draft("RGB", (decode_size, decode_size))
+        if embedded:
+            # orientation is not stored in the embedded thumbnail
+            image.load()
+            transposition = self.TRANSPOSITIONS.get(info.orientation)
+            if transposition:
+                image = image.transpose(getattr(Image.Transpose, transposition))
+        else:
+            image = self._image_ops.exif_transpose(image)
+        if profile.sample:
+            image.thumbnail(
+                (decode_size, decode_size), resample=Image.Resampling.NEAREST
+            )
+        return image
+
+    def _extent(self, image, thumb_size: int):
+        """Fit an image to a square, centered on a transparent background."""
+        Image = self._image
+        scale = thumb_size / max(image.width, image.height)
+        size = (
+            max(1, round(image.width * scale)),
+            max(1, round(image.height * scale)),
+        )
+        image = image.convert("RGBA").resize(size, Image.Resampling.LANCZOS)
+        canvas = Image.new("RGBA", (thumb_size, thumb_size), (0, 0, 0, 0))
+        canvas.paste(image, ((thumb_size - size[0]) // 2, (thumb_size - size[1]) // 2))
+        return canvas
+
+    def render(
+        self,
+        content: bytes,
+        info: Optional[ImageInfo],
+        mime_types: Sequence[str],
+        thumb_size: int,
+        profile: ThumbnailProfile,
+    ) -> Dict[str, bytes]:
+        """Make a thumbnail once and encode it in each format without metadata."""
+        for mime_type in mime_types:
+            self.check_format(mime_type)
+        try:
+            thumbnail = self._extent(
+                self._decode(content, info, thumb_size, profile), thumb_size
+            )
+            thumbnails = {}
+            for mime_type in mime_types:
+                image_format, options = PILLOW_OUTPUT_FORMATS[mime_type]
+                image = thumbnail
+                if image_format == "JPEG":
+                    # transparent extent is black like in ImageMagick
+                    image = thumbnail.convert("RGB")
+                output = io.BytesIO()
+                # neither EXIF nor ICC profile is written unless passed
+                image.save(output, format=image_format, **options)
+                thumbnails[mime_type] = output.getvalue()
+            return thumbnails
+        except (OSError, ValueError, KeyError) as e:
+            raise RuntimeError("Cannot make thumbnail: {}".format(str(e))) from e
+
+    def __repr__(self) -> str:
+        return "PillowThumbnailer"
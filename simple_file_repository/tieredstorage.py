@@ -0,0 +1,512 @@
+import heapq
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+from typing import Iterable, List, Optional
+from uuid import UUID, uuid4
+
+from .exceptions import StorageError, StorageExistsError, StorageNotFoundError
+from .filestorage import FileStorage
+from .storage import FileHandle, FileStat, Storage
+from .usage import Usage
+from .utils import backoff_delay
+
+
+class DefaultParams:
+    """Default parameters"""
+
+    GRACE_PERIOD = 3600.0
+    WORKERS = 4
+    RETRY_BASE_DELAY = 1.0
+    RETRY_MAX_DELAY = 300.0
+
+
+class TieredStorage(Storage):
+    """Write-behind storage over a local and a remote storage.
+
+    Files are stored to a local `FileStorage` first and uploaded to a remote
+    storage (usually `S3Storage`) in background. Pending uploads are recorded
+    in an on-disk journal, so they survive restarts. An uploaded file is kept
+    in the local storage for `grace_period` seconds and then removed.
+    """
+
+    logger = logging.getLogger("TieredStorage")
+
+    def __init__(
+        self,
+        local: FileStorage,
+        remote: Storage,
+        journal_directory: str,
+        grace_period: float = DefaultParams.GRACE_PERIOD,
+        workers: int = DefaultParams.WORKERS,
+        retry_base_delay: float = DefaultParams.RETRY_BASE_DELAY,
+        retry_max_delay: float = DefaultParams.RETRY_MAX_DELAY,
+        start: bool = True,
+    ):
+        """Construct TieredStorage instance.
+
+        :param local: a local storage for new files
+        :param remote: a remote storage to upload files to
+        :param journal_directory: a directory for the journal of pending uploads
+        :param grace_period: seconds to keep an uploaded file in the local storage
+        :param workers: count of upload threads
+        :param retry_base_delay: a delay before first retry of failed upload
+        :param retry_max_delay: a maximum delay between retries
+        :param start: start upload threads immediately if `True`,
+          otherwise :meth:`start` must be called
+        """
+        self.local = local
+        self.remote = remote
+        self.journal_directory = journal_directory
+        self.grace_period = grace_period
+        self.workers = workers
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+
+        # journal entries by file hex and count of not uploaded ones
+        self._entries = {}
+        self._pending = 0
+        # hexes with an upload in flight, at most one per file
+        self._uploading = set()
+        # heap of (due time, sequence, file hex)
+        self._schedule = []
+        self._sequence = itertools.count()
+        self._cond = threading.Condition()
+        self._threads = []
+        self._stopped = False
+
+        try:
+            os.makedirs(self.journal_directory, exist_ok=True)
+        except OSError as e:
+            raise StorageError("Cannot create journal: {}".format(str(e))) from e
+        with self._cond:
+            self._load_journal()
+        if start:
+            self.start()
+
+    def _journal_path(self, file_hex: str) -> str:
+        return os.path.join(self.journal_directory, file_hex + ".json")
+
+    def _write_entry(self, file_hex: str, entry: dict):
+        path = self._journal_path(file_hex)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _remove_entry(self, file_hex: str):
+        try:
+            os.unlink(self._journal_path(file_hex))
+        except FileNotFoundError:
+            pass
+
+    def _load_journal(self):
+        now = time.time()
+        for name in os.listdir(self.journal_directory):
+            if not name.endswith(".json"):
+                continue
+            file_hex = name[:-5]
+            try:
+                with open(self._journal_path(file_hex), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError) as e:
+                self.logger.warning("Skip broken journal entry %s: %s", name, str(e))
+                continue
+            self._set_entry(file_hex, entry)
+            if entry.get("uploaded_at") is None:
+                self._schedule_entry(file_hex, now)
+            else:
+                self._schedule_entry(file_hex, entry["uploaded_at"] + self.grace_period)
+        if self._entries:
+            self.logger.info("Loaded %d journal entries", len(self._entries))
+
+    def _set_entry(self, file_hex: str, entry: dict):
+        """Add or replace an entry, must be called under lock."""
+        self._count_pending(self._entries.get(file_hex), -1)
+        self._entries[file_hex] = entry
+        self._count_pending(entry, 1)
+
+    def _pop_entry(self, file_hex: str) -> Optional[dict]:
+        """Remove an entry, must be called under lock."""
+        entry = self._entries.pop(file_hex, None)
+        self._count_pending(entry, -1)
+        return entry
+
+    def _count_pending(self, entry: Optional[dict], sign: int):
+        if entry is None or entry.get("uploaded_at") is not None:
+            return
+        self._pending += sign
+        if self._pending == 0:
+            # wake up flush
+            self._cond.notify_all()
+
+    def _schedule_entry(self, file_hex: str, due: float):
+        heapq.heappush(self._schedule, (due, next(self._sequence), file_hex))
+        self._cond.notify()
+
+    def _journal_upload(self, file_id: UUID, entry: dict):
+        """Journal and schedule an upload of a file stored locally."""
+        # tells a file stored again under the same id from the one in flight
+        entry["generation"] = uuid4().hex
+        try:
+            with self._cond:
+                self._write_entry(file_id.hex, entry)
+                self._set_entry(file_id.hex, entry)
+                self._schedule_entry(file_id.hex, time.time())
+        except OSError as e:  # pragma: no cover
+            self.local.delete(file_id, silent=True)
+            raise StorageError(e) from e
+
+    def start(self):
+        """Start upload threads."""
+        with self._cond:
+            if self._threads:
+                return
+            self._stopped = False
+            for index in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run, name="TieredStorage-{}".format(index), daemon=True
+                )
+                thread.start()
+                self._threads.append(thread)
+
+    def close(self):
+        """Stop upload threads. Pending uploads stay in the journal."""
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Wait until all pending uploads are done.
+
+        :param timeout: maximum seconds to wait, wait forever if `None`
+        :return: `True` if there are no pending uploads
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def _next_task(self) -> Optional[str]:
+        with self._cond:
+            while not self._stopped:
+                if self._schedule:
+                    due, _, file_hex = self._schedule[0]
+                    delay = due - time.time()
+                    if delay <= 0:
+                        heapq.heappop(self._schedule)
+                        if file_hex in self._entries:
+                            return file_hex
+                        continue
+                    self._cond.wait(delay)
+                else:
+                    self._cond.wait()
+            return None
+
+    def _run(self):
+        while True:
+            file_hex = self._next_task()
+            if file_hex is None:
+                return
+            try:
+                self._process(file_hex)
+            except Exception as e:  # pylint: disable=broad-exception-caught
+                self.logger.exception("Unexpected error for %s: %s", file_hex, e)
+                with self._cond:
+                    if file_hex in self._entries:
+                        self._schedule_entry(
+                            file_hex, time.time() + self.retry_max_delay
+                        )
+
+    def _process(self, file_hex: str):
+        with self._cond:
+            entry = self._entries.get(file_hex)
+            if entry is None:
+                return
+            uploaded = entry.get("uploaded_at") is not None
+            if not uploaded and file_hex in self._uploading:
+                # stored again while an upload of the previous file is in flight
+                self._schedule_entry(file_hex, time.time() + self.retry_base_delay)
+                return
+            if not uploaded:
+                self._uploading.add(file_hex)
+        if uploaded:
+            self._demote(file_hex)
+            return
+        try:
+            self._upload(file_hex, dict(entry))
+        finally:
+            with self._cond:
+                self._uploading.discard(file_hex)
+
+    def _is_current(self, file_hex: str, entry: dict) -> bool:
+        """Check that a file is not deleted or stored again, call under lock."""
+        current = self._entries.get(file_hex)
+        if current is None:
+            return False
+        return current.get("generation") == entry.get("generation")
+
+    def _upload(self, file_hex: str, entry: dict):
+        file_id = UUID(hex=file_hex)
+        try:
+            content = self.local.get(file_id)
+        except StorageNotFoundError:
+            self.logger.warning("Local copy of %s is lost, skip upload", file_hex)
+            with self._cond:
+                if self._is_current(file_hex, entry):
+                    self._pop_entry(file_hex)
+                    self._remove_entry(file_hex)
+            return
+        expires_at = entry.get("expires_at")
+        try:
+            self.remote.store(
+                content,
+                content_type=entry.get("content_type"),
+                tags=entry.get("tags"),
+                override_id=file_id,
+                cache_control=entry.get("cache_control"),
+                ttl=max(0.0, expires_at - time.time()) if expires_at else None,
+            )
+        except StorageExistsError:
+            # uploaded by an attempt that was not recorded, e.g. before a crash
+            self.logger.info("%s is already uploaded", file_hex)
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            attempts = entry.get("attempts", 0)
+            delay = backoff_delay(attempts, self.retry_base_delay, self.retry_max_delay)
+            self.logger.info(
+                "Upload of %s failed: %s, retry #%d in %.1f s",
+                file_hex,
+                str(e),
+                attempts + 1,
+                delay,
+            )
+            entry["attempts"] = attempts + 1
+            with self._cond:
+                if self._is_current(file_hex, entry):
+                    self._set_entry(file_hex, entry)
+                    self._write_entry(file_hex, entry)
+                    self._schedule_entry(file_hex, time.time() + delay)
+            return
+
+        entry["uploaded_at"] = time.time()
+        with self._cond:
+            if not self._is_current(file_hex, entry):
+                # deleted and maybe stored again during upload,
+                # a file stored again is uploaded by its own task
+                self.remote.delete(file_id, silent=True)
+                return
+            self._set_entry(file_hex, entry)
+            self._write_entry(file_hex, entry)
+            self._schedule_entry(file_hex, entry["uploaded_at"] + self.grace_period)
+
+    def _demote(self, file_hex: str):
+        self.local.delete(UUID(hex=file_hex), silent=True)
+        with self._cond:
+            self._pop_entry(file_hex)
+            self._remove_entry(file_hex)
+
+    def is_local(self) -> bool:
+        return self.remote.is_local()
+
+    def get(self, file_id: UUID) -> bytes:
+        try:
+            return self.local.get(file_id)
+        except StorageNotFoundError:
+            return self.remote.get(file_id)
+
+    def get_path(self, file_id: UUID, params: Optional[dict] = None) -> str:
+        if self.local.exists(file_id):
+            return self.local.get_path(file_id, params)
+        return self.remote.get_path(file_id, params)
+
+    def exists(self, file_id: UUID) -> bool:
+        return self.local.exists(file_id) or self.remote.exists(file_id)
+
+    def store(
+        self,
+        content: bytes,
+        content_type: Optional[str] = None,
+        tags: Optional[dict] = None,
+        override_id: Optional[UUID] = None,
+        cache_control: Optional[str] = None,
+        ttl: Optional[float] = None,
+    ) -> UUID:
+        file_id = self.local.store(
+            content,
+            content_type=content_type,
+            tags=tags,
+            override_id=override_id,
+            cache_control=cache_control,
+            ttl=ttl,
+        )
+        entry = dict(
+            content_type=content_type,
+            tags=tags,
+            cache_control=cache_control,
+            expires_at=time.time() + ttl if ttl is not None else None,
+            attempts=0,
+            uploaded_at=None,
+        )
+        self._journal_upload(file_id, entry)
+        return file_id
+
+    def copy(
+        self,
+        src_id: UUID,
+        dst_id: Optional[UUID] = None,
+        tags: Optional[dict] = None,
+        cache_control: Optional[str] = None,
+        destination: Optional[Storage] = None,
+    ) -> UUID:
+        """Copy a file without reading it if possible.
+
+        A file that is not uploaded yet is linked in the local storage and
+        the copy is uploaded in background, an uploaded file is copied by the
+        remote storage, e.g. server-side.
+        """
+        local = destination is None or destination is self
+        with self._cond:
+            entry = self._entries.get(src_id.hex)
+        if entry is None or entry.get("uploaded_at") is not None:
+            return self.remote.copy(
+                src_id,
+                dst_id,
+                tags,
+                cache_control,
+                destination=self.remote if local else destination,
+            )
+        if not local:
+            return super().copy(src_id, dst_id, tags, cache_control, destination)
+        dst_id = self.local.copy(src_id, dst_id)
+        entry = dict(
+            content_type=entry.get("content_type"),
+            tags=tags if tags is not None else entry.get("tags"),
+            cache_control=(
+                cache_control
+                if cache_control is not None
+                else entry.get("cache_control")
+            ),
+            expires_at=None,
+            attempts=0,
+            uploaded_at=None,
+        )
+        self._journal_upload(dst_id, entry)
+        return dst_id
+
+    def get_mimetype(self, file_id: UUID) -> str:
+        with self._cond:
+            entry = self._entries.get(file_id.hex)
+        if entry and entry.get("content_type"):
+            return entry["content_type"]
+        try:
+            return self.local.get_mimetype(file_id)
+        except StorageNotFoundError:
+            return self.remote.get_mimetype(file_id)
+
+    def stat(self, file_id: UUID, with_tags: bool = False) -> FileStat:
+        with self._cond:
+            entry = self._entries.get(file_id.hex)
+        try:
+            stat = self.local.stat(file_id)
+        except StorageNotFoundError:
+            return self.remote.stat(file_id, with_tags=with_tags)
+        if entry:
+            stat.content_type = entry.get("content_type") or stat.content_type
+            stat.cache_control = entry.get("cache_control")
+            stat.tags = entry.get("tags") if with_tags else None
+        return stat
+
+    def get_checksum(self, file_id: UUID) -> Optional[str]:
+        checksum = None
+        if self.local.exists(file_id):
+            checksum = self.local.get_checksum(file_id)
+        return checksum or self.remote.get_checksum(file_id)
+
+    def open_file(self, file_id: UUID) -> FileHandle:
+        try:
+            handle = self.local.open_file(file_id)
+        except StorageNotFoundError:
+            return self.remote.open_file(file_id)
+        with self._cond:
+            entry = self._entries.get(file_id.hex)
+        if entry and entry.get("content_type"):
+            handle.content_type = entry["content_type"]
+        return handle
+
+    def read_head(self, file_id: UUID, size: int) -> bytes:
+        try:
+            return self.local.read_head(file_id, size)
+        except StorageNotFoundError:
+            return self.remote.read_head(file_id, size)
+
+    def delete(self, file_id: UUID, silent: bool = False):
+        with self._cond:
+            entry = self._pop_entry(file_id.hex)
+            if entry is not None:
+                self._remove_entry(file_id.hex)
+        in_local = self.local.exists(file_id)
+        if in_local:
+            self.local.delete(file_id, silent=True)
+        if entry is not None and entry.get("uploaded_at") is None:
+            # not uploaded yet, an in-flight upload will clean after itself
+            return
+        self.remote.delete(file_id, silent=silent or in_local)
+
+    def purge_expired(self, now: Optional[float] = None) -> int:
+        """Purge both storages, a pending upload of an expired file is dropped.
+
+        :return: count of files purged from the remote storage
+        """
+        self.local.purge_expired(now)
+        return self.remote.purge_expired(now)
+
+    def _pending_hexes(self) -> List[str]:
+        with self._cond:
+            return [
+                file_hex
+                for file_hex, entry in self._entries.items()
+                if entry.get("uploaded_at") is None
+            ]
+
+    def usage(self) -> Usage:
+        pending = self._pending_hexes()
+        file_ids = [UUID(hex=file_hex) for file_hex in pending]
+        usage = self.remote.usage()
+        # files being uploaded may be counted by the remote storage already
+        remote_stats = self.remote.stat_many(file_ids)
+        for stat, remote_stat in zip(self.local.stat_many(file_ids), remote_stats):
+            if stat and not remote_stat:
+                usage.add(stat.size)
+        return usage
+
+    def count(self) -> int:
+        return sum(1 for _ in self.list())
+
+    def list(self) -> Iterable[str]:
+        pending = self._pending_hexes()
+        yield from pending
+        # files being uploaded are listed by the remote storage as well
+        pending = set(pending)
+        for file_hex in self.remote.list():
+            if file_hex not in pending:
+                yield file_hex
+
+    def clean(self):
+        with self._cond:
+            for file_hex in self._entries:
+                self._remove_entry(file_hex)
+            self._entries.clear()
+            self._pending = 0
+            self._schedule.clear()
+            self._cond.notify_all()
+        self.local.clean()
+        self.remote.clean()
+
+    def __repr__(self) -> str:
+        return "TieredStorage local={!r} remote={!r}".format(self.local, self.remote)
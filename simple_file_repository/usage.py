@@ -0,0 +1,61 @@
+import bisect
+from typing import Iterable, List, Optional
+
+# upper bounds of size histogram buckets: 1 KiB, 4 KiB, ..., 1 GiB and the rest
+SIZE_BUCKETS = [1024 * 4**power for power in range(11)]
+
+
+class Usage:
+    """Object count, total size and a size histogram of a storage.
+
+    Histogram bucket `i` counts objects with size not greater
+    than `SIZE_BUCKETS[i]`, the last bucket counts larger objects.
+    """
+
+    def __init__(
+        self,
+        count: int = 0,
+        total_bytes: int = 0,
+        histogram: Optional[List[int]] = None,
+    ):
+        self.count = count
+        self.total_bytes = total_bytes
+        self.histogram = list(histogram or [0] * (len(SIZE_BUCKETS) + 1))
+
+    @classmethod
+    def from_sizes(cls, sizes: Iterable[int]) -> "Usage":
+        """Build usage from object sizes."""
+        usage = cls()
+        for size in sizes:
+            usage.add(size)
+        return usage
+
+    def add(self, size: int, sign: int = 1):
+        """Account a stored (`sign=1`) or deleted (`sign=-1`) object."""
+        self.count += sign
+        self.total_bytes += sign * size
+        self.histogram[bisect.bisect_left(SIZE_BUCKETS, size)] += sign
+
+    def to_dict(self) -> dict:
+        """Serialize to a dict."""
+        return dict(
+            count=self.count, total_bytes=self.total_bytes, histogram=self.histogram
+        )
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Usage":
+        """Deserialize from a dict."""
+        return cls(data["count"], data["total_bytes"], data["histogram"])
+
+    def __add__(self, other: "Usage") -> "Usage":
+        return Usage(
+            self.count + other.count,
+            self.total_bytes + other.total_bytes,
+            [a + b for a, b in zip(self.histogram, other.histogram)],
+        )
+
+    def __eq__(self, other) -> bool:
+        return isinstance(other, Usage) and self.to_dict() == other.to_dict()
+
+    def __repr__(self) -> str:
+        return "Usage count={} total_bytes={}".format(self.count, self.total_bytes)
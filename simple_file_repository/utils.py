@@ -1,5 +1,20 @@
+import collections
+import hashlib
+import heapq
+import mmap
+import os
+import random
+import tempfile
+import threading
+import time
+from concurrent.futures import Executor
+from typing import Callable, Iterable, Iterator, Optional, TypeVar
+
 import magic
 
+T = TypeVar("T")
+R = TypeVar("R")
+
 
 def guess_mime_type(content: bytes) -> str:
     """Return a mime type for given content.
@@ -12,3 +27,253 @@ def guess_mime_type(content: bytes) -> str:
         mime_type = m.id_buffer(content)
         # returns application/octet-stream in worst case
         return mime_type
+
+
+def new_hasher(algorithm: str):
+    """Create a hash object for a checksum algorithm.
+
+    Algorithms of :mod:`hashlib` are always available,
+    `xxh64`, `xxh3_64` and `xxh128` require optional `xxhash` package.
+
+    :param algorithm: an algorithm name
+    :return: a hash object with `update` and `hexdigest` methods
+    """
+    if algorithm.startswith("xxh"):
+        try:
+            import xxhash  # pylint: disable=import-outside-toplevel
+        except ImportError as e:
+            raise ValueError("Install xxhash to use " + algorithm) from e
+        return getattr(xxhash, algorithm)()
+    return hashlib.new(algorithm)
+
+
+def backoff_delay(attempt: int, base: float, cap: float) -> float:
+    """Return a delay before a retry using exponential backoff with full jitter.
+
+    :param attempt: a zero-based attempt number
+    :param base: a delay for the first retry in seconds
+    :param cap: a maximum delay in seconds
+    :return: a delay in seconds
+    """
+    return random.uniform(0, min(cap, base * 2 ** min(attempt, 32)))
+
+
+def bounded_map(
+    executor: Executor, fn: Callable[[T], R], iterable: Iterable[T], window: int
+) -> Iterator[R]:
+    """Map `fn` over `iterable` in `executor` with bounded concurrency.
+
+    Unlike :meth:`Executor.map`, the iterable is consumed lazily and at most
+    `window` calls are in flight, so memory does not grow with input size.
+
+    :param executor: an executor to run calls in
+    :param fn: a function to call
+    :param iterable: input items
+    :param window: maximum number of submitted but not yet consumed calls
+    :return: results in input order
+    """
+    pending = collections.deque()
+    try:
+        for item in iterable:
+            pending.append(executor.submit(fn, item))
+            if len(pending) >= window:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+class Checkpoint:
+    """A persistent set of processed file ids.
+
+    Ids are appended to a text file one per line, so an interrupted
+    bulk operation can be resumed by skipping already processed ids.
+
+    At most `memory_ids` recently added ids are kept in a set, older ones
+    are spilled to sorted temporary files of 16-byte ids and looked up
+    by binary search, so memory does not grow with the count of files.
+    Runs of equal size are merged, which keeps their count logarithmic.
+    """
+
+    KEY_SIZE = 16
+    MEMORY_IDS = 1000000
+
+    def __init__(self, path: Optional[str] = None, memory_ids: int = MEMORY_IDS):
+        """Open a checkpoint.
+
+        :param path: a checkpoint file, kept only in memory and temporary
+          files if `None`
+        :param memory_ids: maximum count of ids kept in memory
+        """
+        self.path = path
+        self.memory_ids = memory_ids
+        self._recent = set()
+        # sorted runs of keys as (file, mmap), from the largest to the smallest
+        self._runs = []
+        self._count = 0
+        self._lock = threading.Lock()
+        self._file = None
+        if path:
+            line = "\n"
+            if os.path.isfile(path):
+                with open(path, "r", encoding="ascii") as f:
+                    for line in f:
+                        key = self._key(line.strip())
+                        # a line can be torn by a crash
+                        if key and not self._contains(key):
+                            self._insert(key)
+            # pylint: disable=consider-using-with
+            self._file = open(path, "a", encoding="ascii")
+            if not line.endswith("\n"):
+                # end a torn line
+                self._file.write("\n")
+
+    @classmethod
+    def _key(cls, file_id: str) -> Optional[bytes]:
+        try:
+            key = bytes.fromhex(file_id)
+        except ValueError:
+            return None
+        return key if len(key) == cls.KEY_SIZE else None
+
+    def _contains(self, key: bytes) -> bool:
+        if key in self._recent:
+            return True
+        for _, run in self._runs:
+            lo, hi = 0, len(run) // self.KEY_SIZE
+            while lo < hi:
+                mid = (lo + hi) // 2
+                start = mid * self.KEY_SIZE
+                end = start + self.KEY_SIZE
+                probe = run[start:end]
+                if probe == key:
+                    return True
+                if probe < key:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return False
+
+    def _insert(self, key: bytes):
+        self._recent.add(key)
+        self._count += 1
+        if len(self._recent) >= self.memory_ids:
+            self._spill()
+
+    def _write_run(self, keys: Iterable[bytes]):
+        directory = os.path.dirname(os.path.abspath(self.path)) if self.path else None
+        # pylint: disable=consider-using-with
+        f = tempfile.TemporaryFile(dir=directory)
+        for key in keys:
+            f.write(key)
+        f.flush()
+        self._runs.append((f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+
+    def _iter_run(self, run: mmap.mmap) -> Iterator[bytes]:
+        for start in range(0, len(run), self.KEY_SIZE):
+            end = start + self.KEY_SIZE
+            yield run[start:end]
+
+    def _spill(self):
+        self._write_run(sorted(self._recent))
+        self._recent.clear()
+        while len(self._runs) > 1 and len(self._runs[-1][1]) >= len(self._runs[-2][1]):
+            merged = self._runs[-2:]
+            del self._runs[-2:]
+            self._write_run(heapq.merge(*(self._iter_run(run) for _, run in merged)))
+            for f, run in merged:
+                run.close()
+                f.close()
+
+    def __contains__(self, file_id: str) -> bool:
+        key = self._key(file_id)
+        if key is None:
+            return False
+        with self._lock:
+            return self._contains(key)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def add(self, file_id: str):
+        """Mark file id as processed.
+
+        :param file_id: a hex file id
+        """
+        key = self._key(file_id)
+        if key is None:
+            raise ValueError("Invalid file id " + file_id)
+        with self._lock:
+            if self._contains(key):
+                return
+            self._insert(key)
+            if self._file:
+                self._file.write(file_id + "\n")
+                self._file.flush()
+
+    def close(self):
+        """Close the checkpoint file and drop spilled ids."""
+        if self._file:
+            self._file.close()
+            self._file = None
+        for f, run in self._runs:
+            run.close()
+            f.close()
+        self._runs = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class RateLimiter:
+    """A thread-safe token bucket limiting a rate of some quantity per second."""
+
+    def __init__(self, rate: float, burst: Optional[float] = None):
+        """Construct a limiter.
+
+        :param rate: allowed amount per second
+        :param burst: maximum amount accumulated while idle, `rate` by default
+        """
+        if rate <= 0:
+            raise ValueError("Invalid rate " + str(rate))
+        self.rate = rate
+        self.burst = burst if burst is not None else rate
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount: float = 1):
+        """Take `amount` from the bucket, sleeping if it is exhausted.
+
+        Amount larger than the burst is allowed and is paid off by a longer sleep.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._last) * self.rate
+            )
+            self._last = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def expiry_bucket(ttl: float, now: Optional[float] = None) -> str:
+    """Return a name of an hourly bucket of files expiring after `ttl` seconds.
+
+    Names are UTC hours like `2025042513`, so they sort by time.
+
+    :param ttl: seconds until expiry
+    :param now: current time, `time.time()` if `None`
+    :return: a bucket name
+    """
+    if ttl < 0:
+        raise ValueError("Invalid TTL " + str(ttl))
+    now = time.time() if now is None else now
+    return time.strftime("%Y%m%d%H", time.gmtime(now + ttl))
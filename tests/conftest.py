@@ -61,3 +61,23 @@ def sample_image():
 @pytest.fixture
 def convert_path():
     return shutil.which("convert")
+
+
+@pytest.fixture
+def fake_convert(tmpdir):
+    """A `convert` stand-in that logs arguments and copies source to target."""
+    path = str(tmpdir.join("convert"))
+    log_path = str(tmpdir.join("convert.log"))
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(
+            "#!/bin/sh\n"
+            'echo "$@" >> {}\n'
+            "for target; do\n"
+            '  case "$target" in *saved-*) source="${{target%\\[0\\]}}";; esac\n'
+            '  if [ "$previous" = -write ]; then cp "$source" "$target"; fi\n'
+            '  previous="$target"\n'
+            "done\n"
+            'cp "$source" "$target"\n'.format(log_path)
+        )
+    os.chmod(path, 0o755)
+    return path, log_path
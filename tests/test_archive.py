@@ -0,0 +1,96 @@
+import io
+import json
+import tarfile
+import uuid
+
+import pytest
+
+from simple_file_repository.archive import (
+    MANIFEST_NAME,
+    export_archive,
+    import_archive,
+)
+from simple_file_repository.exceptions import StorageError
+
+
+def test_export_import(file_storage_db, tmpdir, monkeypatch):
+    ids = [file_storage_db.store(str(i).encode() * 100) for i in range(20)]
+    file_ids = sorted(file_id.hex for file_id in ids)
+    buffer = io.BytesIO()
+    with monkeypatch.context() as m:
+        # objects are streamed, not read into memory
+        m.setattr(file_storage_db, "get", None)
+        assert (
+            export_archive(file_storage_db, buffer, file_ids=file_ids, workers=4) == 20
+        )
+
+    buffer.seek(0)
+    with tarfile.open(fileobj=buffer, mode="r|") as archive:
+        names = []
+        for tarinfo in archive:
+            names.append(tarinfo.name)
+            if tarinfo.name == MANIFEST_NAME:
+                manifest = archive.extractfile(tarinfo).read().decode()
+            else:
+                assert tarinfo.pax_headers["SFR.content_type"] == "text/plain"
+    # written in order of ids, manifest is last
+    assert names == file_ids + [MANIFEST_NAME]
+    entries = [json.loads(line) for line in manifest.splitlines()]
+    assert [entry["id"] for entry in entries] == file_ids
+    assert {entry["size"] for entry in entries} == {100, 200}
+
+    destination = type(file_storage_db)(str(tmpdir.mkdir("copy")), "db")
+    buffer.seek(0)
+    assert import_archive(destination, buffer, workers=4) == 20
+    for file_id in ids:
+        assert destination.get(file_id) == file_storage_db.get(file_id)
+    # existing objects are skipped
+    buffer.seek(0)
+    assert import_archive(destination, buffer) == 0
+
+
+def test_export_import_s3(s3_storage_db, file_storage_db):
+    file_id = s3_storage_db.store(
+        b"foo", tags={"owner": "cat"}, cache_control="max-age=60"
+    )
+    s3_storage_db.store(b"bar")
+    buffer = io.BytesIO()
+    assert export_archive(s3_storage_db, buffer, compression="gz") == 2
+
+    file_storage_db.store(b"baz")
+    buffer.seek(0)
+    assert import_archive(file_storage_db, buffer) == 2
+    assert file_storage_db.get(file_id) == b"foo"
+    assert file_storage_db.count() == 3
+
+    s3_storage_db.delete(file_id)
+    buffer.seek(0)
+    assert import_archive(s3_storage_db, buffer) == 1
+    stat = s3_storage_db.stat(file_id, with_tags=True)
+    assert stat.tags == {"owner": "cat"}
+    assert stat.cache_control == "max-age=60"
+
+
+def test_export_missing(file_storage_db):
+    file_id = file_storage_db.store(b"foo")
+    buffer = io.BytesIO()
+    file_ids = [file_id.hex, uuid.uuid4().hex]
+    assert export_archive(file_storage_db, buffer, file_ids=file_ids) == 1
+
+
+def test_export_import_zstd(file_storage_db, tmpdir):
+    pytest.importorskip("zstandard")
+    file_id = file_storage_db.store(b"foo")
+    buffer = io.BytesIO()
+    assert export_archive(file_storage_db, buffer, compression="zstd") == 1
+    destination = type(file_storage_db)(str(tmpdir.mkdir("copy")), "db")
+    buffer.seek(0)
+    assert import_archive(destination, buffer, compression="zstd") == 1
+    assert destination.get(file_id) == b"foo"
+
+
+def test_invalid_archive(file_storage_db):
+    with pytest.raises(ValueError):
+        export_archive(file_storage_db, io.BytesIO(), compression="bz2")
+    with pytest.raises(StorageError):
+        import_archive(file_storage_db, io.BytesIO(b"not a tar archive"))
@@ -0,0 +1,167 @@
+import threading
+import uuid
+
+import pytest
+
+from simple_file_repository.bloom import BloomFilter
+from simple_file_repository.bloomstorage import BloomStorage
+from simple_file_repository.exceptions import StorageNotFoundError
+
+
+def test_bloom_filter(tmpdir):
+    bloom = BloomFilter(1000, error_rate=0.01)
+    ids = [uuid.uuid4() for _ in range(1000)]
+    for file_id in ids:
+        bloom.add(file_id)
+    assert all(file_id in bloom for file_id in ids)
+    false_positives = sum(uuid.uuid4() in bloom for _ in range(10000))
+    assert false_positives < 300
+    assert 0.001 < bloom.false_positive_rate() < 0.03
+
+    path = str(tmpdir.join("filter"))
+    bloom.save(path)
+    loaded = BloomFilter.load(path)
+    assert loaded.count == 1000
+    assert all(file_id in loaded for file_id in ids)
+
+    with open(path, "r+b") as f:
+        f.truncate(100)
+    with pytest.raises(ValueError):
+        BloomFilter.load(path)
+    with pytest.raises(ValueError):
+        BloomFilter(0)
+
+
+def test_bloom_storage(file_storage_db, monkeypatch):
+    file_id = file_storage_db.store(b"foo")
+    storage = BloomStorage(file_storage_db, capacity=100, build=False)
+    missing = uuid.uuid4()
+    # not built yet
+    assert not storage.exists(missing)
+    assert storage.passed == 1
+
+    storage.rebuild()
+    calls = []
+    monkeypatch.setattr(file_storage_db, "exists", calls.append)
+    assert not storage.exists(missing)
+    with pytest.raises(StorageNotFoundError):
+        storage.get(missing)
+    with pytest.raises(StorageNotFoundError):
+        storage.stat(missing)
+    assert not calls
+    assert storage.filtered == 3
+    assert storage.get(file_id) == b"foo"
+
+    # stored ids are added
+    new_id = storage.store(b"bar")
+    assert storage.get_mimetype(new_id) == "text/plain"
+
+    # deleted ids pass until rebuild
+    storage.delete(file_id)
+    with pytest.raises(StorageNotFoundError):
+        storage.get(file_id)
+    assert storage.false_positives == 1
+    assert storage.observed_false_positive_rate() == 0.25
+    storage.rebuild()
+    with pytest.raises(StorageNotFoundError):
+        storage.get(file_id)
+    assert storage.false_positives == 1
+    assert 0 < storage.false_positive_rate() < 0.01
+
+
+def test_bloom_storage_persistence(s3_storage_db, tmpdir):
+    path = str(tmpdir.join("filter"))
+    storage = BloomStorage(s3_storage_db, path=path, build=False)
+    storage.rebuild()
+    stored_id = storage.store(b"foo")
+
+    # journal keeps ids stored after the filter is saved
+    loaded = BloomStorage(s3_storage_db, path=path, build=False)
+    assert loaded.exists(stored_id)
+    assert loaded.passed == 1
+    storage.close()
+    loaded.close()
+
+    loaded = BloomStorage(s3_storage_db, path=path, rebuild_interval=None)
+    assert loaded.get(stored_id) == b"foo"
+    assert not loaded.exists(uuid.uuid4())
+    assert loaded.filtered == 1
+    loaded.close()
+
+
+def test_bloom_storage_background(file_storage_db):
+    file_id = file_storage_db.store(b"foo")
+    storage = BloomStorage(file_storage_db, capacity=100, rebuild_interval=0)
+    storage.rebuild()
+    assert storage.exists(file_id)
+    # a stale filter is rebuilt in background
+    assert not storage.exists(uuid.uuid4())
+    storage.rebuild()
+    assert storage.get(file_id) == b"foo"
+
+
+def test_bloom_storage_store_during_rebuild(file_storage_db, monkeypatch):
+    file_id = file_storage_db.store(b"foo")
+    storage = BloomStorage(file_storage_db, capacity=100, build=False)
+    storage.rebuild()
+    listed = threading.Event()
+    release = threading.Event()
+    original_list = file_storage_db.list
+
+    def blocked_list():
+        yield from original_list()
+        listed.set()
+        release.wait(10)
+
+    monkeypatch.setattr(file_storage_db, "list", blocked_list)
+    rebuild = threading.Thread(target=storage.rebuild)
+    rebuild.start()
+    assert listed.wait(10)
+    stored_id = storage.store(b"bar")
+    release.set()
+    rebuild.join()
+
+    # the id stored during the listing is in the rebuilt filter
+    calls = []
+    monkeypatch.setattr(file_storage_db, "exists", calls.append)
+    assert not storage.exists(uuid.uuid4())
+    assert not calls
+    assert storage.get(stored_id) == b"bar"
+    assert storage.get(file_id) == b"foo"
+
+
+def test_bloom_storage_shared(file_storage_db, tmpdir):
+    path = str(tmpdir.join("filter"))
+    first = BloomStorage(file_storage_db, path=path, build=False)
+    first.rebuild()
+    # e.g. another worker process
+    second = BloomStorage(file_storage_db, path=path, build=False)
+    assert second.false_positive_rate() < 1
+
+    # misses catch up with the journal of other writers
+    file_id = first.store(b"foo")
+    assert second.exists(file_id)
+    assert second.get(file_id) == b"foo"
+
+    # a filter saved by another writer is loaded
+    first.rebuild()
+    other_id = first.store(b"bar")
+    assert second.get(other_id) == b"bar"
+    assert second.exists(file_id)
+    assert not second.exists(uuid.uuid4())
+    first.close()
+    second.close()
+
+
+def test_bloom_storage_copy(s3_storage_db, monkeypatch):
+    storage = BloomStorage(s3_storage_db, build=False)
+    storage.rebuild()
+    file_id = storage.store(b"foo")
+    # copied by the underlying storage, e.g. server-side
+    monkeypatch.setattr(s3_storage_db, "get", None)
+    copy_id = storage.copy(file_id)
+    assert storage.exists(copy_id)
+    assert storage.filtered == 0
+    with pytest.raises(StorageNotFoundError):
+        storage.copy(uuid.uuid4())
+    assert storage.filtered == 1
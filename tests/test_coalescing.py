@@ -0,0 +1,204 @@
+import asyncio
+import os
+import threading
+import time
+import uuid
+
+import pytest
+
+from simple_file_repository.coalescingstorage import CoalescingStorage
+from simple_file_repository.exceptions import StorageNotFoundError
+from simple_file_repository.photostorage import PhotoStorage
+from simple_file_repository.singleflight import SingleFlight
+
+
+def run_threads(count, target):
+    results = [None] * count
+
+    def run(index):
+        try:
+            results[index] = target()
+        except Exception as e:  # pylint: disable=broad-exception-caught
+            results[index] = e
+
+    threads = [threading.Thread(target=run, args=(index,)) for index in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def slow_counter(result=None, error=None):
+    calls = []
+
+    def fn():
+        calls.append(None)
+        time.sleep(0.2)
+        if error:
+            raise error
+        return result if result is not None else len(calls)
+
+    return fn, calls
+
+
+def test_single_flight_threads():
+    flight = SingleFlight()
+    fn, calls = slow_counter()
+    assert run_threads(10, lambda: flight.do("key", fn)) == [1] * 10
+    assert len(calls) == 1
+    assert (flight.executions, flight.coalesced) == (1, 9)
+    # not kept after completion
+    assert flight.do("key", fn) == 2
+
+
+def test_single_flight_exception():
+    flight = SingleFlight()
+    error = StorageNotFoundError("missing")
+    fn, calls = slow_counter(error=error)
+    assert run_threads(5, lambda: flight.do("key", fn)) == [error] * 5
+    assert len(calls) == 1
+
+
+def test_single_flight_cache():
+    flight = SingleFlight(cache_ttl=60, cache_size=1)
+    fn, _ = slow_counter()
+    assert flight.do("key", fn) == 1
+    assert flight.do("key", fn) == 1
+    flight.forget("key")
+    assert flight.do("key", fn) == 2
+    assert flight.do("other", fn) == 3
+    # evicted by size
+    assert flight.do("key", fn) == 4
+
+
+def test_single_flight_forget_running():
+    flight = SingleFlight(cache_ttl=60)
+    values = iter(["old", "new"])
+    started = threading.Event()
+
+    def fn():
+        value = next(values)
+        started.set()
+        time.sleep(0.2 if value == "old" else 0)
+        return value
+
+    thread = threading.Thread(target=lambda: flight.do("key", fn))
+    thread.start()
+    assert started.wait(10)
+    # e.g. a store finished while an exists was running
+    flight.forget("key")
+    # a new caller does not join the outdated call
+    assert flight.do("key", fn) == "new"
+    thread.join()
+    # and the outdated result is not cached over the new one
+    assert flight.do("key", fn) == "new"
+
+
+def test_single_flight_async():
+    flight = SingleFlight()
+    fn, calls = slow_counter()
+    coroutine_calls = []
+
+    async def coroutine_fn():
+        coroutine_calls.append(None)
+        await asyncio.sleep(0.1)
+        return "done"
+
+    async def main():
+        results = await asyncio.gather(
+            *[flight.do_async("key", fn) for _ in range(10)],
+            *[flight.do_async("coro", coroutine_fn) for _ in range(10)],
+        )
+        assert results == [1] * 10 + ["done"] * 10
+
+        # thread and asyncio callers share a call
+        thread = threading.Thread(target=lambda: flight.do("key", fn))
+        thread.start()
+        while not flight._calls:  # pylint: disable=protected-access
+            await asyncio.sleep(0.001)
+        assert await flight.do_async("key", fn) == 2
+        thread.join()
+
+    asyncio.run(main())
+    assert len(calls) == 2
+    assert len(coroutine_calls) == 1
+
+
+def test_coalescing_storage(file_storage_db, monkeypatch):
+    storage = CoalescingStorage(file_storage_db)
+    file_id = storage.store(b"foo")
+    get = file_storage_db.get
+    calls = []
+
+    def slow_get(file_id):
+        calls.append(file_id)
+        time.sleep(0.2)
+        return get(file_id)
+
+    monkeypatch.setattr(file_storage_db, "get", slow_get)
+    assert run_threads(8, lambda: storage.get(file_id)) == [b"foo"] * 8
+    assert len(calls) == 1
+    assert asyncio.run(storage.get_async(file_id)) == b"foo"
+    assert storage.stat(file_id).size == 3
+    assert storage.get_mimetype(file_id) == "text/plain"
+
+    storage.delete(file_id)
+    assert not storage.exists(file_id)
+    with pytest.raises(StorageNotFoundError):
+        storage.get(uuid.UUID(int=1))
+
+
+def test_coalescing_storage_cache(file_storage_db):
+    storage = CoalescingStorage(file_storage_db, cache_ttl=60)
+    file_id = storage.store(b"foo")
+    assert storage.get(file_id) == b"foo"
+    assert storage.exists(file_id)
+    # writes drop cached reads
+    storage.delete(file_id)
+    assert not storage.exists(file_id)
+    with pytest.raises(StorageNotFoundError):
+        storage.get(file_id)
+    storage.store(b"bar", override_id=file_id)
+    assert storage.get(file_id) == b"bar"
+    copy_id = uuid.uuid4()
+    assert not storage.exists(copy_id)
+    storage.copy(file_id, copy_id)
+    assert storage.exists(copy_id)
+    assert os.stat(file_storage_db.get_path(copy_id)).st_nlink == 2
+
+    # a cached miss of another wrapper is dropped as well
+    other = CoalescingStorage(file_storage_db, cache_ttl=60)
+    copy_id = uuid.uuid4()
+    assert not other.exists(copy_id)
+    storage.copy(file_id, copy_id, destination=other)
+    assert other.exists(copy_id)
+
+
+def test_coalescing_thumbnails(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = CoalescingStorage(PhotoStorage(file_storage_db, convert))
+    file_id = storage.store(sample_image)
+    thumb_ids = run_threads(
+        5, lambda: storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100)
+    )
+    assert len(set(thumb_ids)) == 1
+    with open(log_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+
+
+def test_coalescing_thumbnails_cache(file_storage_db, sample_image, fake_convert):
+    convert, _ = fake_convert
+    storage = CoalescingStorage(PhotoStorage(file_storage_db, convert), cache_ttl=60)
+    file_id = storage.store(sample_image)
+    thumb_id = storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100)
+    assert storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100) == thumb_id
+    variants = storage.generate_thumbnail_variants(file_id, ["image/jpeg"])
+
+    # a thumbnail of a deleted image is not served from the cache
+    storage.delete(file_id)
+    storage.store(sample_image, override_id=file_id)
+    assert storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100) != thumb_id
+    storage.delete_many([file_id])
+    storage.store(sample_image, override_id=file_id)
+    assert storage.generate_thumbnail_variants(file_id, ["image/jpeg"]) != variants
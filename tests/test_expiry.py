@@ -0,0 +1,196 @@
+import os
+import threading
+import time
+
+import pytest
+
+from simple_file_repository import s3storage
+from simple_file_repository.exceptions import StorageError
+from simple_file_repository.multifilestorage import DiskRoot, MultiFileStorage
+from simple_file_repository.storage import Storage
+from simple_file_repository.tieredstorage import TieredStorage
+from simple_file_repository.utils import expiry_bucket
+
+HOUR = 3600
+
+
+def test_expiry_bucket():
+    assert expiry_bucket(0, now=0) == "1970010100"
+    assert expiry_bucket(HOUR, now=0) == "1970010101"
+    assert expiry_bucket(HOUR + 1, now=0) == "1970010101"
+    with pytest.raises(ValueError):
+        expiry_bucket(-1)
+
+
+def test_default_purge(file_storage_db):
+    file_storage_db.store(b"kept")
+    # a storage without TTL support has nothing to purge
+    assert Storage.purge_expired(file_storage_db) == 0
+
+
+def test_file_purge(file_storage_db, tmpdir):
+    kept_id = file_storage_db.store(b"kept")
+    expiring_id = file_storage_db.store(b"expiring", ttl=HOUR)
+    later_id = file_storage_db.store(b"later", ttl=10 * HOUR)
+
+    assert file_storage_db.purge_expired() == 0
+    assert file_storage_db.exists(expiring_id)
+
+    assert file_storage_db.purge_expired(now=time.time() + 2 * HOUR) == 1
+    assert not file_storage_db.exists(expiring_id)
+    assert file_storage_db.exists(kept_id)
+    assert file_storage_db.exists(later_id)
+    # the index is not listed as stored files
+    assert file_storage_db.count() == 2
+
+    assert file_storage_db.purge_expired(now=time.time() + 2 * HOUR) == 0
+    assert file_storage_db.purge_expired(now=time.time() + 11 * HOUR) == 1
+    assert os.listdir(os.path.join(str(tmpdir), "db", ".expiry")) == []
+
+
+def test_file_delete_sidecar(file_storage_db):
+    file_id = file_storage_db.store(b"expiring", ttl=HOUR)
+    stripe_dir = os.path.dirname(file_storage_db.get_path(file_id))
+    assert sorted(os.listdir(stripe_dir)) == [
+        file_id.hex + ".bin",
+        file_id.hex + ".exp",
+    ]
+    file_storage_db.delete(file_id)
+    assert os.listdir(stripe_dir) == []
+
+
+def test_file_failed_store(file_storage_db):
+    file_id = file_storage_db.store(b"permanent")
+    with pytest.raises(StorageError):
+        file_storage_db.store(b"tmp", override_id=file_id, ttl=1)
+    # a failed store leaves no expiry entry
+    assert file_storage_db.purge_expired(now=time.time() + 2 * HOUR) == 0
+    assert file_storage_db.get(file_id) == b"permanent"
+
+
+def test_s3_failed_expiry(s3_storage_db, monkeypatch):
+    call = s3_storage_db._call  # pylint: disable=protected-access
+
+    def fail_markers(method, **kwargs):
+        if kwargs.get("Key", "").startswith("_sfr/expiry/"):
+            raise StorageError("Cannot put " + kwargs["Key"])
+        return call(method, **kwargs)
+
+    monkeypatch.setattr(s3_storage_db, "_call", fail_markers)
+    with pytest.raises(StorageError):
+        s3_storage_db.store(b"tmp", ttl=1)
+    # an object without an expiry marker is not kept
+    assert s3_storage_db.count() == 0
+
+
+@pytest.mark.parametrize("storage_fixture", ["file_storage_db", "s3_storage_db"])
+def test_purge_stored_again(request, storage_fixture):
+    storage = request.getfixturevalue(storage_fixture)
+    file_id = storage.store(b"tmp", ttl=1)
+    storage.delete(file_id)
+    storage.store(b"again", override_id=file_id)
+    other_id = storage.store(b"tmp", ttl=1)
+    storage.delete(other_id)
+    storage.store(b"later", override_id=other_id, ttl=10 * HOUR)
+
+    # entries of deleted files do not purge files stored again
+    assert storage.purge_expired(now=time.time() + 2 * HOUR) == 0
+    assert storage.get(file_id) == b"again"
+    assert storage.get(other_id) == b"later"
+    assert storage.purge_expired(now=time.time() + 11 * HOUR) == 1
+    assert storage.get(file_id) == b"again"
+
+
+def test_file_purge_claims(file_storage_db, tmpdir):
+    file_ids = [file_storage_db.store(b"x", ttl=0) for _ in range(20)]
+    expiry_dir = os.path.join(str(tmpdir), "db", ".expiry")
+    (name,) = os.listdir(expiry_dir)
+    # a bucket claimed by another purge is skipped until the claim times out
+    claimed = os.path.join(expiry_dir, name + ".0000.purging")
+    os.rename(os.path.join(expiry_dir, name), claimed)
+    assert file_storage_db.purge_expired(now=time.time() + HOUR) == 0
+    os.utime(claimed, (time.time() - HOUR, time.time() - HOUR))
+
+    results = []
+
+    def purge():
+        results.append(file_storage_db.purge_expired(now=time.time() + HOUR))
+
+    threads = [threading.Thread(target=purge) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(results) == [0, 0, 0, 20]
+    assert not any(file_storage_db.exists(file_id) for file_id in file_ids)
+    assert os.listdir(expiry_dir) == []
+
+
+def test_s3_purge(s3_storage_db, s3_client, s3_bucket, monkeypatch):
+    monkeypatch.setattr(s3storage.DefaultParams, "DELETE_BATCH_SIZE", 2)
+    kept_id = s3_storage_db.store(b"kept")
+    expiring_ids = [s3_storage_db.store(b"x", ttl=HOUR) for _ in range(5)]
+    later_id = s3_storage_db.store(b"later", ttl=10 * HOUR)
+
+    def markers():
+        response = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix="_sfr/expiry/")
+        return response.get("Contents", [])
+
+    assert len(markers()) == 6
+    assert s3_storage_db.purge_expired() == 0
+    assert s3_storage_db.purge_expired(now=time.time() + 2 * HOUR) == 5
+    assert not any(s3_storage_db.exists(file_id) for file_id in expiring_ids)
+    assert s3_storage_db.exists(kept_id)
+    assert s3_storage_db.exists(later_id)
+    assert len(markers()) == 1
+
+    s3_storage_db.delete_many([kept_id, later_id])
+    assert s3_storage_db.count() == 0
+
+
+@pytest.mark.parametrize("multipart", [False, True])
+def test_s3_copy_expiry(s3_storage_db, s3_client, s3_bucket, monkeypatch, multipart):
+    if multipart:
+        monkeypatch.setattr(s3storage.DefaultParams, "MAX_COPY_OBJECT_SIZE", 0)
+    file_id = s3_storage_db.store(b"x", ttl=HOUR)
+    copied_id = s3_storage_db.copy(file_id)
+    # copies are stored without a TTL
+    # pylint: disable=protected-access
+    key = s3_storage_db._get_key(copied_id)
+    metadata = s3_client.head_object(Bucket=s3_bucket, Key=key)["Metadata"]
+    assert s3storage.EXPIRY_METADATA not in metadata
+    assert s3_storage_db.purge_expired(now=time.time() + 2 * HOUR) == 1
+    assert s3_storage_db.get(copied_id) == b"x"
+
+
+def test_multi_file_purge(tmpdir):
+    storage = MultiFileStorage([str(tmpdir.join("a")), str(tmpdir.join("b"))], "db")
+    file_ids = [storage.store(b"x", ttl=0) for _ in range(10)]
+    assert storage.purge_expired(now=time.time() + HOUR) == 10
+    assert not any(storage.exists(file_id) for file_id in file_ids)
+
+
+def test_multi_file_rebalance_expiry(tmpdir):
+    roots = [str(tmpdir.join("a")), str(tmpdir.join("b"))]
+    storage = MultiFileStorage(roots, "db")
+    expiring_ids = [storage.store(b"x", ttl=HOUR) for _ in range(10)]
+    kept_ids = [storage.store(b"kept") for _ in range(10)]
+    storage.set_mode(roots[0], DiskRoot.DRAINING, rebalance=False)
+    assert storage.rebalance() > 0
+
+    # moved files keep their expiry
+    assert storage.purge_expired(now=time.time() + 2 * HOUR) == 10
+    assert not any(storage.exists(file_id) for file_id in expiring_ids)
+    assert all(storage.exists(file_id) for file_id in kept_ids)
+
+
+def test_tiered_purge(file_storage_db, s3_storage_db, tmpdir):
+    storage = TieredStorage(file_storage_db, s3_storage_db, str(tmpdir.join("j")))
+    try:
+        file_id = storage.store(b"x", ttl=HOUR)
+        assert storage.flush(timeout=10)
+        assert storage.purge_expired(now=time.time() + 2 * HOUR) == 1
+        assert not s3_storage_db.exists(file_id)
+        assert not file_storage_db.exists(file_id)
+    finally:
+        storage.close()
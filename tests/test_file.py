@@ -1,9 +1,13 @@
+import collections
+import errno
 import os
 import shutil
+import time
 import uuid
 
 import pytest
 
+from simple_file_repository import filestorage
 from simple_file_repository.exceptions import (
     StorageError,
     StorageNotFoundError,
@@ -18,6 +22,22 @@ def test_create_dir(tmpdir):
     assert file_storage_db.count() == 0
 
 
+def test_create_lazily(tmpdir):
+    storage = FileStorage(os.path.join(str(tmpdir), "root"), "db", create_lazily=True)
+    assert not os.path.isdir(os.path.join(str(tmpdir), "root"))
+    assert storage.count() == 0
+    assert not list(storage.list())
+    assert storage.usage().count == 0
+
+    file_id = storage.store(b"hello world")
+    assert os.path.isdir(os.path.join(str(tmpdir), "root", "db"))
+    assert storage.get(file_id) == b"hello world"
+
+    storage.clean()
+    assert storage.count() == 0
+    assert storage.get(storage.store(b"again")) == b"again"
+
+
 def test_empty_file_storage(file_storage_db, tmpdir):
     assert file_storage_db.count() == 0
     assert os.path.isdir(os.path.join(str(tmpdir), "db"))
@@ -147,9 +167,269 @@ def test_missing_dir(file_storage_db, tmpdir):
     with pytest.raises(StorageNotFoundError):
         file_storage_db.get_mimetype(file_id)
 
+    with pytest.raises(StorageNotInitializedError):
+        file_storage_db.exists(file_id)
     with pytest.raises(StorageNotInitializedError):
         file_storage_db.store(content)
     with pytest.raises(StorageNotInitializedError):
         assert file_storage_db.count() == 0
     with pytest.raises(StorageNotInitializedError):
         file_storage_db.list()
+
+
+def test_list_many_stripes(tmpdir):
+    storage = FileStorage(str(tmpdir), "db", stripes=7, walk_workers=3)
+    file_ids = {storage.store(b"foo").hex for _ in range(50)}
+    # unrelated files are ignored
+    with open(os.path.join(str(tmpdir), "db", "stripe_0", "sfr-x.tmp"), "wb"):
+        pass
+    listed = storage.list()
+    assert not isinstance(listed, list)
+    assert set(listed) == file_ids
+    assert storage.count() == 50
+    storage.clean()
+    assert not os.path.isdir(os.path.join(str(tmpdir), "db"))
+
+
+def test_stat(file_storage_db, sample_image, monkeypatch):
+    file_id = file_storage_db.store(sample_image)
+    stat = file_storage_db.stat(file_id)
+    assert stat.file_id == file_id
+    assert stat.size == len(sample_image)
+    assert stat.content_type == "image/jpeg"
+    assert stat.mtime > 0
+    assert stat.tags is None
+
+    # mime type is guessed only once
+    def fail_guess(content):
+        raise AssertionError("must be cached")
+
+    monkeypatch.setattr(filestorage, "guess_mime_type", fail_guess)
+    assert file_storage_db.get_mimetype(file_id) == "image/jpeg"
+
+    with pytest.raises(StorageNotFoundError):
+        file_storage_db.stat(uuid.uuid4())
+
+
+def test_stat_many(file_storage_db):
+    file_id1 = file_storage_db.store(b"foo")
+    file_id2 = file_storage_db.store(b"barbaz")
+    stats = file_storage_db.stat_many([file_id1, uuid.uuid4(), file_id2])
+    assert [stat.size if stat else None for stat in stats] == [3, None, 6]
+
+
+class CountingOs:
+    """A proxy of `os` module counting filesystem calls."""
+
+    CALLS = {
+        "open",
+        "stat",
+        "fstat",
+        "mkdir",
+        "chmod",
+        "fchmod",
+        "link",
+        "rename",
+        "replace",
+        "unlink",
+        "write",
+        "close",
+        "isfile",
+        "isdir",
+        "exists",
+    }
+
+    def __init__(self, module, counter, prefix=""):
+        self._module = module
+        self._counter = counter
+        self._prefix = prefix
+
+    def __getattr__(self, name):
+        value = getattr(self._module, name)
+        if name == "path":
+            return CountingOs(value, self._counter, "path.")
+        if name not in self.CALLS:
+            return value
+
+        def call(*args, **kwargs):
+            self._counter[self._prefix + name] += 1
+            return value(*args, **kwargs)
+
+        return call
+
+
+def test_syscalls(tmpdir, monkeypatch):
+    umask = os.umask(0o022)
+    try:
+        storage = FileStorage(str(tmpdir), "db", stripes=1, file_perm=0o640)
+    finally:
+        os.umask(umask)
+    storage.store(b"foo")
+
+    calls = collections.Counter()
+    monkeypatch.setattr(filestorage, "os", CountingOs(os, calls))
+
+    def counting_open(*args, **kwargs):
+        calls["builtins.open"] += 1
+        return open(*args, **kwargs)  # pylint: disable=unspecified-encoding
+
+    monkeypatch.setattr(filestorage, "open", counting_open, raising=False)
+
+    def count(operation):
+        calls.clear()
+        operation()
+        return dict(calls)
+
+    file_id = uuid.uuid4()
+    # created stripe is cached, no permission fixups are needed for this umask
+    assert count(lambda: storage.store(b"bar", override_id=file_id)) == {
+        "open": 1,
+        "write": 1,
+        "close": 1,
+        "link": 1,
+        "unlink": 1,
+    }
+    assert count(lambda: storage.get(file_id)) == {"builtins.open": 1}
+    assert count(lambda: storage.exists(file_id)) == {"path.isfile": 1}
+    missing_id = uuid.uuid4()
+    assert count(lambda: storage.exists(missing_id)) == {
+        "path.isfile": 1,
+        "path.isdir": 1,
+    }
+    # the file and its expiry sidecar if it was stored with a TTL
+    assert count(lambda: storage.delete(file_id)) == {"unlink": 2}
+    with pytest.raises(StorageNotFoundError):
+        storage.get(file_id)
+    with pytest.raises(StorageNotFoundError):
+        storage.delete(file_id)
+    assert storage.count() == 1
+
+
+def test_store_permissions(tmpdir):
+    umask = os.umask(0o077)
+    try:
+        storage = FileStorage(
+            str(tmpdir),
+            "db",
+            stripes=1,
+            file_perm=0o640,
+            dir_perm=0o750,
+            checksum_algorithm="sha256",
+        )
+        file_id = storage.store(b"foo")
+    finally:
+        os.umask(umask)
+    path = storage.get_path(file_id)
+    assert os.stat(path).st_mode & 0o777 == 0o640
+    assert os.stat(os.path.dirname(path)).st_mode & 0o777 == 0o750
+    # temporary files are removed
+    assert sorted(os.listdir(os.path.dirname(path))) == [
+        file_id.hex + ".bin",
+        file_id.hex + ".sum",
+    ]
+    checksum = storage.get_checksum(file_id)
+    with pytest.raises(StorageError):
+        storage.store(b"bar", override_id=file_id)
+    assert storage.get(file_id) == b"foo"
+    assert storage.get_checksum(file_id) == checksum
+
+    # a stripe removed after it was cached is created again
+    shutil.rmtree(os.path.dirname(path))
+    assert storage.get(storage.store(b"baz")) == b"baz"
+
+
+def test_store_checksum_concurrently(tmpdir):
+    storage = FileStorage(str(tmpdir), "db", stripes=1, checksum_algorithm="sha256")
+    file_id = uuid.uuid4()
+    checksum_path = os.path.join(str(tmpdir), "db", "stripe_0", file_id.hex + ".sum")
+    storage.store(b"foo", override_id=file_id)
+    storage.delete(file_id)
+    # a concurrent store has recorded its checksum and not published its file yet
+    with open(checksum_path, "w", encoding="ascii") as f:
+        f.write("sha256:concurrent")
+    with pytest.raises(StorageError):
+        storage.store(b"bar", override_id=file_id)
+    assert not storage.exists(file_id)
+    with open(checksum_path, "r", encoding="ascii") as f:
+        assert f.read() == "sha256:concurrent"
+
+    # left by an interrupted store
+    past = time.time() - filestorage.DefaultParams.CHECKSUM_GRACE
+    os.utime(checksum_path, (past, past))
+    storage.store(b"bar", override_id=file_id)
+    assert storage.get_checksum(file_id).startswith("sha256:fcde2b")
+
+
+def test_copy(file_storage_db, tmpdir):
+    file_id = file_storage_db.store(b"foo")
+    copy_id = file_storage_db.copy(file_id)
+    assert file_storage_db.get(copy_id) == b"foo"
+    # a hard link
+    assert os.stat(file_storage_db.get_path(copy_id)).st_nlink == 2
+    with pytest.raises(StorageError):
+        file_storage_db.copy(file_id, copy_id)
+    with pytest.raises(StorageNotFoundError):
+        file_storage_db.copy(uuid.uuid4())
+
+    # another database with a checksum and other permissions
+    other = FileStorage(
+        str(tmpdir), "other", file_perm=0o600, checksum_algorithm="sha256"
+    )
+    source = FileStorage(str(tmpdir), "source", checksum_algorithm="sha256")
+    file_id = source.store(b"bar")
+    copy_id = source.copy(file_id, destination=other)
+    path = other.get_path(copy_id)
+    assert os.stat(path).st_nlink == 1
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert other.get(copy_id) == b"bar"
+    assert other.get_checksum(copy_id) == source.get_checksum(file_id)
+
+    # checksums follow the destination
+    copy_id = source.copy(file_id, destination=file_storage_db)
+    assert file_storage_db.get_checksum(copy_id) is None
+    checksum_path = os.path.splitext(file_storage_db.get_path(copy_id))[0] + ".sum"
+    file_storage_db.delete(copy_id)
+    assert not os.path.exists(checksum_path)
+    other_sha1 = FileStorage(str(tmpdir), "sha1", checksum_algorithm="sha1")
+    copy_id = file_storage_db.copy(file_storage_db.store(b"baz"), destination=other)
+    assert other.get_checksum(copy_id).startswith("sha256:baa5a0")
+    copy_id = source.copy(file_id, destination=other_sha1)
+    assert other_sha1.get_checksum(copy_id).startswith("sha1:62cdb7")
+
+
+def test_copy_without_links(file_storage_db, monkeypatch):
+    file_id = file_storage_db.store(b"foo" * 1000)
+
+    def fail_link(src, dst):
+        if dst.endswith(".bin") and not os.path.basename(src).startswith("."):
+            raise OSError(errno.EXDEV, "Cross-device link")
+        return link(src, dst)
+
+    link = os.link
+    monkeypatch.setattr(os, "link", fail_link)
+    copy_id = file_storage_db.copy(file_id)
+    assert file_storage_db.get(copy_id) == b"foo" * 1000
+    assert os.stat(file_storage_db.get_path(copy_id)).st_nlink == 1
+
+
+def test_clone_file(tmpdir, monkeypatch):
+    content = os.urandom(100000)
+    src_path = str(tmpdir.join("src"))
+    with open(src_path, "wb") as f:
+        f.write(content)
+
+    def clone(dst_name):
+        dst_path = str(tmpdir.join(dst_name))
+        with open(src_path, "rb") as src, open(dst_path, "wb") as dst:
+            filestorage.clone_file(src.fileno(), dst.fileno())
+        with open(dst_path, "rb") as f:
+            return f.read()
+
+    def fail(*args):
+        raise OSError(errno.EOPNOTSUPP, "Not supported")
+
+    assert clone("dst") == content
+    monkeypatch.setattr(filestorage.fcntl, "ioctl", fail)
+    assert clone("dst-range") == content
+    monkeypatch.setattr(os, "copy_file_range", fail)
+    assert clone("dst-stream") == content
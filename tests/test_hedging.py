@@ -0,0 +1,154 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+from simple_file_repository.exceptions import StorageNotFoundError
+from simple_file_repository.hedging import Hedger, LatencyTracker
+from simple_file_repository.s3storage import S3Storage
+
+
+def test_latency_tracker():
+    tracker = LatencyTracker(window=100)
+    assert tracker.percentile(95) == 0
+    for index in range(200):
+        tracker.add(index / 1000)
+    assert len(tracker) == 100
+    assert tracker.percentile(50) == pytest.approx(0.15)
+    assert tracker.percentile(99) == pytest.approx(0.199)
+
+
+def test_hedge_slow_request():
+    hedger = Hedger(budget=1.0, max_delay=0.05)
+    calls = []
+    lock = threading.Lock()
+
+    def request(_):
+        with lock:
+            calls.append(None)
+            first = len(calls) == 1
+        if first:
+            time.sleep(1)
+            return "slow"
+        return "fast"
+
+    started = time.monotonic()
+    assert hedger.call(request) == "fast"
+    assert time.monotonic() - started < 0.5
+    assert (hedger.hedges_fired, hedger.hedges_won) == (1, 1)
+    assert hedger.call(lambda _: "quick") == "quick"
+    assert hedger.hedges_fired == 1
+    hedger.close()
+
+
+def test_hedge_budget():
+    hedger = Hedger(budget=0.0, max_delay=0.01)
+    assert hedger.call(lambda _: time.sleep(0.05) or "done") == "done"
+    assert hedger.hedges_fired == 0
+    hedger.close()
+
+
+def test_hedge_errors():
+    hedger = Hedger(budget=1.0, max_delay=0.01)
+
+    def fail(_):
+        time.sleep(0.05)
+        raise ValueError("failed")
+
+    with pytest.raises(ValueError):
+        hedger.call(fail)
+    assert hedger.hedges_fired == 1
+    assert hedger.hedges_won == 0
+    hedger.close()
+
+
+def test_hedge_delay_percentile():
+    hedger = Hedger(percentile=90, min_delay=0.001, max_delay=1.0)
+    assert hedger.delay("get") == 1.0
+    for _ in range(30):
+        hedger.call(lambda _: None, "get")
+    assert hedger.delay("get") < 0.1
+    assert hedger.delay("head") == 1.0
+    hedger.close()
+
+
+def test_hedge_cancel_and_saturation():
+    hedger = Hedger(budget=1.0, max_delay=0.05, workers=2)
+    stopped = []
+
+    def request(cancelled):
+        if not stopped:
+            stopped.append(cancelled)
+            # the losing request stops once the hedge has succeeded
+            assert cancelled.wait(10)
+            return "slow"
+        return "fast"
+
+    assert hedger.call(request) == "fast"
+    assert hedger.hedges_won == 1
+
+    # no request waits for a thread, it runs on the caller's thread
+    release = threading.Event()
+    started = []
+
+    def blocked(_):
+        started.append(None)
+        return release.wait(10)
+
+    threads = [threading.Thread(target=hedger.call, args=(blocked,)) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    while len(started) < 2:
+        time.sleep(0.01)
+    assert hedger.call(lambda cancelled: threading.current_thread().name) == (
+        threading.current_thread().name
+    )
+    assert hedger.inline == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    hedger.close()
+
+
+def test_shared_hedger():
+    hedger = Hedger.shared("bucket", percentile=95, budget=0.1)
+    assert Hedger.shared("bucket", percentile=95, budget=0.1) is hedger
+    assert Hedger.shared("bucket", percentile=99, budget=0.1) is not hedger
+
+
+def test_s3_hedged_get(s3_storage_db, s3_bucket, monkeypatch):
+    assert s3_storage_db.hedger is None
+    storage = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        hedge_percentile=95,
+        hedge_budget=0.5,
+    )
+    file_id = storage.store(b"foo")
+    for _ in range(30):
+        assert storage.get(file_id) == b"foo"
+        assert storage.stat(file_id).size == 3
+    assert storage.hedger.hedges_fired == 0
+
+    # inject a slow first byte into one request
+    get_object = storage.s3_client.get_object
+    slow = [True]
+
+    def slow_get_object(**kwargs):
+        if slow and slow.pop():
+            time.sleep(2)
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(storage.s3_client, "get_object", slow_get_object)
+    started = time.monotonic()
+    assert storage.get(file_id) == b"foo"
+    assert time.monotonic() - started < 1.5
+    assert storage.hedger.hedges_fired == 1
+    assert storage.hedger.hedges_won == 1
+
+    with pytest.raises(StorageNotFoundError):
+        storage.get(uuid.UUID(int=1))
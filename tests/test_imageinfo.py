@@ -0,0 +1,157 @@
+import struct
+
+import pytest
+
+from simple_file_repository.imageinfo import (
+    NeedMoreData,
+    detect_format,
+    parse_image_info,
+)
+
+
+def make_exif_jpeg(jpeg: bytes, orientation: int, thumbnail: bytes = b"") -> bytes:
+    tiff = b"".join(
+        [
+            b"MM\x00\x2a",
+            struct.pack(">IH", 8, 1),
+            struct.pack(">HHIHH", 0x0112, 3, 1, orientation, 0),
+            # IFD1 follows IFD0
+            struct.pack(">I", 26 if thumbnail else 0),
+        ]
+    )
+    if thumbnail:
+        tiff += b"".join(
+            [
+                struct.pack(">H", 2),
+                struct.pack(">HHII", 0x0201, 4, 1, 56),
+                struct.pack(">HHII", 0x0202, 4, 1, len(thumbnail)),
+                struct.pack(">I", 0),
+                thumbnail,
+            ]
+        )
+    app1 = b"\xff\xe1" + struct.pack(">H", 8 + len(tiff)) + b"Exif\x00\x00" + tiff
+    return jpeg[:2] + app1 + jpeg[2:]
+
+
+def make_png(
+    width: int, height: int, animated: bool = False, text: bool = False
+) -> bytes:
+    def chunk(chunk_type: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + chunk_type + data + b"\x00" * 4
+
+    content = b"\x89PNG\r\n\x1a\n"
+    content += chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0))
+    if animated:
+        content += chunk(b"acTL", struct.pack(">II", 2, 0))
+    if text:
+        content += chunk(b"tEXt", b"Author\x00someone")
+    return content + chunk(b"IDAT", b"\x00" * 10) + chunk(b"IEND", b"")
+
+
+def make_gif(width: int, height: int, frames: int = 1, loop: bool = False) -> bytes:
+    content = b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0)
+    if loop:
+        content += b"\x21\xff\x0bNETSCAPE2.0\x03\x01\x00\x00\x00"
+    for _ in range(frames):
+        content += b"\x21\xf9\x04\x00\x00\x00\x00\x00"
+        content += b"\x2c" + struct.pack("<HHHHB", 0, 0, width, height, 0)
+        content += b"\x02\x02\x4c\x01\x00"
+    return content + b"\x3b"
+
+
+def make_webp(chunk_type: bytes, payload: bytes) -> bytes:
+    chunk = chunk_type + struct.pack("<I", len(payload)) + payload
+    return b"RIFF" + struct.pack("<I", 4 + len(chunk)) + b"WEBP" + chunk
+
+
+def test_jpeg(sample_image):
+    info = parse_image_info(sample_image)
+    assert info.format == "jpeg"
+    assert info.mime_type == "image/jpeg"
+    assert (info.width, info.height) == (329, 247)
+    assert info.orientation == 1
+    assert not info.animated
+    assert not info.metadata
+    # header is enough
+    assert parse_image_info(sample_image[:1024]).width == 329
+    # but segments before the scan may be missing
+    assert parse_image_info(sample_image[:200]).metadata
+
+
+def test_jpeg_orientation(sample_image):
+    info = parse_image_info(make_exif_jpeg(sample_image, 6))
+    assert info.orientation == 6
+    assert info.metadata
+    assert info.display_size == (247, 329)
+    assert parse_image_info(make_exif_jpeg(sample_image, 3)).display_size == (
+        329,
+        247,
+    )
+
+
+def test_jpeg_exif_thumbnail(sample_image):
+    content = make_exif_jpeg(sample_image, 8, thumbnail=sample_image)
+    info = parse_image_info(content)
+    assert info.orientation == 8
+    start, length = info.exif_thumbnail
+    end = start + length
+    assert content[start:end] == sample_image
+    assert parse_image_info(make_exif_jpeg(sample_image, 1)).exif_thumbnail is None
+
+
+def test_jpeg_truncated(sample_image):
+    with pytest.raises(NeedMoreData):
+        parse_image_info(sample_image[:100])
+    with pytest.raises(ValueError):
+        parse_image_info(b"\xff\xd8\xff\xda\x00\x02")
+
+
+def test_png():
+    info = parse_image_info(make_png(640, 480))
+    assert (info.format, info.width, info.height) == ("png", 640, 480)
+    assert not info.animated
+    assert not info.metadata
+    assert parse_image_info(make_png(10, 20, animated=True)).animated
+    assert parse_image_info(make_png(10, 20, text=True)).metadata
+    # metadata may follow image data
+    assert parse_image_info(make_png(10, 20)[:40]).metadata
+
+
+def test_gif():
+    info = parse_image_info(make_gif(30, 40))
+    assert (info.format, info.width, info.height) == ("gif", 30, 40)
+    assert not info.animated
+    assert not info.metadata
+    comment = make_gif(30, 40)[:13] + b"\x21\xfe\x02hi\x00" + make_gif(30, 40)[13:]
+    assert parse_image_info(comment).metadata
+    assert parse_image_info(make_gif(30, 40, frames=2)).animated
+    assert parse_image_info(make_gif(30, 40, loop=True)).animated
+
+
+def test_webp():
+    lossy = make_webp(
+        b"VP8 ", b"\x00\x00\x00\x9d\x01\x2a" + struct.pack("<HH", 300, 200)
+    )
+    assert (parse_image_info(lossy).width, parse_image_info(lossy).height) == (
+        300,
+        200,
+    )
+    lossless = make_webp(b"VP8L", b"\x2f" + struct.pack("<I", 99 | (49 << 14)))
+    assert (parse_image_info(lossless).width, parse_image_info(lossless).height) == (
+        100,
+        50,
+    )
+    extended = make_webp(b"VP8X", b"\x02\x00\x00\x00" + (999).to_bytes(3, "little") * 2)
+    info = parse_image_info(extended)
+    assert (info.width, info.height) == (1000, 1000)
+    assert info.animated
+    assert not info.metadata
+    with_exif = make_webp(b"VP8X", b"\x08\x00\x00\x00" + b"\x00" * 6)
+    assert parse_image_info(with_exif).metadata
+    assert not parse_image_info(lossy).metadata
+
+
+def test_not_image():
+    assert detect_format(b"hello world") is None
+    assert parse_image_info(b"hello world") is None
+    assert parse_image_info(b"") is None
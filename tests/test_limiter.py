@@ -0,0 +1,176 @@
+import threading
+import time
+
+import pytest
+from botocore.exceptions import ClientError
+
+from simple_file_repository.exceptions import StorageError, StorageThrottledError
+from simple_file_repository.limiter import AdaptiveLimiter
+from simple_file_repository.s3storage import S3Storage, is_throttling_error
+
+
+def slow_down_error():
+    return ClientError(
+        {
+            "Error": {"Code": "SlowDown", "Message": "Please reduce your request rate"},
+            "ResponseMetadata": {"HTTPStatusCode": 503},
+        },
+        "PutObject",
+    )
+
+
+def test_aimd():
+    limiter = AdaptiveLimiter(initial_limit=8, max_limit=10)
+    token = limiter.acquire()
+    limiter.release(token, throttled=True)
+    assert limiter.limit == 4
+    assert limiter.throttled == 1
+
+    # concurrent throttled requests decrease the limit once
+    tokens = [limiter.acquire() for _ in range(3)]
+    for token in tokens:
+        limiter.release(token, throttled=True)
+    assert limiter.limit == 2
+
+    for _ in range(100):
+        limiter.release(limiter.acquire())
+    assert limiter.limit == 10
+    assert limiter.in_flight == 0
+
+
+def test_min_limit():
+    limiter = AdaptiveLimiter(initial_limit=2, min_limit=2)
+    limiter.release(limiter.acquire(), throttled=True)
+    assert limiter.limit == 2
+
+
+def test_invalid():
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(initial_limit=0)
+    with pytest.raises(ValueError):
+        AdaptiveLimiter(backoff_ratio=1)
+
+
+def test_wait_and_fail_fast():
+    limiter = AdaptiveLimiter(initial_limit=1, wait_timeout=0)
+    token = limiter.acquire()
+    with pytest.raises(StorageThrottledError):
+        limiter.acquire()
+    assert limiter.rejected == 1
+
+    acquired = threading.Event()
+
+    def wait():
+        limiter.release(limiter.acquire(timeout=10))
+        acquired.set()
+
+    thread = threading.Thread(target=wait)
+    thread.start()
+    while limiter.queue_depth == 0:
+        assert not acquired.is_set()
+        time.sleep(0.001)
+    limiter.release(token)
+    thread.join()
+    assert acquired.is_set()
+    assert limiter.queue_depth == 0
+
+
+def test_call():
+    limiter = AdaptiveLimiter(initial_limit=4)
+    assert limiter.call(lambda: 42, is_throttling_error) == 42
+
+    def fail():
+        raise slow_down_error()
+
+    with pytest.raises(ClientError):
+        limiter.call(fail, is_throttling_error)
+    assert limiter.limit == 2
+    assert limiter.in_flight == 0
+
+
+def test_is_throttling_error():
+    assert is_throttling_error(slow_down_error())
+    not_found = ClientError(
+        {"Error": {"Code": "404"}, "ResponseMetadata": {"HTTPStatusCode": 404}},
+        "HeadObject",
+    )
+    assert not is_throttling_error(not_found)
+    assert not is_throttling_error(ValueError())
+
+
+def test_s3_storage_limiter(s3_storage_db, s3_bucket, monkeypatch):
+    monkeypatch.setattr(AdaptiveLimiter, "_shared", {})
+    storage = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        adaptive_concurrency=True,
+    )
+    other = S3Storage(
+        database="db2",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        adaptive_concurrency=True,
+    )
+    # shared per bucket
+    assert storage.limiter is other.limiter
+    shared_client = S3Storage(
+        database="db2",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        endpoint_url="http://localhost:1",
+        adaptive_concurrency=True,
+        s3_client=storage.s3_client,
+    )
+    # of the endpoint of a shared client
+    assert shared_client.limiter is storage.limiter
+    assert s3_storage_db.limiter is None
+    with pytest.raises(ValueError):
+        S3Storage(
+            database="db3",
+            bucket=s3_bucket,
+            region="us-east-1",
+            access_key_id="",
+            secret_access_key="",
+            adaptive_concurrency=True,
+            limiter_wait_timeout=0,
+        )
+
+    file_id = storage.store(b"foo")
+    assert storage.get(file_id) == b"foo"
+    initial_limit = storage.limiter.limit
+
+    put_object = storage.s3_client.put_object
+    failures = [slow_down_error(), slow_down_error()]
+
+    def flaky_put_object(**kwargs):
+        if failures:
+            raise failures.pop()
+        return put_object(**kwargs)
+
+    monkeypatch.setattr(storage.s3_client, "put_object", flaky_put_object)
+    for _ in range(2):
+        with pytest.raises(StorageError):
+            storage.store(b"bar")
+    assert storage.limiter.limit == initial_limit // 4
+    storage.store(b"bar")
+    assert storage.limiter.in_flight == 0
+    assert storage.count() == 2
+
+    # a slot is held while a body is streamed
+    handle = storage.open_file(file_id)
+    assert storage.limiter.in_flight == 1
+    assert handle.read(1) == b"f"
+    assert storage.limiter.in_flight == 1
+    handle.close()
+    handle.close()
+    assert storage.limiter.in_flight == 0
+    with storage.open_file(file_id) as handle:
+        assert handle.read() == b"foo"
+        assert storage.limiter.in_flight == 0
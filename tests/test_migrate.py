@@ -0,0 +1,102 @@
+import os
+import uuid
+
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.migrate import Migrator, main
+from simple_file_repository.s3storage import S3Storage
+
+
+def test_migrate_file_to_s3(file_storage_db, s3_storage_db, sample_image):
+    image_id = file_storage_db.store(sample_image)
+    text_id = file_storage_db.store(b"hello world")
+
+    stats = Migrator(file_storage_db, s3_storage_db, workers=2).run()
+
+    assert stats.copied == 2
+    assert stats.failed == 0
+    assert stats.bytes == len(sample_image) + len(b"hello world")
+    assert s3_storage_db.count() == 2
+    assert s3_storage_db.get(image_id) == sample_image
+    assert s3_storage_db.get_mimetype(image_id) == "image/jpeg"
+    assert s3_storage_db.get(text_id) == b"hello world"
+
+
+def test_migrate_metadata(s3_storage_db, s3_bucket, monkeypatch):
+    destination = S3Storage(
+        database="dest",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+    )
+    file_id = s3_storage_db.store(
+        b"hello world",
+        content_type="text/plain",
+        tags=dict(kind="thumb"),
+        cache_control="public, max-age=60",
+    )
+
+    def get(_):
+        raise AssertionError("object is downloaded")
+
+    # copied server-side
+    monkeypatch.setattr(s3_storage_db, "get", get)
+    stats = Migrator(s3_storage_db, destination).run()
+    assert stats.copied == 1
+    assert stats.bytes == len(b"hello world")
+
+    stat = destination.stat(file_id, with_tags=True)
+    assert stat.content_type == "text/plain"
+    assert stat.tags == dict(kind="thumb")
+    assert stat.cache_control == "public, max-age=60"
+
+
+def test_migrate_skip_existing(file_storage_db, s3_storage_db):
+    file_id = file_storage_db.store(b"foo")
+    s3_storage_db.store(b"foo", override_id=file_id)
+    file_storage_db.store(b"bar")
+
+    stats = Migrator(file_storage_db, s3_storage_db).run()
+
+    assert stats.copied == 1
+    assert stats.skipped == 1
+    assert s3_storage_db.count() == 2
+
+
+def test_migrate_checkpoint_resume(file_storage_db, tmpdir):
+    destination = FileStorage(str(tmpdir), "dest")
+    file_ids = [file_storage_db.store(b"content") for _ in range(5)]
+    checkpoint_path = os.path.join(str(tmpdir), "checkpoint.txt")
+
+    stats = Migrator(file_storage_db, destination, checkpoint_path=checkpoint_path).run(
+        [file_id.hex for file_id in file_ids[:2]]
+    )
+    assert stats.copied == 2
+
+    # checkpointed objects are not even checked in destination
+    stats = Migrator(
+        file_storage_db,
+        destination,
+        checkpoint_path=checkpoint_path,
+        skip_existing=False,
+    ).run()
+    assert stats.copied == 3
+    assert stats.skipped == 2
+    assert destination.count() == 5
+
+
+def test_migrate_missing_source(file_storage_db, tmpdir):
+    destination = FileStorage(str(tmpdir), "dest")
+    stats = Migrator(file_storage_db, destination).run([uuid.uuid4().hex])
+    assert stats.failed == 1
+    assert destination.count() == 0
+
+
+def test_migrate_cli(file_storage_db, tmpdir):
+    file_id = file_storage_db.store(b"content")
+    source = "file://" + os.path.join(str(tmpdir), "db")
+    destination = os.path.join(str(tmpdir), "dest")
+
+    assert main([source, destination, "--workers", "1"]) == 0
+
+    assert FileStorage(str(tmpdir), "dest").get(file_id) == b"content"
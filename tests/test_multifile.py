@@ -0,0 +1,136 @@
+import os
+import uuid
+
+import pytest
+
+from simple_file_repository.exceptions import StorageExistsError, StorageNotFoundError
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.multifilestorage import DiskRoot, MultiFileStorage
+
+
+@pytest.fixture(name="disk_paths")
+def fixture_disk_paths(tmpdir):
+    return [os.path.join(str(tmpdir), "disk{}".format(index)) for index in range(4)]
+
+
+def test_spread(disk_paths):
+    storage = MultiFileStorage(disk_paths[:3], "db")
+    file_ids = [storage.store(b"content") for _ in range(90)]
+    assert storage.count() == 90
+    assert set(storage.list()) == {file_id.hex for file_id in file_ids}
+    for path in disk_paths[:3]:
+        assert FileStorage(path, "db").count() > 10
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+        assert storage.exists(file_id)
+    assert storage.usage().count == 90
+
+    storage.delete(file_ids[0])
+    assert not storage.exists(file_ids[0])
+    with pytest.raises(StorageNotFoundError):
+        storage.get(file_ids[0])
+    with pytest.raises(StorageNotFoundError):
+        storage.delete(file_ids[0])
+
+
+def test_weights(disk_paths):
+    storage = MultiFileStorage(
+        [DiskRoot(disk_paths[0], weight=9), DiskRoot(disk_paths[1], weight=1)], "db"
+    )
+    for _ in range(200):
+        storage.store(b"x")
+    assert FileStorage(disk_paths[0], "db").count() > 150
+
+
+def test_lookup_probes(disk_paths, monkeypatch):
+    storage = MultiFileStorage(disk_paths, "db")
+    file_id = storage.store(b"content")
+    probes = []
+    original_exists = FileStorage.exists
+
+    def counting_exists(self, probed_id):
+        probes.append(self.storage_directory)
+        return original_exists(self, probed_id)
+
+    monkeypatch.setattr(FileStorage, "exists", counting_exists)
+    assert storage.exists(file_id)
+    assert len(probes) == 1
+    probes.clear()
+    # a missing object is looked up on every root
+    assert not storage.exists(uuid.uuid4())
+    assert len(probes) == 4
+
+
+def test_add_root_rebalance(disk_paths):
+    storage = MultiFileStorage(disk_paths[:2], "db")
+    file_ids = [storage.store(b"content") for _ in range(60)]
+
+    storage.add_root(disk_paths[2], rebalance=False)
+    # objects placed on the new root are found on their previous root
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+
+    # several root changes, some objects rank below two new roots
+    storage.add_root(disk_paths[3], rebalance=False)
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+        assert storage.get_checksum(file_id) is None
+    # an id stored on its previous root is not stored again
+    with pytest.raises(StorageExistsError):
+        storage.store(b"other", override_id=file_ids[0])
+    storage.delete(file_ids.pop())
+
+    storage.start_rebalance()
+    assert storage.wait_rebalance(timeout=30)
+    assert FileStorage(disk_paths[2], "db").count() > 5
+    assert FileStorage(disk_paths[3], "db").count() > 5
+    assert storage.count() == 59
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+
+
+def test_drain(disk_paths, monkeypatch):
+    storage = MultiFileStorage(disk_paths[:3], "db")
+    file_ids = [storage.store(b"content") for _ in range(30)]
+
+    storage.set_mode(disk_paths[0], DiskRoot.DRAINING, rebalance=False)
+    new_ids = [storage.store(b"new") for _ in range(30)]
+
+    def get(*_):
+        raise AssertionError("moved file is read into memory")
+
+    # files are copied by links or streams
+    with monkeypatch.context() as patch:
+        patch.setattr(FileStorage, "get", get)
+        moved = storage.rebalance(bytes_per_sec=10**9)
+    assert moved > 0
+    assert FileStorage(disk_paths[0], "db").count() == 0
+    assert storage.count() == 60
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+    for file_id in new_ids:
+        assert storage.get(file_id) == b"new"
+
+
+def test_read_only(disk_paths):
+    storage = MultiFileStorage(disk_paths[:2], "db")
+    file_ids = [storage.store(b"content") for _ in range(20)]
+    storage.set_mode(disk_paths[0], DiskRoot.READ_ONLY, rebalance=False)
+    on_read_only = FileStorage(disk_paths[0], "db").count()
+    for _ in range(20):
+        storage.store(b"new")
+    assert storage.rebalance() == 0
+    assert FileStorage(disk_paths[0], "db").count() == on_read_only
+    for file_id in file_ids:
+        assert storage.get(file_id) == b"content"
+
+
+def test_copy(disk_paths, file_storage_db):
+    storage = MultiFileStorage(disk_paths[:3], "db")
+    file_id = storage.store(b"content")
+    copy_ids = [storage.copy(file_id) for _ in range(10)]
+    for copy_id in copy_ids:
+        assert storage.get(copy_id) == b"content"
+    assert storage.count() == 11
+    copy_id = storage.copy(file_id, destination=file_storage_db)
+    assert file_storage_db.get(copy_id) == b"content"
@@ -8,9 +8,11 @@ from simple_file_repository.exceptions import (
     StorageNotInitializedError,
 )
 from simple_file_repository.filestorage import FileStorage
-from simple_file_repository.photostorage import PhotoStorage
+from simple_file_repository.photostorage import PhotoStorage, ThumbnailProfile
 from simple_file_repository.photostorages import PhotoStorages
 
+from .test_imageinfo import make_exif_jpeg, make_gif
+
 
 def test_write(file_storage_db):
     storage = PhotoStorage(storage=file_storage_db, imagemagick_convert="")
@@ -125,6 +127,90 @@ def test_photo_storages_multi(s3_client, s3_bucket, tmpdir):
     assert storages["dbs3"].count() == 1
 
 
+def init_storages(storages, tmpdir, names_for_s3=(), bucket=""):
+    storages.init_app(
+        names=[],
+        storage_directory=str(tmpdir),
+        names_for_s3=list(names_for_s3),
+        imagemagick_convert="",
+        access_key_id="",
+        secret_access_key="",
+        region="us-east-1",
+        bucket=bucket,
+        endpoint_url=None,
+        default_cache_control=None,
+    )
+
+
+def test_photo_storages_register(tmpdir):
+    storages = PhotoStorages()
+    with pytest.raises(StorageNotInitializedError):
+        storages.register("db")
+    init_storages(storages, tmpdir)
+
+    storages.register("db")
+    assert "db" in storages
+    assert storages["db"].count() == 0
+    # directories are created on first store
+    assert not os.path.isdir(os.path.join(str(tmpdir), "db"))
+    file_id = storages["db"].store(b"hello world")
+    assert storages["db"].get(file_id) == b"hello world"
+
+    with pytest.raises(PhotoStorageNotFoundError):
+        storages["tenant"].count()
+    assert storages.get_or_create("tenant").count() == 0
+    assert storages.names() == ["db", "tenant"]
+    assert len(storages) == 2
+
+    for name in ("", " ", "a/b", ".", "..", "a/../b", "a\\b", "a b", "db\n"):
+        with pytest.raises(ValueError):
+            storages.register(name)
+
+
+def test_photo_storages_lru(tmpdir):
+    storages = PhotoStorages(max_live_storages=2)
+    init_storages(storages, tmpdir)
+    names = ["tenant-{}".format(i) for i in range(5)]
+    file_ids = {name: storages.get_or_create(name).store(b"x") for name in names}
+
+    storage = storages[names[-1]]
+    assert storages[names[-1]] is storage
+    assert storages[names[0]] is not storages.get_or_create(names[1])
+    # evicted storages are recreated with the same data
+    for name in names:
+        assert storages[name].get(file_ids[name]) == b"x"
+    assert len(storages) == 5
+    live = [storages[name] for name in names[-2:]]
+    assert set(storages.usage_by_database()) == set(names)
+    assert storages.usage().count == 5
+    storages.clean()
+    # sweeps do not evict recently used storages
+    assert [storages[name] for name in names[-2:]] == live
+
+    with pytest.raises(ValueError):
+        PhotoStorages(max_live_storages=0)
+
+
+def test_photo_storages_patterns(s3_client, s3_bucket, tmpdir):
+    s3_client.create_bucket(Bucket=s3_bucket)
+    storages = PhotoStorages()
+    init_storages(storages, tmpdir, names_for_s3=["eu-*"], bucket=s3_bucket)
+
+    assert storages.is_s3("eu-1")
+    assert not storages.is_s3("us-1")
+    assert storages.get_or_create("us-1").is_local()
+    s3_storages = [storages.get_or_create("eu-{}".format(i)) for i in range(3)]
+    assert not any(storage.is_local() for storage in s3_storages)
+
+    file_id = s3_storages[0].store(b"hello world")
+    assert storages["eu-0"].get(file_id) == b"hello world"
+    assert storages["eu-1"].count() == 0
+    # one client is shared by all S3 databases
+    # pylint: disable=protected-access
+    clients = {id(storage._storage.s3_client) for storage in s3_storages}
+    assert len(clients) == 1
+
+
 def test_thumb_missing_convert(s3_storage_db, sample_image):
     storage = PhotoStorage(s3_storage_db, "")
 
@@ -163,3 +249,155 @@ def test_thumb(s3_storage_db, sample_image, convert_path):
 
     assert storage.exists(thumb_id)
     assert storage.get_mimetype(thumb_id) == "image/jpeg"
+
+
+def test_image_info(s3_storage_db, sample_image):
+    storage = PhotoStorage(s3_storage_db, "")
+    file_id = storage.store(sample_image, content_type="image/jpeg")
+    info = storage.get_image_info(file_id)
+    assert (info.format, info.width, info.height) == ("jpeg", 329, 247)
+    assert storage.get_image_info(storage.store(b"hello")) is None
+    assert storage.get_image_info(storage.store(b"")) is None
+
+
+def test_thumb_not_image(file_storage_db, fake_convert, monkeypatch):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(b"hello world")
+
+    def get(_):
+        raise AssertionError("whole file is read")
+
+    # rejected by the header
+    monkeypatch.setattr(file_storage_db, "get", get)
+    with pytest.raises(RuntimeError):
+        storage.generate_thumbnail(file_id, "image/jpeg")
+    assert not os.path.exists(log_path)
+
+
+def test_thumb_passthrough(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(sample_image)
+
+    thumb_id = storage.generate_thumbnail(
+        file_id, "image/jpeg", thumb_size=400, passthrough=True
+    )
+    assert storage.get(thumb_id) == sample_image
+    assert not os.path.exists(log_path)
+
+    # too large or not a requested format
+    storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=200, passthrough=True)
+    storage.generate_thumbnail(file_id, "image/png", thumb_size=400, passthrough=True)
+    with open(log_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 2
+
+    # metadata is not copied
+    file_id = storage.store(make_exif_jpeg(sample_image, 1))
+    storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=400, passthrough=True)
+    with open(log_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 3
+
+
+def test_thumb_unknown_format(file_storage_db, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    # e.g. TIFF stored without a mime type
+    file_id = storage.store(b"II*\x00" + b"\x00" * 100, "application/octet-stream")
+    assert storage.exists(storage.generate_thumbnail(file_id, "image/png"))
+    assert os.path.exists(log_path)
+
+
+def test_thumb_animated_first_frame(file_storage_db, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(make_gif(30, 40, frames=3))
+    storage.generate_thumbnail(file_id, "image/gif")
+    with open(log_path, encoding="utf-8") as f:
+        assert f.read().split()[0].endswith("[0]")
+
+
+def _convert_args(log_path):
+    with open(log_path, encoding="utf-8") as f:
+        return [line.split() for line in f]
+
+
+def test_thumb_profiles(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(sample_image)
+
+    storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100)
+    storage.generate_thumbnail(
+        file_id, "image/jpeg", thumb_size=100, profile=ThumbnailProfile.BALANCED
+    )
+    storage.thumbnail_profile = ThumbnailProfile.FAST
+    storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=100)
+    quality, balanced, fast = _convert_args(log_path)
+    assert "-define" not in quality and "-sample" not in quality
+    assert balanced[:2] == ["-define", "jpeg:size=200x200"]
+    assert "-sample" not in balanced
+    assert fast[:2] == ["-define", "jpeg:size=200x200"]
+    assert fast[fast.index("-sample") + 1] == "200x200>"
+    assert fast.index("-sample") < fast.index("-thumbnail")
+
+
+def test_thumb_exif_thumbnail(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert, ThumbnailProfile.FAST)
+    file_id = storage.store(make_exif_jpeg(sample_image, 6, thumbnail=sample_image))
+
+    thumb_id = storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=200)
+    # fake convert copies its source, that is the embedded thumbnail
+    assert storage.get(thumb_id) == sample_image
+    (args,) = _convert_args(log_path)
+    assert "-define" not in args
+    assert args[args.index("-orient") + 1] == "RightTop"
+    assert args.index("-orient") < args.index("-auto-orient")
+
+    # embedded thumbnail is too small
+    thumb_id = storage.generate_thumbnail(file_id, "image/jpeg", thumb_size=400)
+    assert storage.get(thumb_id) != sample_image
+    assert "-orient" not in _convert_args(log_path)[1]
+
+
+def test_thumb_variants(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(sample_image)
+
+    thumbnails = storage.generate_thumbnail_variants(
+        file_id, ["image/avif", "image/webp", "image/jpeg"]
+    )
+    assert list(thumbnails) == ["image/avif", "image/webp", "image/jpeg"]
+    assert len(set(thumbnails.values())) == 3
+    assert storage.count() == 4
+    # decoded once
+    (args,) = _convert_args(log_path)
+    assert args[0] == "-respect-parentheses"
+    assert args.count("-write") == 2
+    assert args[-1].endswith(".jpg")
+    assert args[-7:-1] == [
+        "-quality",
+        "82",
+        "-interlace",
+        "JPEG",
+        "-sampling-factor",
+        "4:2:0",
+    ]
+    webp = args.index("(", args.index("(") + 1)
+    assert (args[webp + 2], args[webp + 3]) == ("-quality", "80")
+
+
+def test_thumb_variants_passthrough(file_storage_db, sample_image, fake_convert):
+    convert, log_path = fake_convert
+    storage = PhotoStorage(file_storage_db, convert)
+    file_id = storage.store(sample_image)
+
+    thumbnails = storage.generate_thumbnail_variants(
+        file_id, ["image/webp", "image/jpeg"], thumb_size=400, passthrough=True
+    )
+    assert storage.get(thumbnails["image/jpeg"]) == sample_image
+    (args,) = _convert_args(log_path)
+    assert "-write" not in args
+    assert args[-1].endswith(".webp")
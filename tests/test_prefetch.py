@@ -0,0 +1,129 @@
+import threading
+import time
+import uuid
+
+import pytest
+
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.prefetchingstorage import PrefetchingStorage
+
+
+class SlowStorage:
+    """Counts reads of a storage, reads wait until released."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.reads = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __getattr__(self, name):
+        return getattr(self.storage, name)
+
+    def get(self, file_id):
+        self.reads.append(file_id)
+        self.release.wait(10)
+        return self.storage.get(file_id)
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def test_prefetch(file_storage_db):
+    file_ids = [file_storage_db.store("file {}".format(i).encode()) for i in range(5)]
+    backend = SlowStorage(file_storage_db)
+    storage = PrefetchingStorage(backend, workers=2)
+    try:
+        storage.prefetch(file_ids + file_ids + [uuid.uuid4()])
+        wait_for(lambda: storage.prefetched == 5 and storage.failed == 1)
+        # duplicates are dropped
+        assert len(backend.reads) == 6
+        storage.prefetch(file_ids)
+        assert storage.pending_count() == 0
+
+        assert storage.get(file_ids[0]) == b"file 0"
+        assert storage.get(file_ids[0]) == b"file 0"
+        assert storage.read_head(file_ids[1], 4) == b"file"
+        assert len(backend.reads) == 6
+        assert storage.used == 2
+        assert storage.hits == 3
+
+        assert storage.get(file_storage_db.store(b"cold")) == b"cold"
+        assert storage.misses == 1
+
+        storage.delete(file_ids[2])
+        assert storage.wasted == 1
+        assert not storage.exists(file_ids[2])
+
+        # a copy is made by the underlying storage
+        copy_id = storage.copy(file_ids[3])
+        assert file_storage_db.get(copy_id) == b"file 3"
+        assert len(backend.reads) == 7
+    finally:
+        storage.close()
+
+
+def test_prefetch_priority_cancel(file_storage_db):
+    file_ids = [file_storage_db.store(b"x") for _ in range(6)]
+    backend = SlowStorage(file_storage_db)
+    backend.release.clear()
+    storage = PrefetchingStorage(backend, workers=1, max_pending=4)
+    try:
+        storage.prefetch(file_ids[:1])
+        wait_for(lambda: backend.reads)
+        # never blocks while the only worker is busy
+        storage.prefetch(file_ids[1:3])
+        storage.prefetch(file_ids[3:4], priority=10)
+        storage.prefetch(file_ids[4:], priority=5)
+        assert storage.dropped == 1
+        assert storage.cancel([file_ids[1]]) == 1
+
+        # a get joins the in-flight read
+        result = []
+        thread = threading.Thread(
+            target=lambda: result.append(storage.get(file_ids[0]))
+        )
+        thread.start()
+        backend.release.set()
+        thread.join()
+        assert result == [b"x"]
+
+        wait_for(lambda: storage.pending_count() == 0 and len(backend.reads) == 4)
+        assert backend.reads == [file_ids[0], file_ids[3], file_ids[4], file_ids[2]]
+        assert storage.used == 1
+        assert storage.cancel() == 0
+        assert storage.cancelled == 1
+    finally:
+        storage.close()
+
+
+def test_prefetch_disk_cache(s3_storage_db, tmpdir):
+    file_ids = [s3_storage_db.store(bytes(100)) for _ in range(5)]
+    cache = FileStorage(str(tmpdir), "cache")
+    storage = PrefetchingStorage(s3_storage_db, cache=cache, cache_bytes=300)
+    try:
+        storage.prefetch(file_ids[:3])
+        wait_for(lambda: storage.prefetched == 3)
+        assert cache.count() == 3
+        assert storage.get(file_ids[0]) == bytes(100)
+
+        storage.prefetch(file_ids[3:])
+        wait_for(lambda: storage.prefetched == 5)
+        # least recently used unread files are evicted
+        assert cache.count() == 3
+        assert cache.exists(file_ids[0])
+        assert storage.wasted == 2
+        assert storage.get(file_ids[1]) == bytes(100)
+        assert storage.misses == 1
+
+        storage.clean()
+        assert cache.count() == 0
+    finally:
+        storage.close()
+
+    with pytest.raises(ValueError):
+        PrefetchingStorage(s3_storage_db, workers=0)
@@ -1,12 +1,21 @@
 import logging
+import os
+import re
 import time
 import uuid
 
+import moto.s3.models
 import pytest
 import requests
+from botocore.exceptions import IncompleteReadError
 
-from simple_file_repository.exceptions import StorageError
-from simple_file_repository.s3storage import S3Storage
+from simple_file_repository import s3storage
+from simple_file_repository.exceptions import StorageError, StorageNotFoundError
+from simple_file_repository.s3storage import (
+    KEY_LAYOUT_FLAT,
+    KEY_LAYOUT_HASHED,
+    S3Storage,
+)
 
 
 def test_moto_works(s3_client, s3_bucket):
@@ -265,3 +274,268 @@ def test_clean_ignored(s3_storage_db):
     assert s3_storage_db.count() == 1
     s3_storage_db.clean()
     assert s3_storage_db.count() == 1
+
+
+def test_list_sibling_database(s3_storage_db, s3_bucket):
+    sibling = S3Storage(
+        database="db2",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+    )
+    sibling.store(b"foo")
+    file_id = s3_storage_db.store(b"bar")
+    assert s3_storage_db.count() == 1
+    assert list(s3_storage_db.list()) == [file_id.hex]
+    assert sibling.count() == 1
+
+
+def test_list_sharded(s3_storage_db):
+    # force splitting of shards with tiny pages
+    s3_storage_db.list_page_size = 2
+    file_ids = {s3_storage_db.store(b"foo").hex for _ in range(60)}
+    listed = list(s3_storage_db.list())
+    assert len(listed) == 60
+    assert set(listed) == file_ids
+    assert s3_storage_db.count() == 60
+
+    s3_storage_db.list_max_depth = 1
+    assert set(s3_storage_db.list()) == file_ids
+    assert s3_storage_db.count() == 60
+
+
+def test_get_ranged(s3_storage_db, tmpdir):
+    content = os.urandom(100 * 1024 + 7)
+    file_id = s3_storage_db.store(content)
+
+    assert s3_storage_db.get_ranged(file_id, part_size=10 * 1024, workers=4) == content
+    assert s3_storage_db.get_ranged(file_id) == content
+
+    path = os.path.join(str(tmpdir), "download.bin")
+    s3_storage_db.download(file_id, path, part_size=10 * 1024, workers=4)
+    with open(path, "rb") as f:
+        assert f.read() == content
+
+
+def test_get_ranged_missing(s3_storage_db):
+    with pytest.raises(StorageNotFoundError):
+        s3_storage_db.get_ranged(uuid.uuid4())
+
+
+def test_read_head(s3_storage_db, monkeypatch):
+    file_id = s3_storage_db.store(b"hello world")
+    assert s3_storage_db.read_head(file_id, 5) == b"hello"
+    assert s3_storage_db.read_head(s3_storage_db.store(b""), 5) == b""
+    with pytest.raises(StorageNotFoundError):
+        s3_storage_db.read_head(uuid.uuid4(), 5)
+
+    def get_object(**kwargs):
+        raise AssertionError("requested {}".format(kwargs))
+
+    # nothing is requested for no bytes
+    monkeypatch.setattr(s3_storage_db.s3_client, "get_object", get_object)
+    assert s3_storage_db.read_head(file_id, 0) == b""
+
+
+def test_get_ranged_retry_part(s3_storage_db, monkeypatch):
+    content = os.urandom(64 * 1024)
+    file_id = s3_storage_db.store(content)
+    s3_storage_db.retry_base_delay = 0.001
+
+    original_get_object = s3_storage_db.s3_client.get_object
+    ranges = []
+    failed = []
+
+    def flaky_get_object(**kwargs):
+        ranges.append(kwargs.get("Range"))
+        if kwargs["Range"] == "bytes=16384-32767" and not failed:
+            failed.append(kwargs["Range"])
+            raise IncompleteReadError(actual_bytes=1, expected_bytes=16384)
+        return original_get_object(**kwargs)
+
+    monkeypatch.setattr(s3_storage_db.s3_client, "get_object", flaky_get_object)
+
+    assert s3_storage_db.get_ranged(file_id, part_size=16 * 1024) == content
+    # only the failed range is requested again
+    assert len(ranges) == 5
+    assert ranges.count("bytes=16384-32767") == 2
+
+
+def test_get_retry_exhausted(s3_storage_db, monkeypatch):
+    file_id = s3_storage_db.store(b"data")
+    s3_storage_db.retry_base_delay = 0.001
+
+    def broken_get_object(**kwargs):
+        raise IncompleteReadError(actual_bytes=1, expected_bytes=4)
+
+    monkeypatch.setattr(s3_storage_db.s3_client, "get_object", broken_get_object)
+    sleeps = []
+    monkeypatch.setattr(time, "sleep", sleeps.append)
+    with pytest.raises(StorageError):
+        s3_storage_db.get(file_id)
+    # no backoff after the last attempt
+    assert len(sleeps) == s3_storage_db.get_attempts - 1
+
+
+def test_download_failed(s3_storage_db, tmpdir):
+    path = os.path.join(str(tmpdir), "download.bin")
+    with open(path, "wb") as f:
+        f.write(b"previous")
+    with pytest.raises(StorageNotFoundError):
+        s3_storage_db.download(uuid.uuid4(), path)
+    # the target and its directory are untouched
+    assert os.listdir(str(tmpdir)) == ["download.bin"]
+    with open(path, "rb") as f:
+        assert f.read() == b"previous"
+
+
+def test_stat(s3_storage_db, sample_image):
+    file_id = s3_storage_db.store(
+        sample_image,
+        content_type="image/jpeg",
+        tags=dict(kind="thumb"),
+        cache_control="public",
+    )
+    stat = s3_storage_db.stat(file_id)
+    assert stat.size == len(sample_image)
+    assert stat.content_type == "image/jpeg"
+    assert stat.cache_control == "public"
+    assert stat.etag
+    assert stat.mtime > 0
+    assert stat.tags is None
+
+    assert s3_storage_db.stat(file_id, with_tags=True).tags == dict(kind="thumb")
+
+    with pytest.raises(StorageNotFoundError):
+        s3_storage_db.stat(uuid.uuid4())
+
+
+def test_stat_many(s3_storage_db):
+    file_id1 = s3_storage_db.store(b"foo")
+    file_id2 = s3_storage_db.store(b"barbaz")
+    stats = s3_storage_db.stat_many([file_id1, uuid.uuid4(), file_id2], workers=2)
+    assert [stat.size if stat else None for stat in stats] == [3, None, 6]
+
+
+def _hashed_storage(s3_bucket, **kwargs):
+    return S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        key_layout=KEY_LAYOUT_HASHED,
+        **kwargs,
+    )
+
+
+def test_hashed_key_layout(s3_storage_db, s3_client, s3_bucket):
+    storage = _hashed_storage(s3_bucket, key_fanout=16)
+    storage.list_page_size = 2
+    file_ids = {storage.store(b"foo").hex for _ in range(40)}
+    keys = [
+        content["Key"]
+        for content in s3_client.list_objects_v2(Bucket=s3_bucket)["Contents"]
+    ]
+    assert all(re.fullmatch(r"db/[0-9a-f]/[0-9a-f]{32}", key) for key in keys)
+    assert len({key.split("/")[1] for key in keys}) > 1
+
+    assert set(storage.list()) == file_ids
+    assert storage.count() == 40
+    file_id = uuid.UUID(hex=file_ids.pop())
+    assert storage.get(file_id) == b"foo"
+    assert storage.stat(file_id).size == 3
+    storage.delete(file_id)
+    assert not storage.exists(file_id)
+    # flat layout does not see hashed keys
+    assert not s3_storage_db.exists(uuid.UUID(hex=file_ids.pop()))
+
+
+def test_hashed_key_layout_invalid(s3_bucket):
+    with pytest.raises(ValueError):
+        _hashed_storage(s3_bucket, key_fanout=1)
+    with pytest.raises(ValueError):
+        _hashed_storage(s3_bucket, fallback_key_layout=3)
+
+
+def test_migrate_key_layout(s3_storage_db, s3_bucket):
+    file_ids = [
+        s3_storage_db.store(b"foo", content_type="text/x-foo", tags={"a": "b"})
+        for _ in range(10)
+    ]
+    storage = _hashed_storage(s3_bucket, fallback_key_layout=KEY_LAYOUT_FLAT)
+    # readable before migration
+    assert storage.get(file_ids[0]) == b"foo"
+    assert storage.stat(file_ids[0]).content_type == "text/x-foo"
+    assert (
+        storage.get_path(file_ids[0]).split("?")[0].endswith("/db/" + file_ids[0].hex)
+    )
+
+    assert storage.migrate_key_layout(workers=4) == 10
+    assert storage.migrate_key_layout(workers=4) == 0
+    assert s3_storage_db.count() == 10
+    assert not s3_storage_db.exists(file_ids[0])
+
+    storage = _hashed_storage(s3_bucket)
+    assert set(storage.list()) == {file_id.hex for file_id in file_ids}
+    assert storage.get(file_ids[0]) == b"foo"
+    stat = storage.stat(file_ids[0], with_tags=True)
+    assert stat.content_type == "text/x-foo"
+    assert stat.tags == {"a": "b"}
+    assert storage.get_path(file_ids[0]) != s3_storage_db.get_path(file_ids[0])
+
+
+def test_copy(s3_storage_db, s3_bucket):
+    file_id = s3_storage_db.store(
+        b"foo", content_type="text/x-foo", tags={"a": "b"}, cache_control="max-age=1"
+    )
+    copy_id = s3_storage_db.copy(file_id)
+    assert copy_id != file_id
+    assert s3_storage_db.get(copy_id) == b"foo"
+    stat = s3_storage_db.stat(copy_id, with_tags=True)
+    assert (stat.content_type, stat.cache_control) == ("text/x-foo", "max-age=1")
+    assert stat.tags == {"a": "b"}
+
+    dst_id = uuid.uuid4()
+    copy_id = s3_storage_db.copy(
+        file_id, dst_id, tags={"c": "d"}, cache_control="no-cache"
+    )
+    assert copy_id == dst_id
+    stat = s3_storage_db.stat(dst_id, with_tags=True)
+    assert (stat.content_type, stat.cache_control) == ("text/x-foo", "no-cache")
+    assert stat.tags == {"c": "d"}
+
+    # another database of the same endpoint
+    other = _hashed_storage(s3_bucket, track_usage=True)
+    other.database = "other"
+    copy_id = s3_storage_db.copy(file_id, destination=other)
+    assert other.get(copy_id) == b"foo"
+    assert not s3_storage_db.exists(copy_id)
+    with pytest.raises(StorageNotFoundError):
+        s3_storage_db.copy(uuid.uuid4())
+
+
+def test_copy_multipart(s3_storage_db, s3_bucket, monkeypatch):
+    monkeypatch.setattr(moto.s3.models, "S3_UPLOAD_PART_MIN_SIZE", 1024)
+    monkeypatch.setattr(s3storage.DefaultParams, "MAX_COPY_OBJECT_SIZE", 1024)
+    monkeypatch.setattr(s3storage.DefaultParams, "COPY_PART_SIZE", 100 * 1024)
+    content = os.urandom(250 * 1024)
+    file_id = s3_storage_db.store(content, content_type="text/x-foo", tags={"a": "b"})
+    copy_id = s3_storage_db.copy(file_id)
+    assert s3_storage_db.get(copy_id) == content
+    stat = s3_storage_db.stat(copy_id, with_tags=True)
+    assert stat.content_type == "text/x-foo"
+    assert stat.tags == {"a": "b"}
+
+    # large objects are moved by a multipart copy as well
+    storage = _hashed_storage(s3_bucket)
+    assert storage.migrate_key_layout() == 2
+    assert storage.get(file_id) == content
+    assert storage.stat(file_id, with_tags=True).tags == {"a": "b"}
+
+
+def test_copy_to_file_storage(s3_storage_db, file_storage_db):
+    file_id = s3_storage_db.store(b"foo")
+    copy_id = s3_storage_db.copy(file_id, destination=file_storage_db)
+    assert file_storage_db.get(copy_id) == b"foo"
@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import os
+import time
+
+import pytest
+
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.s3storage import S3Storage
+from simple_file_repository.scrubber import Scrubber
+from simple_file_repository.utils import RateLimiter
+
+
+@pytest.fixture(name="checksummed_file_storage")
+def fixture_checksummed_file_storage(tmpdir):
+    return FileStorage(str(tmpdir), "db", checksum_algorithm="sha256")
+
+
+def test_file_checksum(checksummed_file_storage, sample_image):
+    file_id = checksummed_file_storage.store(sample_image)
+    checksum = "sha256:" + hashlib.sha256(sample_image).hexdigest()
+    assert checksummed_file_storage.get_checksum(file_id) == checksum
+    assert checksummed_file_storage.count() == 1
+    assert list(checksummed_file_storage.list()) == [file_id.hex]
+
+    stripe_dir = os.path.dirname(checksummed_file_storage.get_path(file_id))
+    checksummed_file_storage.delete(file_id)
+    assert not os.listdir(stripe_dir)
+
+
+def test_scrub_file_storage(checksummed_file_storage):
+    file_id = checksummed_file_storage.store(b"hello world")
+    corrupted_id = checksummed_file_storage.store(b"hello world")
+    with open(checksummed_file_storage.get_path(corrupted_id), "r+b") as f:
+        f.write(b"j")
+
+    report = Scrubber(checksummed_file_storage).run()
+    assert report.checked == 2
+    assert report.ok == 1
+    assert report.mismatched == [corrupted_id.hex]
+    assert Scrubber(checksummed_file_storage).verify(file_id) == Scrubber.OK
+
+
+def test_scrub_unchecksummed(file_storage_db):
+    file_storage_db.store(b"hello world")
+    report = Scrubber(file_storage_db).run()
+    assert report.checked == 1
+    assert report.unchecksummed == 1
+
+
+def test_scrub_unverifiable(checksummed_file_storage):
+    file_id = checksummed_file_storage.store(b"hello world")
+    checksum_path = os.path.splitext(checksummed_file_storage.get_path(file_id))[0]
+    # e.g. xxhash is not installed
+    with open(checksum_path + ".sum", "w", encoding="ascii") as f:
+        f.write("unknown:0123")
+    report = Scrubber(checksummed_file_storage).run()
+    assert report.checked == 0
+    assert report.unverifiable == [file_id.hex]
+    assert Scrubber(checksummed_file_storage).verify(file_id) == Scrubber.UNVERIFIABLE
+
+
+def test_scrub_resume(checksummed_file_storage, tmpdir):
+    file_ids = [checksummed_file_storage.store(b"data").hex for _ in range(4)]
+    checkpoint_path = os.path.join(str(tmpdir), "scrub.ckpt")
+
+    report = Scrubber(checksummed_file_storage, checkpoint_path=checkpoint_path).run(
+        file_ids[:3]
+    )
+    assert report.checked == 3
+    report = Scrubber(checksummed_file_storage, checkpoint_path=checkpoint_path).run()
+    assert report.checked == 1
+
+
+def test_scrub_s3(s3_client, s3_bucket):
+    s3_client.create_bucket(Bucket=s3_bucket)
+    storage = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        checksum_algorithm="sha256",
+    )
+    calls = []
+    storage.s3_client.meta.events.register(
+        "provide-client-params.s3.PutObject",
+        lambda params, **kwargs: calls.append(params),
+    )
+    file_id = storage.store(b"hello world")
+    # the digest computed once is sent to S3 for verification
+    digest = hashlib.sha256(b"hello world").digest()
+    assert calls[0]["ChecksumSHA256"] == base64.b64encode(digest).decode("ascii")
+    assert "ChecksumAlgorithm" not in calls[0]
+    truncated_id = storage.store(b"hello world")
+    # simulate truncated object keeping its metadata
+    s3_client.put_object(
+        Bucket=s3_bucket,
+        Key="db/" + truncated_id.hex,
+        Body=b"hello",
+        Metadata=s3_client.head_object(Bucket=s3_bucket, Key="db/" + file_id.hex)[
+            "Metadata"
+        ],
+    )
+
+    report = Scrubber(storage).run()
+    assert report.checked == 2
+    assert report.ok == 1
+    assert report.mismatched == [truncated_id.hex]
+
+
+def test_scrub_throttled(checksummed_file_storage):
+    for _ in range(3):
+        checksummed_file_storage.store(b"x" * 4000)
+    started = time.monotonic()
+    # 12000 bytes with a burst of 10000 bytes must take 0.2 s
+    report = Scrubber(checksummed_file_storage, bytes_per_sec=10000).run()
+    assert report.ok == 3
+    assert time.monotonic() - started >= 0.15
+
+
+def test_rate_limiter():
+    limiter = RateLimiter(100, burst=1)
+    started = time.monotonic()
+    for _ in range(6):
+        limiter.acquire()
+    assert time.monotonic() - started >= 0.04
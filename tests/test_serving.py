@@ -0,0 +1,139 @@
+import asyncio
+import socket
+import uuid
+from wsgiref.util import FileWrapper
+
+from simple_file_repository.serving import (
+    asgi_response,
+    negotiate_format,
+    sendfile,
+    wsgi_response,
+)
+
+
+class StartResponse:
+    """Records arguments of WSGI start_response."""
+
+    def __init__(self):
+        self.status = None
+        self.headers = None
+
+    def __call__(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+
+def run_asgi(storage, file_id, scope):
+    messages = []
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(asgi_response(storage, file_id, scope, send))
+    return messages
+
+
+def test_open_file(file_storage_db, sample_image):
+    file_id = file_storage_db.store(sample_image)
+    with file_storage_db.open_file(file_id) as handle:
+        assert handle.size == len(sample_image)
+        assert handle.content_type == "image/jpeg"
+        assert handle.fileno() is not None
+        assert handle.path == file_storage_db.get_path(file_id)
+        assert handle.read() == sample_image
+
+
+def test_open_file_s3(s3_storage_db, sample_image):
+    file_id = s3_storage_db.store(sample_image, content_type="image/jpeg")
+    with s3_storage_db.open_file(file_id) as handle:
+        assert handle.size == len(sample_image)
+        assert handle.content_type == "image/jpeg"
+        assert handle.fileno() is None
+        assert handle.read() == sample_image
+
+
+def test_wsgi_file_wrapper(file_storage_db, sample_image):
+    file_id = file_storage_db.store(sample_image)
+    start_response = StartResponse()
+    body = wsgi_response(
+        file_storage_db,
+        file_id,
+        {"wsgi.file_wrapper": FileWrapper},
+        start_response,
+        headers=[("Cache-Control", "public")],
+    )
+    assert isinstance(body, FileWrapper)
+    assert b"".join(body) == sample_image
+    body.close()
+    assert start_response.status == "200 OK"
+    assert start_response.headers["Content-Type"] == "image/jpeg"
+    assert start_response.headers["Content-Length"] == str(len(sample_image))
+    assert start_response.headers["Cache-Control"] == "public"
+
+
+def test_wsgi_streaming(s3_storage_db, sample_image):
+    file_id = s3_storage_db.store(sample_image, content_type="image/jpeg")
+    start_response = StartResponse()
+    body = wsgi_response(
+        s3_storage_db,
+        file_id,
+        {"wsgi.file_wrapper": FileWrapper},
+        start_response,
+        chunk_size=1000,
+    )
+    assert not isinstance(body, FileWrapper)
+    assert b"".join(body) == sample_image
+
+
+def test_wsgi_not_found(file_storage_db):
+    start_response = StartResponse()
+    wsgi_response(file_storage_db, uuid.uuid4(), {}, start_response)
+    assert start_response.status == "404 Not Found"
+
+
+def test_asgi_zerocopy(file_storage_db, sample_image):
+    file_id = file_storage_db.store(sample_image)
+    scope = {"type": "http", "extensions": {"http.response.zerocopysend": {}}}
+    messages = run_asgi(file_storage_db, file_id, scope)
+    assert messages[0]["status"] == 200
+    assert (b"content-type", b"image/jpeg") in messages[0]["headers"]
+    assert messages[1]["type"] == "http.response.zerocopysend"
+    assert messages[1]["count"] == len(sample_image)
+
+
+def test_asgi_streaming(file_storage_db, sample_image):
+    file_id = file_storage_db.store(sample_image)
+    messages = run_asgi(file_storage_db, file_id, {"type": "http"})
+    assert messages[0]["status"] == 200
+    assert b"".join(message["body"] for message in messages[1:]) == sample_image
+    assert not messages[-1]["more_body"]
+
+    messages = run_asgi(file_storage_db, uuid.uuid4(), {"type": "http"})
+    assert messages[0]["status"] == 404
+
+
+def test_sendfile(file_storage_db, s3_storage_db, sample_image):
+    for storage in (file_storage_db, s3_storage_db):
+        file_id = storage.store(sample_image)
+        left, right = socket.socketpair()
+        with left, right, storage.open_file(file_id) as handle:
+            right.settimeout(10)
+            received = bytearray()
+            # sample image fits into socket buffers
+            assert sendfile(handle, left) == len(sample_image)
+            while len(received) < len(sample_image):
+                received.extend(right.recv(65536))
+            assert received == sample_image
+
+
+def test_negotiate_format():
+    available = ["image/avif", "image/webp", "image/jpeg"]
+    assert negotiate_format(None, available) == "image/avif"
+    assert negotiate_format("image/webp,*/*", available) == "image/avif"
+    accept = "image/webp,image/jpeg;q=0.9,*/*;q=0.5"
+    assert negotiate_format(accept, available) == "image/webp"
+    assert negotiate_format("image/avif;q=0, image/*", available) == "image/webp"
+    assert negotiate_format("image/jpeg", available) == "image/jpeg"
+    assert negotiate_format("text/html", available) is None
+    assert negotiate_format("image/*;q=bad", available) is None
+    assert negotiate_format("image/*", []) is None
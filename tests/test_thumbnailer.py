@@ -0,0 +1,113 @@
+import io
+
+import pytest
+
+from simple_file_repository.imageinfo import parse_image_info
+from simple_file_repository.photostorage import PhotoStorage, ThumbnailProfile
+from simple_file_repository.thumbnailer import (
+    ImageMagickThumbnailer,
+    PillowThumbnailer,
+)
+
+from .test_imageinfo import make_exif_jpeg, make_gif
+
+Image = pytest.importorskip("PIL.Image")
+
+
+def open_image(content):
+    image = Image.open(io.BytesIO(content))
+    image.load()
+    return image
+
+
+@pytest.mark.parametrize(
+    "profile",
+    [ThumbnailProfile.QUALITY, ThumbnailProfile.BALANCED, ThumbnailProfile.FAST],
+)
+def test_pillow_render(sample_image, profile):
+    thumbnailer = PillowThumbnailer()
+    # rotated by 90 degrees, becomes portrait
+    content = make_exif_jpeg(sample_image, 6)
+    thumbnails = thumbnailer.render(
+        content,
+        parse_image_info(content),
+        ["image/png", "image/jpeg", "image/webp"],
+        100,
+        profile,
+    )
+
+    png = open_image(thumbnails["image/png"])
+    assert png.size == (100, 100)
+    # centered on a transparent square
+    assert png.getpixel((0, 50))[3] == 0
+    assert png.getpixel((99, 50))[3] == 0
+    assert png.getpixel((50, 50))[3] == 255
+    assert png.getpixel((50, 0))[3] == 255
+
+    jpeg = open_image(thumbnails["image/jpeg"])
+    assert jpeg.size == (100, 100)
+    assert jpeg.mode == "RGB"
+    # metadata is stripped
+    assert not jpeg.getexif()
+    assert "icc_profile" not in jpeg.info
+    assert open_image(thumbnails["image/webp"]).format == "WEBP"
+
+
+def test_pillow_exif_thumbnail(sample_image):
+    thumbnailer = PillowThumbnailer()
+    embedded = open_image(sample_image).resize((300, 225)).convert("RGB")
+    output = io.BytesIO()
+    embedded.save(output, format="JPEG")
+    content = make_exif_jpeg(sample_image, 6, thumbnail=output.getvalue())
+
+    thumbnails = thumbnailer.render(
+        content, parse_image_info(content), ["image/png"], 100, ThumbnailProfile.FAST
+    )
+    png = open_image(thumbnails["image/png"])
+    # orientation of the image is applied to the embedded thumbnail
+    assert png.getpixel((0, 50))[3] == 0
+    assert png.getpixel((50, 0))[3] == 255
+
+
+def test_pillow_photo_storage(file_storage_db):
+    storage = PhotoStorage(file_storage_db, "", thumbnailer=PillowThumbnailer())
+    frames = [Image.new("RGB", (300, 100), color) for color in ("red", "blue")]
+    output = io.BytesIO()
+    frames[0].save(output, format="GIF", save_all=True, append_images=frames[1:])
+    file_id = storage.store(output.getvalue())
+    variants = storage.generate_thumbnail_variants(
+        file_id, ["image/gif", "image/jpeg"], thumb_size=50
+    )
+    gif = open_image(storage.get(variants["image/gif"]))
+    assert gif.size == (50, 50)
+    # the first frame
+    assert gif.convert("RGB").getpixel((25, 25)) == (255, 0, 0)
+    assert storage.get_mimetype(variants["image/jpeg"]) == "image/jpeg"
+
+    with pytest.raises(RuntimeError):
+        storage.generate_thumbnail(file_id, "image/x-unknown")
+
+    file_id = storage.store(make_gif(300, 100))
+    with pytest.raises(RuntimeError):
+        storage.generate_thumbnail(file_id, "image/png")
+
+
+def test_imagemagick_thumbnailer(sample_image, fake_convert):
+    convert, log_path = fake_convert
+    thumbnailer = ImageMagickThumbnailer(convert)
+    thumbnails = thumbnailer.render(
+        sample_image,
+        parse_image_info(sample_image),
+        ["image/png", "image/jpeg"],
+        100,
+        ThumbnailProfile.QUALITY,
+    )
+    # fake convert copies its source
+    assert thumbnails == {"image/png": sample_image, "image/jpeg": sample_image}
+    with open(log_path, encoding="utf-8") as f:
+        assert len(f.readlines()) == 1
+
+    with pytest.raises(RuntimeError):
+        ImageMagickThumbnailer("").render(
+            sample_image, None, ["image/png"], 100, ThumbnailProfile.QUALITY
+        )
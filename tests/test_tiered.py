@@ -0,0 +1,197 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from simple_file_repository.exceptions import StorageError, StorageNotFoundError
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.tieredstorage import TieredStorage
+
+
+@pytest.fixture(name="tiered_storage")
+def fixture_tiered_storage(tmpdir, s3_storage_db):
+    storage = TieredStorage(
+        local=FileStorage(str(tmpdir), "db"),
+        remote=s3_storage_db,
+        journal_directory=os.path.join(str(tmpdir), "journal"),
+        retry_base_delay=0.01,
+    )
+    yield storage
+    storage.close()
+
+
+def wait_until(predicate, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_write_behind(tiered_storage, s3_storage_db, sample_image):
+    file_id = tiered_storage.store(sample_image, content_type="image/jpeg")
+    assert tiered_storage.local.exists(file_id)
+    assert tiered_storage.get(file_id) == sample_image
+    assert tiered_storage.exists(file_id)
+    assert tiered_storage.get_mimetype(file_id) == "image/jpeg"
+
+    assert tiered_storage.flush(timeout=10)
+    assert s3_storage_db.get(file_id) == sample_image
+    assert s3_storage_db.get_mimetype(file_id) == "image/jpeg"
+    assert tiered_storage.count() == 1
+    assert list(tiered_storage.list()) == [file_id.hex]
+    # still in grace period
+    assert tiered_storage.local.exists(file_id)
+
+
+def test_demote_after_grace(tmpdir, s3_storage_db):
+    storage = TieredStorage(
+        local=FileStorage(str(tmpdir), "db"),
+        remote=s3_storage_db,
+        journal_directory=os.path.join(str(tmpdir), "journal"),
+        grace_period=0,
+    )
+    try:
+        file_id = storage.store(b"content")
+        assert storage.flush(timeout=10)
+        assert wait_until(lambda: not os.listdir(storage.journal_directory))
+        assert not storage.local.exists(file_id)
+        assert storage.get(file_id) == b"content"
+    finally:
+        storage.close()
+
+
+def test_survive_restart(tmpdir, s3_storage_db):
+    local = FileStorage(str(tmpdir), "db")
+    journal_directory = os.path.join(str(tmpdir), "journal")
+    storage = TieredStorage(local, s3_storage_db, journal_directory, start=False)
+    file_id = storage.store(b"content", content_type="text/plain")
+    storage.close()
+    assert not s3_storage_db.exists(file_id)
+
+    storage = TieredStorage(local, s3_storage_db, journal_directory)
+    try:
+        assert storage.flush(timeout=10)
+        assert s3_storage_db.get(file_id) == b"content"
+        assert s3_storage_db.get_mimetype(file_id) == "text/plain"
+    finally:
+        storage.close()
+
+
+def test_retry_upload(tiered_storage, s3_storage_db, monkeypatch):
+    original_store = s3_storage_db.store
+    failures = []
+
+    def flaky_store(*args, **kwargs):
+        if len(failures) < 2:
+            failures.append(1)
+            # not only storage errors are retried
+            raise StorageError("SlowDown") if len(failures) == 1 else OSError()
+        return original_store(*args, **kwargs)
+
+    monkeypatch.setattr(s3_storage_db, "store", flaky_store)
+
+    file_id = tiered_storage.store(b"content")
+    assert tiered_storage.flush(timeout=10)
+    assert len(failures) == 2
+    assert s3_storage_db.exists(file_id)
+    journal_path = os.path.join(tiered_storage.journal_directory, file_id.hex + ".json")
+    with open(journal_path, encoding="utf-8") as f:
+        assert json.load(f)["attempts"] == 2
+
+
+def test_store_again_during_upload(tmpdir, monkeypatch):
+    remote = FileStorage(str(tmpdir), "remote")
+    storage = TieredStorage(
+        local=FileStorage(str(tmpdir), "db"),
+        remote=remote,
+        journal_directory=os.path.join(str(tmpdir), "journal"),
+    )
+    original_store = remote.store
+    uploading = threading.Event()
+    release = threading.Event()
+
+    def blocked_store(*args, **kwargs):
+        if not release.is_set():
+            uploading.set()
+            release.wait(10)
+        return original_store(*args, **kwargs)
+
+    monkeypatch.setattr(remote, "store", blocked_store)
+    try:
+        file_id = storage.store(b"old")
+        assert uploading.wait(10)
+        storage.delete(file_id)
+        storage.store(b"new", override_id=file_id)
+        release.set()
+        assert storage.flush(timeout=10)
+        # the content stored again is uploaded, not marked by the stale upload
+        assert remote.get(file_id) == b"new"
+    finally:
+        release.set()
+        storage.close()
+
+
+def test_upload_already_stored(tmpdir):
+    remote = FileStorage(str(tmpdir), "remote")
+    storage = TieredStorage(
+        local=FileStorage(str(tmpdir), "db"),
+        remote=remote,
+        journal_directory=os.path.join(str(tmpdir), "journal"),
+        start=False,
+    )
+    file_id = storage.store(b"content")
+    # uploaded before a crash, but not recorded in the journal
+    remote.store(b"content", override_id=file_id)
+    assert list(storage.list()) == [file_id.hex]
+    assert storage.count() == 1
+    assert storage.usage().count == 1
+
+    storage.start()
+    try:
+        assert storage.flush(timeout=10)
+        assert remote.get(file_id) == b"content"
+    finally:
+        storage.close()
+
+
+def test_delete(tiered_storage, s3_storage_db):
+    file_id = tiered_storage.store(b"content")
+    assert tiered_storage.flush(timeout=10)
+    tiered_storage.delete(file_id)
+    assert not tiered_storage.exists(file_id)
+    assert not s3_storage_db.exists(file_id)
+    with pytest.raises(StorageNotFoundError):
+        tiered_storage.get(file_id)
+    with pytest.raises(StorageNotFoundError):
+        tiered_storage.delete(file_id)
+
+
+def test_copy(tmpdir, s3_storage_db):
+    storage = TieredStorage(
+        local=FileStorage(str(tmpdir), "db"),
+        remote=s3_storage_db,
+        journal_directory=os.path.join(str(tmpdir), "journal"),
+        start=False,
+    )
+    try:
+        file_id = storage.store(b"content", content_type="text/plain", tags={"a": "b"})
+        # not uploaded yet, linked locally and uploaded in background
+        copy_id = storage.copy(file_id, tags={"c": "d"})
+        assert storage.local.exists(copy_id)
+        assert not s3_storage_db.exists(copy_id)
+        storage.start()
+        assert storage.flush(timeout=10)
+        assert s3_storage_db.get(copy_id) == b"content"
+        assert s3_storage_db.stat(copy_id, with_tags=True).tags == {"c": "d"}
+
+        # uploaded, copied by the remote storage
+        copy_id = storage.copy(file_id)
+        assert not storage.local.exists(copy_id)
+        assert storage.get(copy_id) == b"content"
+        assert storage.get_mimetype(copy_id) == "text/plain"
+    finally:
+        storage.close()
@@ -0,0 +1,153 @@
+import os
+import threading
+
+from simple_file_repository.filestorage import FileStorage
+from simple_file_repository.photostorages import PhotoStorages
+from simple_file_repository.s3storage import S3Storage
+from simple_file_repository.usage import SIZE_BUCKETS, Usage
+
+
+def test_usage_histogram():
+    usage = Usage.from_sizes([0, 1024, 1025, 10**12])
+    assert usage.count == 4
+    assert usage.total_bytes == 1024 + 1025 + 10**12
+    assert usage.histogram[0] == 2
+    assert usage.histogram[1] == 1
+    assert usage.histogram[len(SIZE_BUCKETS)] == 1
+    usage.add(1025, -1)
+    assert usage == Usage.from_sizes([0, 1024, 10**12])
+    assert (usage + usage).count == 6
+
+
+def test_file_usage_scan(file_storage_db):
+    file_storage_db.store(b"x" * 10)
+    file_storage_db.store(b"x" * 5000)
+    assert file_storage_db.usage() == Usage.from_sizes([10, 5000])
+
+
+def test_file_usage_tracked(tmpdir):
+    storage = FileStorage(str(tmpdir), "db")
+    # existing data is picked up by reconciliation
+    storage.store(b"x" * 10)
+
+    storage = FileStorage(str(tmpdir), "db", track_usage=True)
+    assert storage.usage() == Usage.from_sizes([10])
+    file_id = storage.store(b"x" * 5000)
+    storage.store(b"x" * 20)
+    storage.delete(file_id)
+    counter_path = os.path.join(str(tmpdir), "db", ".usage.json")
+    assert os.path.isfile(counter_path)
+
+    # counters are persisted and shared
+    storage = FileStorage(str(tmpdir), "db", track_usage=True)
+    assert storage.usage() == Usage.from_sizes([10, 20])
+
+    # broken counter is reconciled
+    with open(counter_path, "w", encoding="ascii") as f:
+        f.write("{")
+    assert storage.usage() == Usage.from_sizes([10, 20])
+
+
+def test_file_usage_reconcile_concurrently(tmpdir, monkeypatch):
+    storage = FileStorage(str(tmpdir), "db", track_usage=True)
+    storage.store(b"x" * 10)
+    scan_usage = storage._scan_usage  # pylint: disable=protected-access
+    thread = threading.Thread(target=storage.store, args=(b"x" * 20,))
+
+    def scan_during_store():
+        thread.start()
+        # the store waits for the scan, so it is counted once
+        thread.join(0.2)
+        assert thread.is_alive()
+        return scan_usage()
+
+    monkeypatch.setattr(storage, "_scan_usage", scan_during_store)
+    assert storage.reconcile_usage() == Usage.from_sizes([10])
+    thread.join()
+    assert storage.usage() == Usage.from_sizes([10, 20])
+
+
+def test_s3_usage_tracked(s3_client, s3_bucket):
+    s3_client.create_bucket(Bucket=s3_bucket)
+    storage = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        track_usage=True,
+    )
+    storage.store(b"x" * 10)
+    assert storage.usage() == Usage.from_sizes([10])
+    assert storage.count() == 1
+
+    file_id = storage.store(b"x" * 5000)
+    storage.store(b"x" * 20)
+    storage.delete(file_id)
+    assert storage.usage() == Usage.from_sizes([10, 20])
+    assert storage.reconcile_usage() == Usage.from_sizes([10, 20])
+
+    untracked = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+    )
+    assert untracked.usage() == Usage.from_sizes([10, 20])
+
+    # flushed changes are counted by other processes
+    other = S3Storage(
+        database="db",
+        bucket=s3_bucket,
+        region="us-east-1",
+        access_key_id="",
+        secret_access_key="",
+        track_usage=True,
+    )
+    storage.store(b"x" * 30)
+    storage.flush_usage()
+    assert other.usage() == Usage.from_sizes([10, 20, 30])
+    # and dropped by a reconcile
+    assert other.reconcile_usage() == Usage.from_sizes([10, 20, 30])
+    assert not s3_client.list_objects_v2(Bucket=s3_bucket, Prefix="_sfr/usage/db/")[
+        "KeyCount"
+    ]
+
+
+def test_photo_storages_usage(s3_client, s3_bucket, tmpdir):
+    s3_client.create_bucket(Bucket=s3_bucket)
+    storages = PhotoStorages(max_live_storages=1)
+    storages.init_app(
+        names=["db", "dbs3"],
+        storage_directory=str(tmpdir),
+        names_for_s3=["dbs3"],
+        imagemagick_convert="",
+        access_key_id="",
+        secret_access_key="",
+        region="us-east-1",
+        bucket=s3_bucket,
+        endpoint_url=None,
+        default_cache_control=None,
+        track_usage=True,
+    )
+    storages["db"].store(b"x" * 10)
+    storages["dbs3"].store(b"x" * 20)
+    assert storages.usage_by_database()["db"] == Usage.from_sizes([10])
+    assert storages.usage() == Usage.from_sizes([10, 20])
+
+    # usage changes of an evicted storage are flushed
+    storages["dbs3"].store(b"x" * 30)
+    storages["db"].count()
+    assert s3_client.list_objects_v2(Bucket=s3_bucket, Prefix="_sfr/usage/dbs3/")[
+        "KeyCount"
+    ]
+    assert storages.usage() == Usage.from_sizes([10, 20, 30])
+
+    # re-created storages resume changes of evicted ones under one writer
+    for size in (40, 50):
+        storages["dbs3"].store(b"x" * size)
+        storages["db"].count()
+    response = s3_client.list_objects_v2(Bucket=s3_bucket, Prefix="_sfr/usage/dbs3/")
+    assert response["KeyCount"] == 1
+    assert storages.usage() == Usage.from_sizes([10, 20, 30, 40, 50])
@@ -1,6 +1,9 @@
+import os
+import uuid
+
 import magic
 
-from simple_file_repository.utils import guess_mime_type
+from simple_file_repository.utils import Checkpoint, guess_mime_type
 
 
 def test_libmagic_guess_image(sample_image):
@@ -26,3 +29,31 @@ def test_guess_text():
     buffer = b"just plain text"
     mime_type = guess_mime_type(buffer)
     assert mime_type == "text/plain"
+
+
+def test_checkpoint_spill(tmpdir):
+    path = os.path.join(str(tmpdir), "checkpoint.txt")
+    file_ids = [uuid.uuid4().hex for _ in range(100)]
+    with Checkpoint(path, memory_ids=4) as checkpoint:
+        for file_id in file_ids:
+            checkpoint.add(file_id)
+        checkpoint.add(file_ids[0])
+        # pylint: disable=protected-access
+        assert len(checkpoint._recent) < 4
+        assert len(checkpoint._runs) <= 5
+        assert len(checkpoint) == 100
+        assert all(file_id in checkpoint for file_id in file_ids)
+        assert uuid.uuid4().hex not in checkpoint
+        assert "not an id" not in checkpoint
+
+    # a torn line is skipped
+    with open(path, "a", encoding="ascii") as f:
+        f.write(file_ids[0][:10])
+    file_id = uuid.uuid4().hex
+    with Checkpoint(path, memory_ids=4) as checkpoint:
+        assert len(checkpoint) == 100
+        assert all(file_id in checkpoint for file_id in file_ids)
+        checkpoint.add(file_id)
+    with Checkpoint(path) as checkpoint:
+        assert len(checkpoint) == 101
+        assert file_id in checkpoint